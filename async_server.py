@@ -0,0 +1,169 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from server import AUTH_BUSY, CONNECTIONS, FRAME_SECONDS, ChatServer
+from connection import AsyncConnection
+from protocol import FRAME_HANDSHAKE, MAX_AUTH_FRAME_SIZE, MAX_FRAME_SIZE, FrameDecoder, ProtocolError, detect_version
+
+class AsyncChatServer(ChatServer):
+    """ChatServer engine running every connection on a single asyncio event loop"""
+    def __init__(self, host='0.0.0.0', port=5555, **kwargs):
+        super().__init__(host, port, **kwargs)
+        self.loop = None
+        self.stopped = None
+        # Blocking SQLite reads and auth run here so they never stall the
+        # event loop (message writes go through the batched MessageWriter)
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chatx-db")
+
+    async def handle_client(self, reader, writer):
+        # Handle individual client connection
+        if not self.admit_connection():
+            writer.write(self.busy_reply())
+            writer.close()
+            return
+        self.configure_socket(writer.get_extra_info('socket'))
+        address = writer.get_extra_info('peername')
+        username = None
+        connection = None
+        authenticated = False
+        CONNECTIONS.inc()
+
+        try:
+            # Authentication loop: HELLO (binary clients), then AUTH
+            decoder = None
+            session = None
+            while not username:
+                try:
+                    data_chunk = await asyncio.wait_for(reader.read(4096), 10.0)
+                except asyncio.TimeoutError:
+                    # Test connection that doesn't send data - just close silently
+                    return
+
+                if not data_chunk:
+                    return
+
+                if decoder is None:
+                    decoder = FrameDecoder(detect_version(data_chunk), MAX_AUTH_FRAME_SIZE)
+
+                for frame_type, payload in self.auth_frames(decoder, data_chunk):
+                    if frame_type == FRAME_HANDSHAKE:
+                        reply, session = self.process_hello(payload)
+                        if reply is not None:
+                            writer.write(reply)
+                        if session is None:
+                            return
+                        continue
+
+                    # The password check runs on the auth pool; the loop only awaits it
+                    request = self.parse_auth_request(payload, self.auth_cipher(decoder.version, session))
+                    if request is None:
+                        return
+                    future = self.submit_credentials(request)
+                    success, message = await asyncio.wrap_future(future) if future else (False, AUTH_BUSY)
+                    result = self.finish_auth(request, success, message, address, decoder.version, session)
+
+                    username, encrypted_response, features, session, resume_from = result
+                    writer.write(self.auth_response_bytes(encrypted_response, decoder.version))
+                    if username:
+                        break
+
+            self.connection_limiter.authenticated()
+            decoder.max_frame_size = MAX_FRAME_SIZE
+            authenticated = True
+
+            connection = AsyncConnection(writer, self.loop, username, address, self.send_policy)
+            self.configure_connection(connection, decoder.version, features, session)
+            self.register_client(connection)
+            self.send_session_token(connection)
+            await self.loop.run_in_executor(self.db_executor, self.send_history, connection, resume_from)
+            connection.start()
+            self.watch_connection(connection)
+            self.announce_join(username)
+
+            # Main message loop: the decoder buffers partial frames
+            while self.running:
+                for frame_type, flags, encrypted_data in decoder.drain():
+                    start = time.perf_counter()
+                    try:
+                        for future in self.client_frame_steps(encrypted_data, connection):
+                            await asyncio.wrap_future(future)
+                    except Exception as e:
+                        print(f"[SERVER] Error processing message: {e}")
+                    finally:
+                        FRAME_SECONDS.observe(time.perf_counter() - start)
+
+                data_chunk = await reader.read(65536)
+                if not data_chunk:
+                    break
+                connection.last_received = time.monotonic()
+                decoder.feed(data_chunk)
+
+        except ProtocolError as e:
+            print(f"[SERVER] Protocol error from {address}: {e}")
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            print(f"[SERVER] Error with client {address}: {e}")
+
+        finally:
+            if connection:
+                connection.close()
+                if self.unregister_client(connection):
+                    self.announce_leave(username)
+
+            writer.close()
+            self.connection_limiter.release(authenticated)
+
+    async def serve(self):
+        # Accept connections on the event loop until stop() is called
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+
+        server = await asyncio.start_server(
+            self.handle_client, self.host, self.port,
+            reuse_address=True, reuse_port=self.reuse_port or None, backlog=self.backlog
+        )
+        self.running = True
+
+        print(f"[SERVER] ChatX Server (asyncio engine) started on {self.host}:{self.port}")
+        self.start_beacon()
+        self.start_metrics()
+        print(f"[SERVER] Waiting for connections...")
+
+        # Start terminal input monitoring thread
+        if self.interactive:
+            input_thread = threading.Thread(target=self.monitor_terminal_input, daemon=True)
+            input_thread.start()
+
+        async with server:
+            await self.stopped.wait()
+
+    def start(self):
+        # Start the server
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            print(f"[SERVER] Server error: {e}")
+        finally:
+            self.stop()
+
+    def run_blocking(self, func, *args):
+        # Off the event loop, on the database executor
+        return self.db_executor.submit(func, *args)
+
+    def close_database(self):
+        # Let queued database work finish before the connection pool closes
+        self.db_executor.shutdown(wait=True)
+        super().close_database()
+
+    def stop(self):
+        # Stop the server
+        was_running = self.running
+        super().stop()
+
+        if was_running and self.loop and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self.stopped.set)
+            except RuntimeError:
+                pass
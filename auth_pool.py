@@ -0,0 +1,46 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import REGISTRY
+
+AUTH_REJECTED = REGISTRY.counter('chatx_auth_rejected_total', "AUTH requests refused because the auth pool was full")
+
+class AuthPool:
+    """Bounded thread pool for password hashing, with admission control.
+
+    At most `workers` KDF computations run at once (hashlib releases the
+    GIL, so they use that many cores), and at most `max_pending` requests
+    may be running or queued. Beyond that submit() refuses at once, so a
+    reconnect storm is answered with "busy" instead of a queue of
+    connections waiting seconds for their turn.
+    """
+    def __init__(self, workers=None, max_pending=256):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="chatx-auth")
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        """Future for fn(*args), or None when the pool is full"""
+        with self.lock:
+            if self.pending >= self.max_pending:
+                AUTH_REJECTED.inc()
+                return None
+            self.pending += 1
+        try:
+            future = self.executor.submit(fn, *args)
+        except RuntimeError:
+            # Shut down
+            self.release()
+            return None
+        future.add_done_callback(self.release)
+        return future
+
+    def release(self, future=None):
+        with self.lock:
+            self.pending -= 1
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
@@ -1,9 +1,82 @@
+import base64
+import json
+import os
+import random
 import socket
-from encryption import MessageEncryption
+import threading
+import time
+from encryption import (
+    DEFAULT_CIPHERS, FERNET_TOKEN_PREFIX, KeyExchange, MessageEncryption, SessionCipher, verify_signature,
+)
+from heartbeat import set_keepalive
+from protocol import (
+    AUTH_BUSY, CLIENT_FEATURES, FRAME_HANDSHAKE, HANDSHAKE_ERROR, HANDSHAKE_HELLO, LEGACY_VERSION,
+    PROTOCOL_VERSION, FrameDecoder, encode_wire, format_key_exchange, hello_transcript,
+)
+
+SERVER_CLOSED = "Server closed connection"
+IDENTITY_CHANGED = "Server identity key has changed"
+
+# Where AuthService pins server identity keys by default
+KNOWN_SERVERS_PATH = os.path.join(os.path.expanduser("~"), ".chatx_known_servers.json")
+
+class KnownServers:
+    """Server identity keys pinned on first use, by "host:port".
+
+    Saved to a JSON file when `path` is given, otherwise kept only as
+    long as the object.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.keys = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.keys = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"[CLIENT] Ignoring unreadable {path}: {e}")
+
+    def get(self, server):
+        return self.keys.get(server)
+
+    def pin(self, server, key):
+        with self.lock:
+            if self.keys.get(server) == key:
+                return
+            self.keys[server] = key
+            if not self.path:
+                return
+            try:
+                with open(self.path, 'w') as f:
+                    json.dump(self.keys, f, indent=2)
+            except OSError as e:
+                print(f"[CLIENT] Could not save {self.path}: {e}")
+
+def server_name(sock):
+    # "host:port" a server's identity key is pinned under
+    host, port = sock.getpeername()[:2]
+    return f"{host}:{port}"
 
 class AuthService:
-    def __init__(self):
+    def __init__(self, known_servers=None):
         self.encryption = MessageEncryption()
+        # Identity keys of servers met before; a different key fails the login
+        self.known_servers = known_servers or KnownServers(KNOWN_SERVERS_PATH)
+        # Wire format and receive decoder of the last successful session;
+        # the decoder may already hold frames sent right after AUTH_RESPONSE
+        self.protocol_version = PROTOCOL_VERSION
+        self.decoder = None
+        # Ciphers of the last successful session: the per-session AEAD
+        # cipher and the group cipher for broadcasts, or the shared Fernet
+        # key (and no group cipher) when none was negotiated
+        self.cipher = self.encryption
+        self.group_cipher = None
+        # True when the last failure was the server answering FAIL, rather
+        # than the connection failing
+        self.rejected = False
+        # True when the last successful session was resumed with a token
+        self.resumed = False
 
     def connect_server(self, ip, port):
         """Establish connection to the server"""
@@ -12,33 +85,124 @@ class AuthService:
             client_socket.settimeout(10)  # 10s timeout for connection
             client_socket.connect((ip, port))
             client_socket.settimeout(None)  # Reset timeout
+            set_keepalive(client_socket)  # notice a vanished server even when idle
             return client_socket
         except Exception as e:
             raise Exception(f"Connection failed: {e}")
 
-    def authenticate(self, client_socket, username, password, action):
-        """Handle the authentication handshake"""
+    def read_frame(self, client_socket, decoder):
+        """Read until the decoder holds one complete frame; returns (frame_type, payload)"""
+        while True:
+            for frame_type, flags, payload in decoder:
+                return frame_type, payload
+            if not decoder.recv_into(client_socket):
+                return None, None
+
+    def read_response(self, client_socket, decoder):
+        """Read until the decoder holds one complete frame; returns its payload"""
+        return self.read_frame(client_socket, decoder)[1]
+
+    def handshake(self, client_socket, decoder):
+        """Agree a session key with a binary-framing server before AUTH.
+
+        Sends HELLO with an ephemeral X25519 key and checks the server's
+        signed reply against the identity key pinned for this server,
+        pinning it on first contact. Returns (cipher, identity); raises
+        when the server refuses, answers oddly or shows another key.
+        """
+        exchange = KeyExchange()
+        hello = f"{HANDSHAKE_HELLO}|{format_key_exchange(exchange.public_key, DEFAULT_CIPHERS)}".encode()
+        client_socket.sendall(encode_wire(hello, PROTOCOL_VERSION, FRAME_HANDSHAKE))
+        frame_type, payload = self.read_frame(client_socket, decoder)
+        if payload is None:
+            raise Exception(SERVER_CLOSED)
+        if frame_type != FRAME_HANDSHAKE:
+            raise Exception("Invalid server response format")
+        
+        kind, _, reply = payload.decode(errors='replace').partition('|')
+        if kind == HANDSHAKE_ERROR:
+            # Refused before AUTH, e.g. busy
+            self.rejected = True
+            raise Exception(reply)
+        fields = reply.split('|')
+        if kind != HANDSHAKE_HELLO or len(fields) != 4:
+            raise Exception("Invalid server response format")
+        
+        algorithm, server_key, identity, signature = fields
+        signed = f"{HANDSHAKE_HELLO}|{algorithm}|{server_key}|{identity}".encode()
+        if not verify_signature(identity, signature, hello_transcript(hello, signed)):
+            self.rejected = True
+            raise Exception("Invalid server handshake signature")
+        pinned = self.known_servers.get(server_name(client_socket))
+        if pinned is not None and pinned != identity:
+            self.rejected = True
+            raise Exception(IDENTITY_CHANGED)
+        return exchange.session_cipher(server_key, algorithm, is_client=True), identity
+
+    def read_legacy_response(self, client_socket, decoder):
+        """Read a legacy server's bare AUTH_RESPONSE token.
+
+        Nothing ends the token, and the frames the server sends right
+        behind it (history, user list) often arrive in the same read. The
+        response ends where the next Fernet token begins; the bytes after
+        it go to the decoder.
+        """
+        data = b''
+        while True:
+            chunk = client_socket.recv(4096)
+            if not chunk:
+                return data or None
+            data += chunk
+            end = data.find(FERNET_TOKEN_PREFIX, 1)
+            while end > 0:
+                if self.encryption.decrypt_bytes(data[:end]) is not None:
+                    decoder.feed(data[end:])
+                    return data[:end]
+                end = data.find(FERNET_TOKEN_PREFIX, end + 1)
+            if self.encryption.decrypt_bytes(data) is not None:
+                return data
+
+    def authenticate(self, client_socket, username, password, action, version=PROTOCOL_VERSION,
+                     last_seen_id=None):
+        """Handle the authentication handshake.
+
+        Binary framing first agrees a session key in a HELLO round trip
+        (see handshake), so the credentials never travel under the shared
+        key; legacy servers only know the shared Fernet key.
+        """
         try:
-            # Send authentication request
-            auth_request = f"AUTH|{action}|{username}|{password}"
-            encrypted_auth = self.encryption.encrypt(auth_request)
-            client_socket.send(encrypted_auth.encode())
+            # Authentication request, advertising optional protocol features
+            auth_request = f"AUTH|{action}|{username}|{password}|{','.join(CLIENT_FEATURES)}"
+            if last_seen_id is not None:
+                # The newest message id we hold, after the retired key exchange field
+                auth_request += f"||{last_seen_id}"
+            decoder = FrameDecoder(version)
             
             # Receive authentication response
-            client_socket.settimeout(10) # Wait at most 10s for auth response
-            encrypted_response = client_socket.recv(4096).decode()
+            client_socket.settimeout(10) # Wait at most 10s for each reply
+            identity = None
+            if version == LEGACY_VERSION:
+                # Legacy servers send the bare token, unframed
+                cipher = self.encryption
+                client_socket.sendall(cipher.encrypt(auth_request).encode())
+                encrypted_response = self.read_legacy_response(client_socket, decoder)
+            else:
+                cipher, identity = self.handshake(client_socket, decoder)
+                client_socket.sendall(encode_wire(cipher.encrypt_bytes(auth_request.encode()), version))
+                encrypted_response = self.read_response(client_socket, decoder)
             client_socket.settimeout(None)
             
             if not encrypted_response:
-                raise Exception("Server closed connection")
+                raise Exception(SERVER_CLOSED)
                 
-            response = self.encryption.decrypt(encrypted_response)
+            response = cipher.decrypt_bytes(encrypted_response)
             
             if not response:
                 raise Exception("Failed to decrypt server response")
+            response = response.decode()
             
-            # Parse response
-            parts = response.split('|', 2)
+            # Parse response: AUTH_RESPONSE|STATUS|MESSAGE[|GROUP_KEY]
+            parts = response.split('|')
             if len(parts) < 3 or parts[0] != "AUTH_RESPONSE":
                 raise Exception("Invalid server response format")
             
@@ -46,39 +210,118 @@ class AuthService:
             message = parts[2]
             
             if status == "SUCCESS":
+                self.protocol_version = version
+                self.decoder = decoder
+                self.cipher, self.group_cipher = cipher, None
+                if identity:
+                    if len(parts) < 4:
+                        raise Exception("Invalid server response format")
+                    self.group_cipher = SessionCipher(base64.b64decode(parts[3]), cipher.algorithm)
+                    self.known_servers.pin(server_name(client_socket), identity)
+                self.resumed = action == "RESUME"
                 return True, message
             else:
+                self.rejected = True
                 return False, message
                 
         except socket.timeout:
             return False, "Authentication timed out"
+        except (ConnectionResetError, BrokenPipeError):
+            return False, SERVER_CLOSED
         except Exception as e:
             return False, str(e)
 
-    def login(self, ip, port, username, password):
-        """Complete login flow: Connect -> Auth"""
-        try:
+    def open_session(self, ip, port, username, password, action, last_seen_id=None):
+        """Connect and authenticate, falling back to the legacy wire format.
+
+        Servers that predate binary framing drop the connection on a framed
+        HELLO without answering, so one retry with newline framing keeps
+        them usable. Current servers always answer, even when they refuse a
+        connection as busy, so no other failure falls back, and neither
+        does a server whose identity key is pinned: it has spoken binary
+        framing before, so a silent close is no reason to send the password
+        under the shared key.
+        """
+        self.rejected = False
+        # A SESSION token is only ever sent under a session key
+        versions = (PROTOCOL_VERSION,) if action == "RESUME" else (PROTOCOL_VERSION, LEGACY_VERSION)
+        for version in versions:
             sock = self.connect_server(ip, port)
-            success, message = self.authenticate(sock, username, password, "LOGIN")
-            
+            pinned = self.known_servers.get(server_name(sock))
+            success, message = self.authenticate(sock, username, password, action, version, last_seen_id)
             if success:
                 return True, sock, message
-            else:
-                sock.close()
-                return False, None, message
+            sock.close()
+            if message != SERVER_CLOSED or pinned:
+                break
+        return False, None, message
+
+    def login(self, ip, port, username, password, last_seen_id=None):
+        """Complete login flow: Connect -> Auth"""
+        try:
+            return self.open_session(ip, port, username, password, "LOGIN", last_seen_id)
         except Exception as e:
             return False, None, str(e)
             
     def register(self, ip, port, username, password):
         """Complete registration flow: Connect -> Auth"""
         try:
-            sock = self.connect_server(ip, port)
-            success, message = self.authenticate(sock, username, password, "REGISTER")
-            
-            if success:
-                return True, sock, message
-            else:
-                sock.close()
-                return False, None, message
+            return self.open_session(ip, port, username, password, "REGISTER")
         except Exception as e:
             return False, None, str(e)
+
+    def resume(self, ip, port, username, token, last_seen_id=0):
+        """Reconnect with a SESSION token instead of the password.
+
+        No password check runs on the server, and history is only replayed
+        after last_seen_id (0 for the usual full replay). A refused or
+        expired token fails like a bad password; log in again then. Only
+        binary framing is tried: the token must not travel under the
+        shared legacy key.
+        """
+        try:
+            return self.open_session(ip, port, username, token, "RESUME", last_seen_id)
+        except Exception as e:
+            return False, None, str(e)
+
+    def reconnect(self, ip, port, username, password, token=None, last_seen_id=0,
+                  should_retry=lambda: True, base_delay=0.5, max_delay=30.0):
+        """Re-establish a lost session, retrying with jittered exponential backoff.
+
+        Tries the SESSION token first and falls back to the password when
+        the server refuses it (with password None, as for a client that
+        does not keep it, a refused token ends the attempt and the user
+        must log in again); either way only messages newer than
+        last_seen_id are replayed. Connection failures and busy servers
+        are retried after a random delay of up to base_delay * 2**attempt
+        (capped at max_delay), so clients dropped together by a server
+        restart come back spread out instead of all at once. Gives up when
+        the password is refused or should_retry() turns false. Returns
+        (success, socket, message) like login().
+        """
+        message = SERVER_CLOSED
+        attempt = 0
+        while should_retry():
+            time.sleep(random.uniform(0, min(max_delay, base_delay * 2 ** attempt)))
+            if not should_retry():
+                break
+            attempt += 1
+            if token:
+                success, sock, message = self.resume(ip, port, username, token, last_seen_id)
+                if success:
+                    return True, sock, message
+                if self.rejected and message != AUTH_BUSY:
+                    # Expired, or signed by a server that has since changed its key
+                    token = None
+                    if password is None:
+                        break
+                    success, sock, message = self.login(ip, port, username, password, last_seen_id)
+            elif password is None:
+                break
+            else:
+                success, sock, message = self.login(ip, port, username, password, last_seen_id)
+            if success:
+                return True, sock, message
+            if self.rejected and message != AUTH_BUSY:
+                break
+        return False, None, message
@@ -0,0 +1,4 @@
+"""Benchmarks for the ChatX server.
+
+Run from the project root, e.g. ``python -m benchmarks.bench_engines``.
+"""
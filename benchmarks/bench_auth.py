@@ -0,0 +1,121 @@
+"""Logins per second during a reconnect storm.
+
+Seeds N users with the legacy unsalted SHA-256 hash, then every user
+logs in at once, twice: the first storm verifies the legacy hashes and
+rehashes them with scrypt (the transparent migration), the second is
+the steady state with scrypt hashes only. A third storm reconnects with
+the SESSION tokens the second one handed out (AUTH|RESUME): no password
+check, and no history replay since nothing was missed. Clients use
+binary framing, the only one the server accepts tokens over. Repeated for
+each auth pool size. Requests beyond the auth pool's queue limit are
+refused as busy rather than left waiting.
+
+    python -m benchmarks.bench_auth --users 500 --auth-workers 1,4 --auth-queue 256
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import time
+
+from benchmarks.common import (
+    BenchClient, free_port, percentile, raise_fd_limit, remove_db, seed_users,
+    start_server_process, temp_db_path,
+)
+from db_manager import DBManager
+from passwords import legacy_hash
+from protocol import FEATURE_RESUME
+from server import AUTH_BUSY
+
+PASSWORD = "benchpass"
+
+
+async def login(port, username, secret, latencies, action, last_seen_id):
+    # Returns (ok, busy, SESSION token)
+    client = BenchClient(username, secret, binary=True)
+    start = time.perf_counter()
+    try:
+        ok = await client.login('127.0.0.1', port, action, (FEATURE_RESUME,), last_seen_id)
+    except (OSError, asyncio.TimeoutError):
+        ok = False
+    latencies.append(time.perf_counter() - start)
+    busy = not ok and AUTH_BUSY in (client.auth_reply or '')
+    token = None
+    if ok:
+        # The token is the first frame after AUTH_RESPONSE
+        with contextlib.suppress(asyncio.TimeoutError):
+            message = await asyncio.wait_for(client.read_message(), 30) or ''
+            if message.startswith("SESSION|"):
+                token = message.split('|')[1]
+    client.close()
+    return ok, busy, token
+
+
+async def storm(port, credentials, action="LOGIN", last_seen_id=None):
+    # credentials: {username: password or token}; returns the new tokens too
+    latencies = []
+    start = time.perf_counter()
+    results = await asyncio.gather(*(
+        login(port, name, secret, latencies, action, last_seen_id) for name, secret in credentials.items()
+    ))
+    elapsed = time.perf_counter() - start
+    succeeded = sum(ok for ok, busy, token in results)
+    busy = sum(busy for ok, busy, token in results)
+    tokens = {name: token for name, (ok, busy, token) in zip(credentials, results) if token}
+    return (succeeded, busy, elapsed, latencies), tokens
+
+
+def seed_messages(db_name, count):
+    rows = [("seed", "ALL", f"message {i}", "2024/01/01 00:00:00") for i in range(count)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = DBManager(db_name)
+        db.save_messages(rows)
+        db.close()
+
+
+def run(engine, workers, queue, n_users, n_messages):
+    db_name = temp_db_path()
+    usernames = [f"user{i}" for i in range(n_users)]
+    seed_users(db_name, usernames, PASSWORD, password_hash=legacy_hash(PASSWORD))
+    seed_messages(db_name, n_messages)
+    port = free_port()
+    proc = start_server_process(port, engine, db_name, auth_workers=workers, auth_queue=queue)
+    try:
+        rows = []
+        passwords = dict.fromkeys(usernames, PASSWORD)
+        for label in ("legacy->scrypt", "scrypt"):
+            result, tokens = asyncio.run(storm(port, passwords))
+            rows.append((label, *result))
+            time.sleep(1)  # let the server reap the closed sessions
+        # Resume with the newest message id seen, so nothing is replayed
+        result, _ = asyncio.run(storm(port, tokens, "RESUME", n_messages))
+        rows.append(("resume", *result))
+        return rows
+    finally:
+        proc.terminate()
+        proc.join()
+        remove_db(db_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--auth-workers', default="1,4", help="comma-separated auth pool sizes")
+    parser.add_argument('--auth-queue', type=int, default=256, help="auth requests admitted at once")
+    parser.add_argument('--engine', default='threaded', choices=('threaded', 'asyncio'))
+    parser.add_argument('--messages', type=int, default=200, help="public messages a full login replays")
+    args = parser.parse_args()
+    raise_fd_limit()
+
+    print(f"{args.users} simultaneous logins, auth queue {args.auth_queue}, "
+          f"{args.engine} engine, {os.cpu_count()} CPU(s)")
+    print(f"{'workers':>7} {'hashes':<15} {'ok':>5} {'busy':>5} {'logins/s':>9} {'p50 ms':>8} {'p99 ms':>8}")
+    for workers in (int(w) for w in args.auth_workers.split(',')):
+        for label, succeeded, busy, elapsed, latencies in run(args.engine, workers, args.auth_queue, args.users, args.messages):
+            print(f"{workers:>7} {label:<15} {succeeded:>5} {busy:>5} {succeeded / elapsed:>9.1f} "
+                  f"{percentile(latencies, 50) * 1000:>8.0f} {percentile(latencies, 99) * 1000:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+"""Cipher throughput: the shared Fernet key vs the AEAD session ciphers.
+
+For each payload size, encrypts and then decrypts a batch of frames with
+every cipher and reports MB/s and frames/s for the round trip, plus the
+wire size of one token relative to the plaintext.
+
+    python -m benchmarks.bench_cipher --sizes 64,1024,16384,1048576
+"""
+import argparse
+import os
+import time
+
+from encryption import DEFAULT_CIPHERS, MessageEncryption, SessionCipher
+
+
+def round_trip(cipher, payloads):
+    start = time.perf_counter()
+    tokens = [cipher.encrypt_bytes(payload) for payload in payloads]
+    for token in tokens:
+        if cipher.decrypt_bytes(token) is None:
+            raise AssertionError("round trip failed")
+    return time.perf_counter() - start, len(tokens[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default="64,1024,16384,1048576",
+                        help="comma-separated payload sizes in bytes")
+    parser.add_argument('--volume', type=int, default=32 << 20,
+                        help="plaintext bytes processed per size and cipher")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    ciphers = [("Fernet", MessageEncryption())]
+    ciphers += [(algorithm, SessionCipher.generate(algorithm)) for algorithm in DEFAULT_CIPHERS]
+
+    print(f"{'size':>8} {'cipher':<9} {'MB/s':>9} {'frames/s':>11} {'wire size':>10}")
+    for size in (int(s) for s in args.sizes.split(',')):
+        count = max(1, min(args.volume // size, 200000))
+        payloads = [os.urandom(size) for _ in range(count)]
+        for name, cipher in ciphers:
+            best = min(round_trip(cipher, payloads) for _ in range(args.repeat))
+            elapsed, token_size = best
+            print(f"{size:>8} {name:<9} {size * count / elapsed / 1e6:>9.1f} "
+                  f"{count / elapsed:>11.0f} {token_size / size:>9.2f}x")
+
+
+if __name__ == '__main__':
+    main()
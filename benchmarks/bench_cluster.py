@@ -0,0 +1,123 @@
+"""Private-message delivery across federated nodes behind a TCP broker.
+
+Starts a BrokerServer and N server nodes on loopback ports (all sharing
+one database), logs clients in round-robin over the nodes and has every
+client send M private messages to the next user, who therefore always
+sits on another node when N > 1. Reports throughput and send-to-receive
+latency, measured in this process, against a single node without a
+broker.
+
+    python -m benchmarks.bench_cluster --nodes 1,3 --clients 60 --messages 50
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+
+from benchmarks.common import (
+    BenchClient, free_port, percentile, raise_fd_limit, remove_db, seed_users,
+    start_server_process, temp_db_path,
+)
+
+PASSWORD = "benchpass"
+
+
+def _run_broker(port):
+    sys.stdout = open(os.devnull, 'w')
+    from broker import BrokerServer
+    BrokerServer('127.0.0.1', port).start()
+
+
+async def receive(client, latencies, counts):
+    # Private messages carry their send time in the content
+    while True:
+        frame = await client.read_frame()
+        if frame is None:
+            return
+        parts = (client.encryption.decrypt(frame.decode()) or '').split('|', 4)
+        if len(parts) == 5 and parts[0] == 'MSG' and parts[3] == client.username \
+                and parts[2] != client.username:
+            latencies.append(time.perf_counter() - float(parts[4]))
+            counts[client.username] += 1
+
+
+async def drive(ports, usernames, messages, timeout):
+    clients = []
+    for index, name in enumerate(usernames):
+        client = BenchClient(name, PASSWORD)
+        if not await client.login('127.0.0.1', ports[index % len(ports)]):
+            raise RuntimeError(f"Login failed for {name}")
+        clients.append(client)
+    # Let presence reach every node before the first private message
+    await asyncio.sleep(2)
+
+    latencies = []
+    counts = {name: 0 for name in usernames}
+    readers = [asyncio.create_task(receive(c, latencies, counts)) for c in clients]
+    start = time.perf_counter()
+    for k in range(messages):
+        for index, client in enumerate(clients):
+            receiver = usernames[(index + 1) % len(usernames)]
+            await client.send(f"MSG|2025/01/01 12:00:00|{client.username}|{receiver}|{time.perf_counter()}")
+
+    expected = messages * len(clients)
+    deadline = time.perf_counter() + timeout
+    while len(latencies) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+
+    for client in clients:
+        client.close()
+    for reader in readers:
+        reader.cancel()
+    return len(latencies), elapsed, latencies
+
+
+def run(nodes, engine, n_clients, messages, timeout):
+    db_name = temp_db_path()
+    usernames = [f"user{i}" for i in range(n_clients)]
+    seed_users(db_name, usernames, PASSWORD)
+
+    procs = []
+    broker = None
+    if nodes > 1:
+        broker_port = free_port()
+        procs.append(multiprocessing.Process(target=_run_broker, args=(broker_port,)))
+        procs[0].start()
+        broker = f"tcp://127.0.0.1:{broker_port}"
+    ports = [free_port() for _ in range(nodes)]
+    try:
+        for port in ports:
+            procs.append(start_server_process(port, engine, db_name, broker=broker))
+        return asyncio.run(drive(ports, usernames, messages, timeout))
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.join()
+        remove_db(db_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--nodes', default="1,3", help="comma-separated node counts")
+    parser.add_argument('--engine', default='threaded', choices=('threaded', 'asyncio'))
+    parser.add_argument('--clients', type=int, default=60)
+    parser.add_argument('--messages', type=int, default=50, help="private messages per client")
+    parser.add_argument('--timeout', type=float, default=60)
+    args = parser.parse_args()
+    raise_fd_limit()
+
+    total = args.clients * args.messages
+    print(f"{args.clients} clients x {args.messages} private messages ({total} total), "
+          f"{args.engine} engine, {os.cpu_count()} CPU(s)")
+    print(f"{'nodes':>6} {'msgs/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'delivered':>10}")
+    for nodes in (int(n) for n in args.nodes.split(',')):
+        received, elapsed, latencies = run(nodes, args.engine, args.clients, args.messages, args.timeout)
+        print(f"{nodes:>6} {received / elapsed:>9.0f} {percentile(latencies, 50) * 1000:>8.1f} "
+              f"{percentile(latencies, 99) * 1000:>8.1f} {received / total:>9.0%}")
+
+
+if __name__ == '__main__':
+    main()
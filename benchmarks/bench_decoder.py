@@ -0,0 +1,131 @@
+"""Receive-loop throughput: the original str split loop vs FrameDecoder.
+
+Each case pushes 1 MB of frames through an in-memory socket that hands
+out at most `burst` bytes per call, so the same input can arrive as one
+burst or trickle in as 4 KB segments. Frames are random base64 text the
+size of typical Fernet tokens; the last case is a single 1 MB frame
+(a large HISTORY_BATCH) split across many reads. Every loop must
+return the same payloads.
+
+    python -m benchmarks.bench_decoder --repeat 5
+"""
+import argparse
+import base64
+import os
+import random
+import time
+
+from protocol import LEGACY_VERSION, PROTOCOL_VERSION, FrameDecoder, encode_wire
+
+
+class BurstSocket:
+    """Serves a fixed byte string at most `burst` bytes per recv call"""
+
+    def __init__(self, data, burst):
+        self.data = memoryview(data)
+        self.burst = burst
+        self.pos = 0
+
+    def recv(self, size):
+        size = min(size, self.burst, len(self.data) - self.pos)
+        chunk = self.data[self.pos:self.pos + size].tobytes()
+        self.pos += size
+        return chunk
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), self.burst, len(self.data) - self.pos)
+        buffer[:size] = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+
+def str_loop(sock, read_size):
+    # The receive loop used by handle_client and ChatClient before FrameDecoder
+    frames = []
+    buffer = ""
+    while True:
+        data_chunk = sock.recv(read_size).decode()
+        if not data_chunk:
+            break
+        buffer += data_chunk
+        while '\n' in buffer:
+            encrypted_data, buffer = buffer.split('\n', 1)
+            if not encrypted_data:
+                continue
+            frames.append(encrypted_data.encode())
+    return frames
+
+
+def decoder_loop(sock, version):
+    frames = []
+    decoder = FrameDecoder(version)
+    while True:
+        for frame_type, flags, payload in decoder.drain():
+            frames.append(payload)
+        if not decoder.recv_into(sock):
+            break
+    return frames
+
+
+def make_tokens(total, low, high):
+    tokens = []
+    size = 0
+    while size < total:
+        token = base64.urlsafe_b64encode(os.urandom(random.randint(low, high)))
+        tokens.append(token)
+        size += len(token)
+    return tokens
+
+
+def run(label, tokens, burst, repeat):
+    legacy = b''.join(encode_wire(token, LEGACY_VERSION) for token in tokens)
+    binary = b''.join(encode_wire(token, PROTOCOL_VERSION) for token in tokens)
+    loops = [
+        ("str recv(4096)", legacy, lambda sock: str_loop(sock, 4096)),
+        ("str recv(64K)", legacy, lambda sock: str_loop(sock, 65536)),
+        ("decoder v1", legacy, lambda sock: decoder_loop(sock, LEGACY_VERSION)),
+        ("decoder v2", binary, lambda sock: decoder_loop(sock, PROTOCOL_VERSION)),
+    ]
+
+    results = []
+    for name, data, loop in loops:
+        best = None
+        for _ in range(repeat):
+            sock = BurstSocket(data, burst)
+            start = time.perf_counter()
+            frames = loop(sock)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        if frames != tokens:
+            raise AssertionError(f"{name} decoded {len(frames)} frames, expected {len(tokens)}")
+        results.append((name, best))
+
+    mb = sum(len(token) for token in tokens) / 1e6
+    print(f"{label:<34}" + "".join(f"{mb / elapsed:>16.0f}" for name, elapsed in results))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1 << 20, help="bytes of frames per case")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    random.seed(1)
+
+    small = make_tokens(args.size, 60, 200)
+    big = [base64.urlsafe_b64encode(os.urandom(args.size * 3 // 4))]
+    cases = [
+        (f"{len(small)} frames, one burst", small, args.size * 2),
+        (f"{len(small)} frames, 64 KB bursts", small, 65536),
+        (f"{len(small)} frames, 4 KB bursts", small, 4096),
+        ("1 frame of 1 MB, 4 KB bursts", big, 4096),
+    ]
+
+    print(f"MB/s, best of {args.repeat}")
+    print(f"{'case':<34}" + "".join(f"{name:>16}" for name in
+                                    ("str recv(4096)", "str recv(64K)", "decoder v1", "decoder v2")))
+    for label, tokens, burst in cases:
+        run(label, tokens, burst, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""LAN server discovery: one-at-a-time TCP probes vs the concurrent scan vs the UDP beacon.
+
+Scans a /24 for one listener and times how long each method takes to
+find it. On loopback (the default) every address refuses at once, so
+the sequential scan looks cheap; point --network at a real LAN /24, where
+each silent host costs a full connect timeout one after another, to see
+the difference the concurrent scan (about one timeout in total) makes.
+The listener and beacon run in this process.
+
+    python -m benchmarks.bench_discovery --network 127.0.0.0/24 --host 127.0.0.250
+"""
+import argparse
+import socket
+import time
+
+from benchmarks.common import free_port
+from discovery import DiscoveryBeacon, beacon_query, network_hosts, scan_hosts
+
+
+def sequential_scan(hosts, port, timeout):
+    # The old approach: one blocking connect per host
+    for host in hosts:
+        try:
+            with socket.create_connection((host, port), timeout):
+                return host
+        except OSError:
+            continue
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--network', default='127.0.0.0/24')
+    parser.add_argument('--host', default='127.0.0.250', help="address the listener binds to")
+    parser.add_argument('--timeout', type=float, default=0.5)
+    args = parser.parse_args()
+
+    port = free_port()
+    listener = socket.socket()
+    listener.bind((args.host, port))
+    listener.listen(256)
+    beacon_port = free_port()
+    beacon = DiscoveryBeacon(port, beacon_port)
+    hosts = network_hosts([args.network])
+
+    print(f"{len(hosts)} hosts in {args.network}, server at {args.host}:{port}")
+    print(f"{'method':<12} {'found':>16} {'seconds':>9}")
+    try:
+        for name, find in (
+            ("sequential", lambda: sequential_scan(hosts, port, args.timeout)),
+            ("concurrent", lambda: scan_hosts(hosts, port, args.timeout)),
+            ("beacon", lambda: next(iter(beacon_query(beacon_port, args.timeout, settle=0)), (None,))[0]),
+        ):
+            start = time.perf_counter()
+            found = find()
+            elapsed = time.perf_counter() - start
+            print(f"{name:<12} {str(found):>16} {elapsed:>9.3f}")
+    finally:
+        beacon.close()
+        listener.close()
+
+
+if __name__ == '__main__':
+    main()
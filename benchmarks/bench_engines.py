@@ -0,0 +1,114 @@
+"""Compare the threaded and asyncio server engines under load.
+
+For each engine the benchmark logs in N clients, reports the server's
+memory and thread count while they sit idle, then measures how quickly a
+burst of group messages is fanned out to every connection.
+
+    python -m benchmarks.bench_engines --clients 1000 --messages 20
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime
+
+from benchmarks.common import (
+    BenchClient, free_port, process_stats, raise_fd_limit, remove_db,
+    seed_users, start_server_process, temp_db_path,
+)
+
+PASSWORD = "benchpass"
+
+
+async def wait_until_quiet(clients, quiet=1.0, limit=120):
+    """Wait until no client has received anything for `quiet` seconds"""
+    deadline = time.perf_counter() + limit
+    while time.perf_counter() < deadline:
+        last = max((c.last_frame for c in clients), default=0)
+        if time.perf_counter() - last >= quiet:
+            return
+        await asyncio.sleep(0.2)
+
+
+async def run_engine(engine, n_clients, n_messages, batch):
+    port = free_port()
+    db_name = temp_db_path()
+    usernames = [f"user{i}" for i in range(n_clients)]
+    seed_users(db_name, usernames, PASSWORD)
+    proc = start_server_process(port, engine, db_name)
+
+    clients = [BenchClient(name, PASSWORD) for name in usernames]
+    readers = []
+    try:
+        # Log everybody in, `batch` connections at a time
+        start = time.perf_counter()
+        for i in range(0, n_clients, batch):
+            group = clients[i:i + batch]
+            results = await asyncio.gather(*(c.login('127.0.0.1', port) for c in group))
+            if not all(results):
+                raise RuntimeError("Login failed")
+            readers.extend(asyncio.create_task(c.count_frames()) for c in group)
+        login_time = time.perf_counter() - start
+
+        await wait_until_quiet(clients)
+        rss_mb, threads = process_stats(proc.pid)
+
+        # Fan out a burst of group messages from one sender
+        for c in clients:
+            c.frames = 0
+        sender = clients[0]
+        start = time.perf_counter()
+        for i in range(n_messages):
+            timestamp = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+            await sender.send(f"MSG|{timestamp}|{sender.username}|ALL|bench message {i}")
+
+        expected = n_messages * n_clients
+        deadline = time.perf_counter() + 120
+        while sum(c.frames for c in clients) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        fanout_time = time.perf_counter() - start
+        delivered = sum(c.frames for c in clients)
+
+        return {
+            'engine': engine,
+            'clients': n_clients,
+            'login_s': login_time,
+            'idle_rss_mb': rss_mb,
+            'idle_threads': threads,
+            'delivered': delivered,
+            'expected': expected,
+            'fanout_s': fanout_time,
+            'deliveries_per_s': delivered / fanout_time if fanout_time else 0.0,
+        }
+    finally:
+        for c in clients:
+            c.close()
+        for task in readers:
+            task.cancel()
+        proc.terminate()
+        proc.join()
+        remove_db(db_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--messages', type=int, default=20)
+    parser.add_argument('--batch', type=int, default=100, help="concurrent logins")
+    parser.add_argument('--engines', default='threaded,asyncio')
+    args = parser.parse_args()
+
+    limit = raise_fd_limit()
+    if limit < args.clients * 2 + 100:
+        print(f"Warning: open file limit is {limit}, which may be too low")
+
+    print(f"{'engine':<10} {'clients':>8} {'login s':>9} {'RSS MB':>8} {'threads':>8} "
+          f"{'delivered':>12} {'fanout s':>9} {'msgs/s':>10}")
+    for engine in args.engines.split(','):
+        r = asyncio.run(run_engine(engine, args.clients, args.messages, args.batch))
+        print(f"{r['engine']:<10} {r['clients']:>8} {r['login_s']:>9.2f} {r['idle_rss_mb']:>8.1f} "
+              f"{r['idle_threads']:>8} {r['delivered']:>5}/{r['expected']:<6} "
+              f"{r['fanout_s']:>9.2f} {r['deliveries_per_s']:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""Count encrypt calls and time per broadcast, before and after encrypt-once frames.
+
+Runs in-process against fake connections, so only the server's routing
+and crypto cost is measured. The "before" column replays the original
+per-send encryption pattern:
+
+* group MSG: one encrypt, then a fresh `encoded + b'\\n'` copy per recipient
+* private MSG: one encrypt for the receiver and another for the sender's copy
+* USER_LIST: built and encrypted twice, the first result thrown away
+
+    python -m benchmarks.bench_fanout --clients 1000
+"""
+import argparse
+import contextlib
+import io
+import time
+
+from benchmarks.common import remove_db, temp_db_path
+from connection import ClientConnection
+from server import ChatServer
+
+
+class FakeConnection(ClientConnection):
+    """A legacy-client connection that just counts queued bytes"""
+
+    def __init__(self, username, cipher):
+        super().__init__(username, None)
+        self.cipher = cipher
+        self.frames = 0
+        self.bytes = 0
+
+    def send(self, data, droppable=False):
+        self.frames += 1
+        self.bytes += len(data)
+        return True
+
+    @property
+    def queue_depth(self):
+        return 0
+
+    def _enqueue(self, data):
+        pass
+
+    def start(self):
+        pass
+
+    def write_direct(self, data):
+        self.send(data)
+
+    def close(self):
+        self.closed = True
+
+
+class CountingEncryption:
+    """Wraps MessageEncryption and counts encrypt() calls"""
+
+    def __init__(self, encryption):
+        self.inner = encryption
+        self.calls = 0
+
+    def encrypt(self, message):
+        self.calls += 1
+        return self.inner.encrypt(message)
+
+    def encrypt_bytes(self, data):
+        self.calls += 1
+        return self.inner.encrypt_bytes(data)
+
+    def decrypt(self, message):
+        return self.inner.decrypt(message)
+
+
+# Replays of the original ChatServer send paths
+
+def legacy_broadcast_message(server, message):
+    encrypted_message = server.encryption.encrypt(message)
+    with server.clients_lock:
+        for username, client_socket in server.clients.items():
+            client_socket.send(encrypted_message.encode() + b'\n')
+
+
+def legacy_private_message(server, message, sender, receiver):
+    with server.clients_lock:
+        encrypted_message = server.encryption.encrypt(message)
+        server.clients[receiver].send(encrypted_message.encode() + b'\n')
+    encrypted_msg = server.encryption.encrypt(message)
+    server.clients[sender].send(encrypted_msg.encode() + b'\n')
+
+
+def legacy_broadcast_user_list(server):
+    with server.clients_lock:
+        message = f"USER_LIST|{','.join(server.clients.keys())}"
+        server.encryption.encrypt(message)
+    with server.clients_lock:
+        message = f"USER_LIST|{','.join(server.clients.keys())}"
+        encrypted_message = server.encryption.encrypt(message)
+        for client_socket in server.clients.values():
+            client_socket.send(encrypted_message.encode() + b'\n')
+
+
+def current_private_message(server, message, sender, receiver):
+    server.route_message("MSG", *message.split('|', 4)[1:], server.clients[sender], 1)
+
+
+def measure(server, func, repeat):
+    server.encryption.calls = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    elapsed = time.perf_counter() - start
+    return server.encryption.calls / repeat, elapsed / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+
+    db_name = temp_db_path()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            server = ChatServer(db_name=db_name)
+        server.encryption = CountingEncryption(server.encryption)
+        for i in range(args.clients):
+            server.clients[f"user{i}"] = FakeConnection(f"user{i}", server.encryption)
+
+        group = "MSG|2025/01/01 12:00:00|user0|ALL|" + "hello everyone " * 8
+        private = "MSG|2025/01/01 12:00:00|user0|user1|" + "hello there " * 8
+        cases = [
+            ("group MSG",
+             lambda: legacy_broadcast_message(server, group),
+             lambda: server.broadcast_message(group)),
+            ("private MSG",
+             lambda: legacy_private_message(server, private, "user0", "user1"),
+             lambda: current_private_message(server, private, "user0", "user1")),
+            ("USER_LIST",
+             lambda: legacy_broadcast_user_list(server),
+             lambda: server.broadcast_user_list()),
+        ]
+
+        print(f"{args.clients} connected clients, {args.repeat} repetitions")
+        print(f"{'operation':<12} {'encrypts before':>16} {'encrypts after':>15} "
+              f"{'us before':>10} {'us after':>10}")
+        for name, before, after in cases:
+            calls_before, us_before = measure(server, before, args.repeat)
+            calls_after, us_after = measure(server, after, args.repeat)
+            print(f"{name:<12} {calls_before:>16.1f} {calls_after:>15.1f} "
+                  f"{us_before:>10.0f} {us_after:>10.0f}")
+    finally:
+        remove_db(db_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""Heartbeat cost and idle reaping across many connections.
+
+N clients advertising HEARTBEAT connect (with SESSION tokens minted from
+the database secret, so logins skip the password KDF) and sit idle.
+All answer every PING with PONG until the join traffic has settled;
+then a few of them go silent, like a laptop that dropped off the
+network. Reports the server's threads, RSS and CPU time while pinging
+everyone, PINGs per answering client, how many answering clients were
+wrongly dropped, and how long after going silent the others were
+disconnected (expected: the timeout, give or take one interval, since
+the last PONG came up to an interval before the silence).
+
+    python -m benchmarks.bench_heartbeat --connections 2000 --interval 2 --timeout 6
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import time
+
+from benchmarks.common import (
+    BenchClient, free_port, percentile, process_stats, raise_fd_limit, remove_db, seed_users,
+    start_server_process, temp_db_path,
+)
+from db_manager import DBManager
+from protocol import FEATURE_HEARTBEAT, FEATURE_PRESENCE_DELTAS
+from sessions import SessionTokens
+
+
+def cpu_seconds(pid):
+    # User plus system CPU time of a process, from /proc
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return 0.0
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+class Clock:
+    """Phases shared by every simulated client"""
+    def __init__(self):
+        self.silence = float('inf')   # silent clients stop answering
+        self.deadline = float('inf')  # measurement ends
+        self.frames = 0               # frames read other than PINGs
+
+
+async def run_client(client, silent, clock, results, ping_size):
+    # Read everything and answer PINGs until the deadline; silent clients
+    # stop answering once the silence starts. Only frames as long as a
+    # PING token are decrypted: decrypting every join announcement would
+    # make this process, not the server, the bottleneck
+    pings = 0
+    try:
+        while True:
+            timeout = max(0.01, clock.deadline - time.perf_counter())
+            frame = await asyncio.wait_for(client.read_frame(), min(timeout, 3600))
+            now = time.perf_counter()
+            if frame is None:
+                results.append((silent, pings, now - clock.silence if now >= clock.silence else 0.0))
+                return
+            if len(frame) != ping_size or not (client.encryption.decrypt(frame.decode()) or '').startswith("PING|"):
+                clock.frames += 1
+                continue
+            if now >= clock.silence and not silent:
+                pings += 1
+            if not (silent and now >= clock.silence):
+                await client.send(f"PONG|{time.strftime('%Y/%m/%d %H:%M:%S')}|{client.username}|SERVER|")
+    except asyncio.TimeoutError:
+        if time.perf_counter() < clock.deadline:
+            raise
+        results.append((silent, pings, None))
+    except ConnectionError:
+        results.append((silent, pings, time.perf_counter() - clock.silence))
+    finally:
+        client.close()
+
+
+async def nudge(clients, clock, interval):
+    # PONG unprompted until the silence starts: a client stuck behind its
+    # backlog of join announcements would otherwise be reaped before the
+    # measurement begins
+    while time.perf_counter() < clock.silence:
+        for client in list(clients):
+            with contextlib.suppress(ConnectionError):
+                await client.send(f"PONG|{time.strftime('%Y/%m/%d %H:%M:%S')}|{client.username}|SERVER|")
+        await asyncio.sleep(interval / 2)
+
+
+async def run(args, port, pid, tokens):
+    random.seed(1)
+    silent = set(random.sample(range(args.connections), min(args.silent, args.connections)))
+    gate = asyncio.Semaphore(args.concurrency)
+    clock = Clock()
+    results = []
+    clients = []
+    # Fernet token length depends only on the plaintext length
+    ping_size = len(BenchClient('', '').encryption.encrypt(f"PING|{args.interval:g}|{args.timeout:g}"))
+
+    async def connect(i):
+        username = f"user{i}"
+        async with gate:
+            client = BenchClient(username, tokens.issue(username)[0])
+            features = (FEATURE_HEARTBEAT, FEATURE_PRESENCE_DELTAS)
+            if not await client.login('127.0.0.1', port, "RESUME", features, 0):
+                raise RuntimeError(f"Login failed: {client.auth_reply}")
+        clients.append(client)
+        # Read from the start, or join announcements fill the send queue
+        return asyncio.ensure_future(run_client(client, i in silent, clock, results, ping_size))
+
+    nudger = asyncio.ensure_future(nudge(clients, clock, args.interval))
+    tasks = await asyncio.gather(*(connect(i) for i in range(args.connections)))
+    # Wait until the join announcements have all been read (none for a
+    # whole interval), so what follows is the idle steady state
+    frames = -1
+    while frames != clock.frames:
+        frames = clock.frames
+        await asyncio.sleep(args.interval)
+
+    clock.silence = time.perf_counter()
+    await nudger
+    duration = args.timeout + args.interval * 3
+    clock.deadline = clock.silence + duration
+    cpu_start = cpu_seconds(pid)
+    await asyncio.sleep(duration / 2)
+    rss, threads = process_stats(pid)
+    await asyncio.gather(*tasks)
+    cpu = cpu_seconds(pid) - cpu_start
+    return results, duration, cpu, rss, threads
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--connections', type=int, default=2000)
+    parser.add_argument('--interval', type=float, default=2.0, help="heartbeat_interval, seconds")
+    parser.add_argument('--timeout', type=float, default=6.0, help="heartbeat_timeout, seconds")
+    # Each one reaped is a leave announcement to everyone, which this one
+    # process has to read for all of its clients
+    parser.add_argument('--silent', type=int, default=20, help="clients that stop answering")
+    parser.add_argument('--concurrency', type=int, default=200, help="logins in flight at once")
+    parser.add_argument('--engine', default='asyncio', choices=('threaded', 'asyncio'))
+    args = parser.parse_args()
+    raise_fd_limit()
+
+    db_name = temp_db_path()
+    seed_users(db_name, [f"user{i}" for i in range(args.connections)], "benchpass")
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = DBManager(db_name)
+        tokens = SessionTokens(db.get_secret('session'))
+        db.close()
+    port = free_port()
+    # Every login queues a join announcement and a presence delta to every
+    # client; size the send queues so the login storm drops nobody
+    proc = start_server_process(port, args.engine, db_name, heartbeat_interval=args.interval,
+                                heartbeat_timeout=args.timeout, max_handshakes=None, max_connections=None,
+                                send_queue_size=args.connections * 4)
+    try:
+        results, duration, cpu, rss, threads = asyncio.run(run(args, port, proc.pid, tokens))
+    finally:
+        proc.terminate()
+        proc.join()
+        remove_db(db_name)
+
+    answering = [r for r in results if not r[0]]
+    silent = [r for r in results if r[0]]
+    reaped = [r[2] for r in silent if r[2] is not None]
+    print(f"{args.connections} idle connections, {args.engine} engine, "
+          f"PING every {args.interval:g}s, timeout {args.timeout:g}s, {len(silent)} silent")
+    print(f"  server threads              {threads:>8}")
+    print(f"  server RSS                  {rss:>8.1f} MB")
+    print(f"  server CPU                  {cpu / duration * 100:>8.1f} % of a core")
+    print(f"  PINGs per answering client  {sum(r[1] for r in answering) / max(1, len(answering)):>8.1f}")
+    print(f"  answering clients dropped   {sum(r[2] is not None for r in answering):>8}")
+    print(f"  silent clients reaped       {len(reaped):>8} of {len(silent)}")
+    print(f"  reap delay p50              {percentile(reaped, 50):>8.2f} s")
+    print(f"  reap delay p99              {percentile(reaped, 99):>8.2f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""Login time with 1k/10k/100k stored messages: per-row MSG replay vs HISTORY_BATCH.
+
+Each run stores N public messages, logs one client in and times how long
+it takes to receive and decrypt the whole replay (up to the HISTORY_END
+cursor for the public chat). `--page-size` defaults to the largest size
+so the full history is replayed; pass e.g. 50 to see the paged default.
+
+    python -m benchmarks.bench_history --sizes 1000,10000,100000
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import time
+
+from benchmarks.common import (
+    BenchClient, free_port, remove_db, seed_users, start_server_process, temp_db_path,
+)
+from db_manager import DBManager
+from protocol import CLIENT_FEATURES, HISTORY_BATCH_PREFIX, unpack_history_batch
+
+PASSWORD = "benchpass"
+
+
+def seed_messages(db_name, count):
+    rows = [("sender", "ALL", f"stored message number {i} with some ordinary chat text", "2025/01/01 12:00:00")
+            for i in range(count)]
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = DBManager(db_name)
+        for i in range(0, count, 10000):
+            db.save_messages(rows[i:i + 10000])
+        db.close()
+
+
+async def timed_login(port, features):
+    client = BenchClient("reader", PASSWORD)
+    start = time.perf_counter()
+    if not await client.login('127.0.0.1', port, features=features):
+        raise RuntimeError("Login failed")
+
+    messages = frames = wire_bytes = 0
+    try:
+        while True:
+            frame = await client.read_frame()
+            if frame is None:
+                raise RuntimeError("Server closed the connection")
+            frames += 1
+            wire_bytes += len(frame) + 1
+            data = client.encryption.decrypt_bytes(frame)
+            if data.startswith(HISTORY_BATCH_PREFIX):
+                messages += len(unpack_history_batch(data)[1])
+            elif data.startswith(b"MSG|"):
+                messages += 1
+            elif data.startswith(b"HISTORY_END|ALL|"):
+                break
+    finally:
+        client.close()
+    return time.perf_counter() - start, messages, frames, wire_bytes
+
+
+async def run(size, page_size):
+    port = free_port()
+    db_name = temp_db_path()
+    seed_users(db_name, ["sender", "reader"], PASSWORD)
+    seed_messages(db_name, size)
+    proc = start_server_process(port, 'threaded', db_name, history_page_size=page_size)
+    try:
+        results = []
+        for label, features in (("per-row MSG", ()), ("HISTORY_BATCH", CLIENT_FEATURES)):
+            elapsed, messages, frames, wire_bytes = await timed_login(port, features)
+            results.append((label, elapsed, messages, frames, wire_bytes))
+            await asyncio.sleep(0.2)
+        return results
+    finally:
+        proc.terminate()
+        proc.join()
+        remove_db(db_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--page-size', type=int, default=None)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    page_size = args.page_size or max(sizes)
+
+    print(f"history_page_size={page_size}")
+    print(f"{'stored':>8} {'mode':<14} {'login s':>9} {'messages':>9} {'frames':>8} {'wire MB':>8}")
+    for size in sizes:
+        for label, elapsed, messages, frames, wire_bytes in asyncio.run(run(size, page_size)):
+            print(f"{size:>8} {label:<14} {elapsed:>9.3f} {messages:>9} {frames:>8} "
+                  f"{wire_bytes / 1e6:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
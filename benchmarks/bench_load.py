@@ -0,0 +1,318 @@
+"""Load generator: many simulated users chatting against a local server.
+
+Users register and log in through AuthService (the client's own
+handshake, key exchange included), in a bounded thread pool, and their
+sockets are then driven from one event loop with the client's MSG and
+TYPING framing. For --duration seconds users send messages at --rate per
+second in total (a --private share of them to a random other user, the
+rest to ALL), each preceded by a TYPING ON with probability --typing.
+Every message carries its send time, so receivers measure end-to-end
+delivery latency.
+
+Reports login time, throughput, p50/p99 delivery latency and the server's
+RSS, and writes everything to a JSON results file; --baseline compares
+against an earlier file so runs from two commits can be diffed.
+
+    python -m benchmarks.bench_load --users 1000 --rate 500 --duration 30 --output load.json
+    python -m benchmarks.bench_load --users 1000 --rate 500 --baseline load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from auth_service import AuthService, KnownServers
+from benchmarks.common import (
+    free_port, percentile, process_stats, raise_fd_limit, remove_db, start_server_process,
+    temp_db_path,
+)
+from protocol import FLAG_GROUP_KEY, encode_wire
+
+PASSWORD = "benchpass"
+MARKER = "load"  # content prefix of generated messages
+
+
+class LoadUser:
+    """One simulated user on an AuthService session"""
+
+    def __init__(self, username, auth, sock):
+        self.username = username
+        self.auth = auth
+        self.sock = sock
+        self.reader = None
+        self.writer = None
+
+    async def attach(self):
+        # Hand the authenticated blocking socket to the event loop
+        self.sock.setblocking(False)
+        self.reader, self.writer = await asyncio.open_connection(sock=self.sock, limit=2 ** 22)
+
+    def send(self, message):
+        token = self.auth.cipher.encrypt_bytes(message.encode())
+        self.writer.write(encode_wire(token, self.auth.protocol_version))
+
+    async def receive(self, stats):
+        # Decode frames until EOF; generated MSGs report their latency
+        decoder = self.auth.decoder
+        try:
+            while True:
+                for frame_type, flags, payload in decoder.drain():
+                    cipher = self.auth.group_cipher if flags & FLAG_GROUP_KEY else self.auth.cipher
+                    data = cipher.decrypt_bytes(payload)
+                    if not data or not data.startswith(b"MSG|"):
+                        continue
+                    parts = data.decode(errors='replace').split('|', 4)
+                    if len(parts) < 5 or parts[2] == self.username:
+                        continue  # our own message echoed back
+                    fields = parts[4].split(' ')
+                    if len(fields) == 2 and fields[0] == MARKER:
+                        stats['latencies'].append(time.perf_counter() - float(fields[1]))
+                data = await self.reader.read(65536)
+                if not data:
+                    stats['disconnected'] += 1
+                    return
+                stats['last_frame'] = time.perf_counter()
+                decoder.feed(data)
+        except ConnectionError:
+            stats['disconnected'] += 1
+        except asyncio.CancelledError:
+            pass
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+        else:
+            self.sock.close()
+
+
+def open_session(action, host, port, username):
+    # Runs in the thread pool: the blocking AuthService handshake, timed
+    auth = AuthService(KnownServers())
+    start = time.perf_counter()
+    flow = auth.register if action == "REGISTER" else auth.login
+    success, sock, message = flow(host, port, username, PASSWORD)
+    elapsed = time.perf_counter() - start
+    if not success:
+        raise RuntimeError(f"{action} failed for {username}: {message}")
+    return LoadUser(username, auth, sock), elapsed
+
+
+async def open_sessions(action, host, port, usernames, concurrency):
+    loop = asyncio.get_running_loop()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = await asyncio.gather(*(
+            loop.run_in_executor(pool, open_session, action, host, port, name) for name in usernames
+        ))
+    return [user for user, elapsed in results], [elapsed for user, elapsed in results]
+
+
+async def drive_user(user, peers, interval, private_share, typing_share, until, stats, seed):
+    # Send until `until` as a Poisson process, one message every `interval`
+    # seconds on average; stops early if the server dropped the connection
+    rng = random.Random(f"{seed}-{user.username}")
+    await asyncio.sleep(max(0.0, min(rng.expovariate(1 / interval), until - time.perf_counter())))
+    while time.perf_counter() < until and not user.writer.is_closing():
+        if rng.random() < private_share and len(peers) > 1:
+            receiver = user.username
+            while receiver == user.username:
+                receiver = rng.choice(peers)
+        else:
+            receiver = "ALL"
+        timestamp = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        if rng.random() < typing_share:
+            user.send(f"TYPING|{timestamp}|{user.username}|{receiver}|ON")
+            stats['typing'] += 1
+        user.send(f"MSG|{timestamp}|{user.username}|{receiver}|{MARKER} {time.perf_counter()}")
+        stats['sent'] += 1
+        stats['expected'] += stats['online'] - 1 if receiver == "ALL" else 1
+        try:
+            await user.writer.drain()
+        except ConnectionError:
+            return
+        await asyncio.sleep(max(0.0, min(rng.expovariate(1 / interval), until - time.perf_counter())))
+
+
+async def sample_rss(pid, samples, stop):
+    while not stop.is_set():
+        samples.append(process_stats(pid)[0])
+        try:
+            await asyncio.wait_for(stop.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_load(args, host, port, pid):
+    usernames = [f"load{i}" for i in range(args.users)]
+    stats = {'latencies': [], 'sent': 0, 'typing': 0, 'expected': 0, 'online': args.users,
+             'last_frame': 0.0, 'disconnected': 0}
+    rss_samples = []
+    stop_sampling = asyncio.Event()
+    sampler = asyncio.create_task(sample_rss(pid, rss_samples, stop_sampling)) if pid else None
+
+    # Registration logs users in too; those sessions are closed again so the
+    # timed logins below measure LOGIN on its own
+    users, _ = await open_sessions("REGISTER", host, port, usernames, args.concurrency)
+    for user in users:
+        user.close()
+    start = time.perf_counter()
+    users, login_times = await open_sessions("LOGIN", host, port, usernames, args.concurrency)
+    login_total = time.perf_counter() - start
+    for user in users:
+        await user.attach()
+    readers = [asyncio.create_task(user.receive(stats)) for user in users]
+    idle_rss = process_stats(pid)[0] if pid else 0.0
+
+    # Let login history and presence updates drain before measuring
+    deadline = time.perf_counter() + 120
+    while time.perf_counter() - stats['last_frame'] < 1.0 and time.perf_counter() < deadline:
+        await asyncio.sleep(0.2)
+    stats['latencies'].clear()
+    interval = args.users / args.rate
+    start = time.perf_counter()
+    until = start + args.duration
+    await asyncio.gather(*(
+        drive_user(user, usernames, interval, args.private, args.typing, until, stats, args.seed)
+        for user in users
+    ))
+    send_elapsed = time.perf_counter() - start
+
+    # Wait for in-flight deliveries
+    deadline = time.perf_counter() + args.drain
+    while len(stats['latencies']) < stats['expected'] and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    if sampler:
+        stop_sampling.set()
+        await sampler
+    disconnected = stats['disconnected']
+    for user in users:
+        user.close()
+    for reader in readers:
+        reader.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+
+    latencies = stats['latencies']
+    return {
+        'login': {
+            'total_s': login_total,
+            'p50_ms': percentile(login_times, 50) * 1000,
+            'p99_ms': percentile(login_times, 99) * 1000,
+            'logins_per_s': len(login_times) / login_total if login_total else 0.0,
+        },
+        'messages': {
+            'sent': stats['sent'],
+            'typing_sent': stats['typing'],
+            'sent_per_s': stats['sent'] / send_elapsed if send_elapsed else 0.0,
+            'expected_deliveries': stats['expected'],
+            'delivered': len(latencies),
+            'delivered_ratio': len(latencies) / stats['expected'] if stats['expected'] else 1.0,
+            'deliveries_per_s': len(latencies) / elapsed if elapsed else 0.0,
+            'disconnected_users': disconnected,
+        },
+        'latency': {
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': max(latencies, default=0.0) * 1000,
+        },
+        'server': {
+            'idle_rss_mb': idle_rss,
+            'peak_rss_mb': max(rss_samples, default=0.0),
+        },
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), timeout=10,
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_report(results, baseline=None):
+    def show(section, key, label, unit):
+        value = results[section][key]
+        line = f"  {label:<22} {value:>12.1f} {unit}"
+        if baseline and baseline.get(section, {}).get(key):
+            old = baseline[section][key]
+            line += f"   ({(value - old) / old:+.1%} vs {baseline.get('commit') or 'baseline'})"
+        print(line)
+
+    show('login', 'total_s', "login, all users", "s")
+    show('login', 'p50_ms', "login p50", "ms")
+    show('login', 'p99_ms', "login p99", "ms")
+    show('messages', 'sent_per_s', "messages sent", "/s")
+    show('messages', 'deliveries_per_s', "deliveries", "/s")
+    show('messages', 'delivered_ratio', "delivered", "(ratio)")
+    show('messages', 'disconnected_users', "users disconnected", "")
+    show('latency', 'p50_ms', "delivery p50", "ms")
+    show('latency', 'p99_ms', "delivery p99", "ms")
+    show('server', 'idle_rss_mb', "server RSS, idle", "MB")
+    show('server', 'peak_rss_mb', "server RSS, peak", "MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--rate', type=float, default=200, help="messages per second, all users together")
+    parser.add_argument('--private', type=float, default=0.8, help="share of messages sent privately")
+    parser.add_argument('--typing', type=float, default=0.5, help="chance a message is preceded by TYPING ON")
+    parser.add_argument('--duration', type=float, default=20, help="seconds of sending")
+    parser.add_argument('--drain', type=float, default=30, help="seconds to wait for late deliveries")
+    parser.add_argument('--concurrency', type=int, default=64, help="logins in flight at once")
+    parser.add_argument('--engine', default='threaded', choices=('threaded', 'asyncio'))
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1, help="seeds every user's send schedule")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--baseline', help="results file of an earlier run to compare against")
+    args = parser.parse_args()
+    raise_fd_limit()
+
+    port = free_port()
+    db_name = temp_db_path()
+    proc = start_server_process(port, args.engine, db_name, args.workers)
+    try:
+        metrics = asyncio.run(run_load(args, '127.0.0.1', port, proc.pid))
+    finally:
+        proc.terminate()
+        proc.join()
+        remove_db(db_name)
+
+    results = {
+        'benchmark': 'bench_load',
+        'commit': git_commit(),
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'cpus': os.cpu_count(),
+        'params': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline')},
+        **metrics,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    print(f"{args.users} users, {args.rate:g} msgs/s for {args.duration:g}s "
+          f"({args.private:.0%} private, typing {args.typing:.0%}), {args.engine} engine, "
+          f"{args.workers} worker(s), {os.cpu_count()} CPU(s)")
+    print_report(results, baseline)
+    if results['messages']['sent_per_s'] < 0.9 * args.rate:
+        print(f"  Note: only {results['messages']['sent_per_s']:.0f} of {args.rate:g} msgs/s were sent; "
+              f"the load generator itself is saturated (it shares {os.cpu_count()} CPU(s) with the server)")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""Presence churn: full USER_LIST rebroadcasts vs PRESENCE_JOIN/LEAVE deltas.
+
+Runs in-process against fake connections. With N users online, random
+users disconnect and reconnect; every leave and every join is one churn
+event. Reports bytes queued to clients per event (what every client has
+to receive, decrypt and parse) and server time per event, for clients
+without the PRESENCE_DELTAS feature (full lists) and with it (deltas,
+plus one snapshot for the reconnecting user).
+
+    python -m benchmarks.bench_presence --users 5000 --events 200
+"""
+import argparse
+import contextlib
+import io
+import random
+import time
+
+from benchmarks.common import remove_db, temp_db_path
+from connection import ClientConnection
+from protocol import FEATURE_PRESENCE_DELTAS
+from server import ChatServer
+
+
+class FakeConnection(ClientConnection):
+    """A connection that just counts queued frames and bytes"""
+
+    def __init__(self, username, cipher, features, totals):
+        super().__init__(username, None)
+        self.cipher = cipher
+        self.features = features
+        self.totals = totals
+
+    def send(self, data, droppable=False):
+        self.totals[0] += 1
+        self.totals[1] += len(data)
+        return True
+
+    @property
+    def queue_depth(self):
+        return 0
+
+    def _enqueue(self, data):
+        pass
+
+    def start(self):
+        pass
+
+    def write_direct(self, data):
+        self.send(data)
+
+    def close(self):
+        self.closed = True
+
+
+def run(n_users, events, features):
+    db_name = temp_db_path()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            server = ChatServer(db_name=db_name)
+        totals = [0, 0]  # frames, bytes
+        usernames = [f"user{i}" for i in range(n_users)]
+
+        def connect(username):
+            server.register_client(FakeConnection(username, server.encryption, features, totals))
+            server.broadcast_presence(username)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            for username in usernames:
+                connect(username)
+            totals[:] = [0, 0]
+
+            random.seed(1)
+            start = time.perf_counter()
+            for _ in range(events // 2):
+                username = random.choice(usernames)
+                server.unregister_client(server.clients[username])
+                server.broadcast_presence(username)
+                connect(username)
+            elapsed = time.perf_counter() - start
+    finally:
+        remove_db(db_name)
+
+    churn = events // 2 * 2
+    return totals[0] / churn, totals[1] / churn, elapsed / churn
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--events', type=int, default=200, help="leave + join events")
+    args = parser.parse_args()
+
+    print(f"{args.users} users online, {args.events} churn events")
+    print(f"{'mode':<12} {'frames/event':>13} {'KB/event':>11} {'ms/event':>9}")
+    for name, features in (("USER_LIST", set()), ("deltas", {FEATURE_PRESENCE_DELTAS})):
+        frames, size, elapsed = run(args.users, args.events, features)
+        print(f"{name:<12} {frames:>13.0f} {size / 1024:>11.1f} {elapsed * 1000:>9.2f}")
+
+
+if __name__ == '__main__':
+    main()
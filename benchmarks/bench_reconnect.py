@@ -0,0 +1,163 @@
+"""Reconnect storm after a server restart: password logins vs token resumes.
+
+N users are logged in, the server is killed and started again on the
+same database, and every client reconnects at once. "login" reconnects
+the old way: straight away, by password, replaying the latest page of
+every conversation. "resume" uses AuthService.reconnect: jittered
+exponential backoff, a SESSION token, and only messages newer than the
+newest one the client holds. Reports the time until everyone is back,
+the busiest 100 ms of connection attempts, and the history bytes sent.
+
+    python -m benchmarks.bench_reconnect --users 200 --messages 500
+"""
+import argparse
+import contextlib
+import io
+import os
+import signal
+import socket
+import threading
+import time
+
+from auth_service import AuthService, KnownServers
+from benchmarks.common import (
+    free_port, raise_fd_limit, remove_db, seed_users, start_server_process, temp_db_path,
+)
+from db_manager import DBManager
+from protocol import FLAG_GROUP_KEY
+
+PASSWORD = "benchpass"
+
+
+def drain(service, sock, idle=0.5):
+    """Read until the server goes quiet; returns (HISTORY bytes read, SESSION token)"""
+    received, token = 0, None
+    sock.settimeout(idle)
+    decoder = service.decoder
+    while True:
+        for frame_type, flags, payload in decoder:
+            if flags & FLAG_GROUP_KEY:
+                continue  # Broadcasts: joins and presence
+            message = service.cipher.decrypt_bytes(payload) or b''
+            if message.startswith(b"HISTORY"):
+                received += len(payload)
+            elif message.startswith(b"SESSION|"):
+                token = message.split(b'|')[1].decode()
+        try:
+            if not decoder.recv_into(sock):
+                break
+        except socket.timeout:
+            break
+    return received, token
+
+
+class User:
+    def __init__(self, name):
+        self.name = name
+        self.sock = None
+        self.token = None
+        self.history = 0
+
+    def login(self, port):
+        service = AuthService(KnownServers())
+        ok, self.sock, message = service.login('127.0.0.1', port, self.name, PASSWORD)
+        if not ok:
+            raise RuntimeError(message)
+        self.history, self.token = drain(service, self.sock)
+
+    def reconnect(self, port, mode, attempts):
+        # Returns the history bytes replayed once back in
+        service = AuthService(KnownServers())
+        if mode == 'resume':
+            original = service.connect_server
+
+            def counted(ip, port):
+                attempts.append(time.perf_counter())
+                return original(ip, port)
+            service.connect_server = counted
+            ok, self.sock, message = service.reconnect(
+                '127.0.0.1', port, self.name, PASSWORD, self.token, self.last_seen
+            )
+        else:
+            while True:
+                attempts.append(time.perf_counter())
+                ok, self.sock, message = service.login('127.0.0.1', port, self.name, PASSWORD)
+                if ok:
+                    break
+                time.sleep(0.1)
+        self.history, self.token = drain(service, self.sock)
+        return self.history
+
+
+def peak_rate(times, window=0.1):
+    times = sorted(times)
+    peak, first = 0, 0
+    for last, t in enumerate(times):
+        while t - times[first] > window:
+            first += 1
+        peak = max(peak, last - first + 1)
+    return peak
+
+
+def run(mode, n_users, n_messages, engine):
+    db_name = temp_db_path()
+    users = [User(f"user{i}") for i in range(n_users)]
+    seed_users(db_name, [user.name for user in users], PASSWORD)
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = DBManager(db_name)
+        # Random text, so compressed history batches are not unrealistically small
+        db.save_messages([("seed", "ALL", f"message {i} {os.urandom(24).hex()}", "2024/01/01 00:00:00")
+                          for i in range(n_messages)])
+        db.close()
+    port = free_port()
+    proc = start_server_process(port, engine, db_name)
+    try:
+        threads = [threading.Thread(target=user.login, args=(port,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for user in users:
+            user.last_seen = n_messages  # what the login replay ended with
+
+        os.kill(proc.pid, signal.SIGKILL)
+        proc.join()
+        for user in users:
+            user.sock.close()
+        proc = start_server_process(port, engine, db_name)
+
+        attempts, history = [], []
+        start = time.perf_counter()
+        threads = [threading.Thread(target=lambda u=user: history.append(u.reconnect(port, mode, attempts)))
+                   for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        for user in users:
+            user.sock.close()
+        return elapsed, len(attempts), peak_rate(attempts), sum(history)
+    finally:
+        proc.terminate()
+        proc.join()
+        remove_db(db_name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=500, help="public messages in the database")
+    parser.add_argument('--engine', default='threaded', choices=('threaded', 'asyncio'))
+    args = parser.parse_args()
+    raise_fd_limit()
+
+    print(f"{args.users} clients reconnecting after a restart, {args.messages} messages, {args.engine} engine")
+    print(f"{'mode':<8} {'seconds':>8} {'attempts':>9} {'peak/100ms':>11} {'history KB':>11}")
+    for mode in ('login', 'resume'):
+        elapsed, attempts, peak, history = run(mode, args.users, args.messages, args.engine)
+        print(f"{mode:<8} {elapsed:>8.2f} {attempts:>9} {peak:>11} {history / 1024:>11.0f}")
+
+
+if __name__ == '__main__':
+    main()
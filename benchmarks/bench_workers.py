@@ -0,0 +1,129 @@
+"""Private-message throughput as the number of server worker processes grows.
+
+For each worker count, logs in N clients spread over a few client
+processes, then every client sends M private messages in one burst, to
+the next M users in a ring. Every user therefore receives exactly M
+messages plus M sender confirmations. Throughput is messages delivered
+per second, from the first send until every client has all its frames.
+Most pairs of users sit on different workers, so the numbers include
+relaying over the bus hub. Scaling needs free cores: on a single-core
+machine extra workers only add relaying overhead.
+
+    python -m benchmarks.bench_workers --workers 1,2,4 --clients 200 --messages 50
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+
+from benchmarks.common import (
+    BenchClient, free_port, raise_fd_limit, remove_db, seed_users,
+    start_server_process, temp_db_path,
+)
+
+PASSWORD = "benchpass"
+
+
+async def drive_clients(port, names, all_names, messages, barrier, timeout):
+    clients = [BenchClient(name, PASSWORD) for name in names]
+    for client in clients:
+        if not await client.login('127.0.0.1', port):
+            raise RuntimeError(f"Login failed for {client.username}")
+    readers = [asyncio.create_task(c.count_frames()) for c in clients]
+    loop = asyncio.get_running_loop()
+
+    # Everybody is logged in once the barrier opens; let the joins settle
+    await loop.run_in_executor(None, barrier.wait)
+    await asyncio.sleep(2)
+    baseline = [c.frames for c in clients]
+    await loop.run_in_executor(None, barrier.wait)
+
+    start = time.time()
+    ring = len(all_names)
+    for client in clients:
+        index = all_names.index(client.username)
+        for k in range(1, messages + 1):
+            receiver = all_names[(index + k) % ring]
+            await client.send(f"MSG|2025/01/01 12:00:00|{client.username}|{receiver}|benchmark message {k}")
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if all(c.frames - b >= 2 * messages for c, b in zip(clients, baseline)):
+            break
+        await asyncio.sleep(0.01)
+    # last_frame is a perf_counter stamp; convert it to wall time so client
+    # processes can be compared
+    end = time.time() - (time.perf_counter() - max(c.last_frame for c in clients))
+    # Clients of a process that finished first may already be leaving;
+    # their leave notices are not part of the workload
+    received = sum(min(c.frames - b, 2 * messages) for c, b in zip(clients, baseline))
+
+    for client in clients:
+        client.close()
+    for reader in readers:
+        reader.cancel()
+    return start, end, received
+
+
+def client_process(port, names, all_names, messages, barrier, results, timeout):
+    raise_fd_limit()
+    start, end, received = asyncio.run(
+        drive_clients(port, names, all_names, messages, barrier, timeout)
+    )
+    results.put((start, end, received))
+
+
+def run(workers, engine, n_clients, messages, client_procs, timeout):
+    port = free_port()
+    db_name = temp_db_path()
+    usernames = [f"user{i}" for i in range(n_clients)]
+    seed_users(db_name, usernames, PASSWORD)
+    proc = start_server_process(port, engine, db_name, workers=workers)
+
+    barrier = multiprocessing.Barrier(client_procs)
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(target=client_process, args=(
+            port, usernames[i::client_procs], usernames, messages, barrier, results, timeout
+        ))
+        for i in range(client_procs)
+    ]
+    try:
+        for p in procs:
+            p.start()
+        outcomes = [results.get(timeout=timeout + 120) for _ in procs]
+    finally:
+        for p in procs:
+            p.join(timeout=5)
+        proc.terminate()
+        proc.join()
+        remove_db(db_name)
+
+    elapsed = max(end for start, end, received in outcomes) - min(start for start, end, received in outcomes)
+    return sum(received for start, end, received in outcomes), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', default="1,2,4", help="comma-separated worker counts")
+    parser.add_argument('--engine', default='threaded', choices=('threaded', 'asyncio'))
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--messages', type=int, default=50, help="private messages per client")
+    parser.add_argument('--client-procs', type=int, default=min(4, os.cpu_count() or 1))
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    total = args.clients * args.messages
+    print(f"{args.clients} clients x {args.messages} private messages ({total} total), "
+          f"{args.engine} engine, {os.cpu_count()} CPU(s)")
+    print(f"{'workers':>8} {'seconds':>9} {'msgs/s':>10} {'delivered':>10}")
+    for workers in (int(w) for w in args.workers.split(',')):
+        received, elapsed = run(workers, args.engine, args.clients, args.messages,
+                                args.client_procs, args.timeout)
+        print(f"{workers:>8} {elapsed:>9.2f} {received / 2 / elapsed:>10.0f} "
+              f"{received / 2 / total:>9.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+"""Helpers shared by the benchmark scripts."""
+import asyncio
+import base64
+import contextlib
+import io
+import multiprocessing
+import os
+import resource
+import socket
+import tempfile
+import time
+
+from db_manager import SQL_INSERT_USER, DBManager
+from encryption import DEFAULT_CIPHERS, FERNET_TOKEN_PREFIX, KeyExchange, MessageEncryption, SessionCipher
+from passwords import hash_password
+from protocol import (
+    FLAG_GROUP_KEY, FRAME_HANDSHAKE, FRAME_HEADER, HANDSHAKE_HELLO, PROTOCOL_VERSION, encode_wire,
+    format_key_exchange,
+)
+
+
+def raise_fd_limit():
+    """Raise the open-file soft limit as far as the hard limit allows"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def temp_db_path():
+    fd, path = tempfile.mkstemp(prefix='chatx_bench_', suffix='.db')
+    os.close(fd)
+    os.unlink(path)
+    return path
+
+
+def remove_db(path):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path + suffix)
+
+
+def seed_users(db_name, usernames, password, password_hash=None):
+    """Register benchmark users directly in the database.
+
+    All users share one password hash (by default a single scrypt hash of
+    `password`), so seeding thousands of users skips thousands of KDF runs.
+    """
+    password_hash = password_hash or hash_password(password)
+    created_at = time.strftime("%Y-%m-%d %H:%M:%S")
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = DBManager(db_name)
+        with db.pool.connection() as conn:
+            conn.executemany(SQL_INSERT_USER, ((name, password_hash, created_at) for name in usernames))
+        db.close()
+
+
+# Benchmark clients all connect from one address and send faster than
+# people type, so rate limits are off unless a benchmark sets them
+NO_RATE_LIMITS = dict(message_limit=None, typing_limit=None, ip_message_limit=None, ip_typing_limit=None)
+
+
+def _run_server(port, engine, db_name, workers, broker, kwargs):
+    raise_fd_limit()
+    kwargs = {**NO_RATE_LIMITS, **kwargs}
+    import sys
+    sys.stdout = open(os.devnull, 'w')
+    if workers > 1:
+        from workers import WorkerPool
+        WorkerPool('127.0.0.1', port, workers, engine, db_name=db_name, **kwargs).start()
+        return
+    from server import create_server
+    server = create_server('127.0.0.1', port, engine, db_name=db_name, **kwargs)
+    if broker:
+        from bus import create_bus
+        server.attach_bus(create_bus(broker, f"node-{port}"))
+    server.start()
+
+
+def start_server_process(port, engine='threaded', db_name=None, workers=1, broker=None, **kwargs):
+    """Start a ChatServer (or a WorkerPool) in a child process and wait until it accepts.
+    With a broker URL the server joins that cluster as node-<port>."""
+    proc = multiprocessing.Process(
+        target=_run_server, args=(port, engine, db_name, workers, broker, kwargs)
+    )
+    proc.start()
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        with contextlib.suppress(OSError):
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return proc
+        time.sleep(0.05)
+    proc.terminate()
+    raise RuntimeError("Server did not start")
+
+
+def process_stats(pid):
+    """Return (rss_mb, threads) for a process from /proc"""
+    rss_kb, threads = 0, 0
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss_kb = int(line.split()[1])
+                elif line.startswith('Threads:'):
+                    threads = int(line.split()[1])
+    except OSError:
+        pass
+    return rss_kb / 1024, threads
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class BenchClient:
+    """Minimal asyncio chat client speaking the newline-delimited protocol.
+
+    With binary=True it logs in over binary framing instead (HELLO, then
+    AUTH under the session key, without checking the server's identity)
+    and read_message() reads binary frames; send() and count_frames()
+    stay newline-only.
+    """
+
+    def __init__(self, username, password, encryption=None, binary=False):
+        self.username = username
+        self.password = password
+        self.encryption = encryption or MessageEncryption()
+        self.binary = binary
+        self.cipher = None
+        self.group_cipher = None
+        self.reader = None
+        self.writer = None
+        self.frames = 0
+        self.last_frame = 0.0
+        self.buffer = b''
+        self.auth_reply = None
+
+    async def login(self, host, port, action="LOGIN", features=(), last_seen_id=None):
+        """Authenticate; for action="RESUME" the password is a SESSION token"""
+        self.reader, self.writer = await asyncio.open_connection(host, port, limit=2 ** 26)
+        request = f"AUTH|{action}|{self.username}|{self.password}|{','.join(features)}"
+        if last_seen_id is not None:
+            request += f"||{last_seen_id}"
+        if self.binary:
+            return await self.binary_login(request)
+        auth = self.encryption.encrypt(request)
+        self.writer.write(auth.encode())
+        await self.writer.drain()
+        response = await asyncio.wait_for(self.reader.read(4096), 30)
+        # The auth response is not newline-terminated and may arrive glued
+        # to the first pushed frame; Fernet tokens always start with gAAAAA.
+        token = response.split(b'\n', 1)[0]
+        boundary = token.find(FERNET_TOKEN_PREFIX, 1)
+        if boundary > 0:
+            token = token[:boundary]
+        self.buffer = response[len(token):]
+        self.last_frame = time.perf_counter()
+        self.auth_reply = reply = self.encryption.decrypt(token.decode()) or ''
+        return reply.startswith("AUTH_RESPONSE|SUCCESS")
+
+    async def binary_login(self, request):
+        # HELLO round trip, then the AUTH request under the session key
+        exchange = KeyExchange()
+        hello = f"{HANDSHAKE_HELLO}|{format_key_exchange(exchange.public_key, DEFAULT_CIPHERS)}"
+        self.writer.write(encode_wire(hello.encode(), PROTOCOL_VERSION, FRAME_HANDSHAKE))
+        frame = await asyncio.wait_for(self.read_wire_frame(), 30)
+        if frame is None:
+            return False
+        frame_type, flags, payload = frame
+        fields = payload.decode(errors='replace').split('|')
+        if frame_type != FRAME_HANDSHAKE or fields[0] != HANDSHAKE_HELLO:
+            # ERROR|MESSAGE, e.g. busy
+            self.auth_reply = '|'.join(fields)
+            return False
+        self.cipher = exchange.session_cipher(fields[2], fields[1], is_client=True)
+        self.writer.write(encode_wire(self.cipher.encrypt_bytes(request.encode()), PROTOCOL_VERSION))
+        frame = await asyncio.wait_for(self.read_wire_frame(), 30)
+        if frame is None:
+            return False
+        self.last_frame = time.perf_counter()
+        self.auth_reply = reply = (self.cipher.decrypt_bytes(frame[2]) or b'').decode()
+        if not reply.startswith("AUTH_RESPONSE|SUCCESS"):
+            return False
+        self.group_cipher = SessionCipher(base64.b64decode(reply.split('|')[3]), self.cipher.algorithm)
+        return True
+
+    async def read_wire_frame(self):
+        """Return the next binary (frame_type, flags, payload), or None at EOF"""
+        try:
+            header = await self.reader.readexactly(FRAME_HEADER.size)
+            magic, frame_type, flags, length = FRAME_HEADER.unpack(header)
+            return frame_type, flags, await self.reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            return None
+
+    async def read_frame(self):
+        """Return the next encrypted frame (without its newline), or None at EOF"""
+        if b'\n' in self.buffer:
+            frame, self.buffer = self.buffer.split(b'\n', 1)
+            return frame
+        try:
+            frame = self.buffer + (await self.reader.readuntil(b'\n'))[:-1]
+        except asyncio.IncompleteReadError:
+            return None
+        self.buffer = b''
+        return frame
+
+    async def read_message(self):
+        """Return the next frame decrypted, or None at EOF"""
+        if self.binary:
+            frame = await self.read_wire_frame()
+            if frame is None:
+                return None
+            frame_type, flags, payload = frame
+            cipher = self.group_cipher if flags & FLAG_GROUP_KEY else self.cipher
+            return (cipher.decrypt_bytes(payload) or b'').decode()
+        frame = await self.read_frame()
+        if frame is None:
+            return None
+        return self.encryption.decrypt(frame.decode()) or ''
+
+    async def send(self, message):
+        self.writer.write(self.encryption.encrypt(message).encode() + b'\n')
+        await self.writer.drain()
+
+    async def count_frames(self):
+        """Count newline-terminated frames until the connection closes"""
+        self.frames += self.buffer.count(b'\n')
+        self.buffer = b''
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                self.frames += data.count(b'\n')
+                self.last_frame = time.perf_counter()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
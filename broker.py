@@ -0,0 +1,323 @@
+import hashlib
+import hmac
+import ipaddress
+import json
+import os
+import queue
+import socket
+import threading
+import time
+
+from bus import EVENT_PRESENCE, Bus, BusHub
+from encryption import derive_cipher
+from protocol import PROTOCOL_VERSION, FrameDecoder, ProtocolError, encode_wire
+
+# Handshake on every broker connection, in plaintext frames: the broker
+# challenges with a 'nonce', the node answers hello with its 'node' name,
+# its own 'nonce' and a 'proof' that it knows the cluster secret, and the
+# broker's welcome carries its own 'proof'. Everything after is encrypted
+# with a key derived from the secret and both nonces (see link_cipher)
+EVENT_CHALLENGE = 'challenge'
+EVENT_HELLO = 'hello'
+EVENT_WELCOME = 'welcome'
+NONCE_SIZE = 16
+
+def is_loopback(host):
+    # True for addresses only this machine can reach
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return host == 'localhost'
+
+def handshake_proof(secret, role, broker_nonce, node_nonce, node):
+    """HMAC-SHA256 by which `role` ('node' or 'broker') proves it knows the secret"""
+    message = b"|".join((role.encode(), broker_nonce, node_nonce, node.encode()))
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+def link_cipher(secret, broker_nonce, node_nonce, node):
+    # Key for the rest of one broker connection, fresh for every connection
+    return derive_cipher(secret.encode(), broker_nonce + node_nonce, b"chatx bus " + node.encode())
+
+def encode_event(event, cipher=None):
+    # Bus events travel as JSON in binary (v2) frames, encrypted after the handshake
+    data = json.dumps(event).encode()
+    if cipher is not None:
+        data = cipher.encrypt_bytes(data)
+    return encode_wire(data, PROTOCOL_VERSION)
+
+def read_event(sock, decoder, cipher=None):
+    """The next event from a broker connection, or None once it closes"""
+    while True:
+        for frame_type, flags, payload in decoder:
+            if cipher is not None:
+                payload = cipher.decrypt_bytes(payload)
+                if payload is None:
+                    raise ProtocolError("Bus event failed authentication")
+            return json.loads(payload)
+        if not decoder.recv_into(sock):
+            return None
+
+def read_events(sock, decoder, cipher=None):
+    """Yield events from a broker connection until it closes"""
+    while True:
+        event = read_event(sock, decoder, cipher)
+        if event is None:
+            return
+        yield event
+
+class BrokerMember:
+    """One node connected to the broker, with its own outbound queue so a
+    slow node never stalls relaying to the others"""
+    def __init__(self, sock, node, cipher):
+        self.sock = sock
+        self.node = node
+        self.cipher = cipher
+        self.queue = queue.SimpleQueue()
+        self.writer_thread = threading.Thread(target=self.writer_loop, name=f"broker-{node}", daemon=True)
+        self.writer_thread.start()
+
+    def send(self, event):
+        self.queue.put(encode_event(event, self.cipher))
+
+    def writer_loop(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                break
+
+    def close(self):
+        self.queue.put(None)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+class BrokerServer:
+    """TCP front end of a BusHub for server nodes on different hosts.
+
+    Nodes connect with TcpBus (URL tcp://[secret@]host:port) and prove
+    they know the shared secret in a challenge-response handshake; events
+    are encrypted after it. Without a secret the broker only listens on a
+    loopback address. The broker only routes and tracks presence; it holds
+    no chat state and needs no database.
+    """
+    def __init__(self, host='127.0.0.1', port=6000, secret=''):
+        if not secret and not is_loopback(host):
+            raise ValueError(f"A broker listening on {host or 'all interfaces'} needs a cluster secret")
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.hub = BusHub()
+        self.server_socket = None
+        self.running = False
+
+    def start(self):
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server_socket.bind((self.host, self.port))
+        self.server_socket.listen()
+        self.port = self.server_socket.getsockname()[1]
+        self.running = True
+        print(f"[BUS] Cluster broker listening on {self.host}:{self.port}")
+
+        while self.running:
+            try:
+                sock, address = self.server_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.handle_node, args=(sock, address), daemon=True).start()
+
+    def start_background(self):
+        thread = threading.Thread(target=self.start, name="chatx-broker", daemon=True)
+        thread.start()
+        return thread
+
+    def handle_node(self, sock, address):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        decoder = FrameDecoder(PROTOCOL_VERSION)
+        member = None
+        try:
+            sock.settimeout(10)
+            broker_nonce = os.urandom(NONCE_SIZE)
+            sock.sendall(encode_event({'type': EVENT_CHALLENGE, 'nonce': broker_nonce.hex()}))
+            hello = read_event(sock, decoder)
+            if not hello or hello.get('type') != EVENT_HELLO or not isinstance(hello.get('node'), str) or not hello['node']:
+                print(f"[BUS] Rejected broker connection from {address}")
+                return
+            node = hello['node']
+            node_nonce = bytes.fromhex(hello['nonce'])
+            proof = handshake_proof(self.secret, 'node', broker_nonce, node_nonce, node)
+            if len(node_nonce) != NONCE_SIZE or not hmac.compare_digest(str(hello.get('proof', '')), proof):
+                print(f"[BUS] Rejected broker connection from {address}")
+                return
+            sock.sendall(encode_event({
+                'type': EVENT_WELCOME, 'proof': handshake_proof(self.secret, 'broker', broker_nonce, node_nonce, node)
+            }))
+            sock.settimeout(None)
+
+            cipher = link_cipher(self.secret, broker_nonce, node_nonce, node)
+            member = BrokerMember(sock, node, cipher)
+            print(f"[BUS] Node {member.node} joined from {address}")
+            self.hub.add_member(member.node, member.send)
+            for event in read_events(sock, decoder, cipher):
+                # Nodes may only speak for themselves
+                event['node'] = member.node
+                self.hub.dispatch(event)
+        except (OSError, ProtocolError, ValueError, KeyError, TypeError) as e:
+            print(f"[BUS] Broker connection from {address} failed: {e}")
+        finally:
+            if member is not None:
+                self.hub.remove_member(member.node, member.send)
+                member.close()
+                print(f"[BUS] Node {member.node} left")
+            else:
+                sock.close()
+
+    def stop(self):
+        self.running = False
+        if self.server_socket:
+            self.server_socket.close()
+
+class TcpBus(Bus):
+    """Bus to a BrokerServer over TCP.
+
+    Reconnects with backoff when the broker goes away. While disconnected
+    the node only knows its own users and events it publishes are dropped;
+    the presence snapshot sent on reconnect brings it back in sync.
+    """
+    def __init__(self, node, host, port, secret='', reconnect_delay=0.5, max_reconnect_delay=10.0):
+        super().__init__(node)
+        self.host = host
+        self.port = port
+        self.secret = secret
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.sock = None
+        self.cipher = None
+        self.send_lock = threading.Lock()
+        self.reader_thread = None
+        self.closed = False
+
+    def start(self, handler):
+        super().start(handler)
+        self.reader_thread = threading.Thread(target=self.reader_loop, name="chatx-bus", daemon=True)
+        self.reader_thread.start()
+
+    def connect(self):
+        """Connect and run the handshake (see EVENT_CHALLENGE); returns
+        (sock, decoder, cipher) for reading events"""
+        sock = socket.create_connection((self.host, self.port), timeout=5)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            decoder = FrameDecoder(PROTOCOL_VERSION)
+            challenge = read_event(sock, decoder)
+            if not challenge or challenge.get('type') != EVENT_CHALLENGE:
+                raise ConnectionError("no challenge from the broker")
+            broker_nonce = bytes.fromhex(challenge['nonce'])
+            node_nonce = os.urandom(NONCE_SIZE)
+            sock.sendall(encode_event({
+                'type': EVENT_HELLO, 'node': self.node, 'nonce': node_nonce.hex(),
+                'proof': handshake_proof(self.secret, 'node', broker_nonce, node_nonce, self.node),
+            }))
+            welcome = read_event(sock, decoder)
+            proof = handshake_proof(self.secret, 'broker', broker_nonce, node_nonce, self.node)
+            if (not welcome or welcome.get('type') != EVENT_WELCOME
+                    or not hmac.compare_digest(str(welcome.get('proof', '')), proof)):
+                raise ConnectionError("broker refused the handshake (wrong cluster secret?)")
+            sock.settimeout(None)
+        except (OSError, ProtocolError, ValueError, KeyError, TypeError):
+            sock.close()
+            raise
+        cipher = link_cipher(self.secret, broker_nonce, node_nonce, self.node)
+        with self.send_lock:
+            self.sock, self.cipher = sock, cipher
+        return sock, decoder, cipher
+
+    def reader_loop(self):
+        delay = self.reconnect_delay
+        while not self.closed:
+            try:
+                sock, decoder, cipher = self.connect()
+            except (OSError, ProtocolError, ValueError, KeyError, TypeError) as e:
+                print(f"[BUS] Cannot reach broker {self.host}:{self.port}: {e}")
+                time.sleep(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+            print(f"[BUS] Connected to broker {self.host}:{self.port} as {self.node}")
+            delay = self.reconnect_delay
+
+            try:
+                for event in read_events(sock, decoder, cipher):
+                    try:
+                        self.handler(event)
+                    except Exception as e:
+                        print(f"[BUS] Error handling {event.get('type')} event: {e}")
+            except (OSError, ProtocolError, ValueError):
+                pass
+
+            with self.send_lock:
+                self.sock = None
+            sock.close()
+            if not self.closed:
+                print("[BUS] Lost broker connection; reconnecting")
+                # Partitioned: forget every remote user until the next snapshot
+                self.handler({'type': EVENT_PRESENCE, 'node': None, 'users': {}})
+
+    def _send(self, event):
+        with self.send_lock:
+            if self.sock is None:
+                return
+            try:
+                self.sock.sendall(encode_event(event, self.cipher))
+            except OSError as e:
+                print(f"[BUS] Publish failed: {e}")
+
+    def close(self):
+        self.closed = True
+        with self.send_lock:
+            if self.sock is not None:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+if __name__ == "__main__":
+    print("="*50)
+    print("ChatX Cluster Broker")
+    print("="*50)
+
+    try:
+        host = input("Enter address to listen on (press Enter for 127.0.0.1): ").strip() or '127.0.0.1'
+    except (EOFError, OSError):
+        host = '127.0.0.1'
+        print("Using default address: 127.0.0.1")
+
+    try:
+        port_str = input("Enter broker port (press Enter for 6000): ").strip()
+        port = int(port_str) if port_str else 6000
+    except (EOFError, OSError, ValueError):
+        port = 6000
+        print("Using default port: 6000")
+
+    try:
+        secret = input("Enter shared cluster secret (required unless listening on loopback): ").strip()
+    except (EOFError, OSError):
+        secret = ''
+
+    print("="*50)
+
+    try:
+        broker = BrokerServer(host, port, secret)
+    except ValueError as e:
+        print(f"[BUS] {e}")
+        raise SystemExit(1)
+    try:
+        broker.start()
+    except KeyboardInterrupt:
+        print("\n[BUS] Keyboard interrupt received...")
+        broker.stop()
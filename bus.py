@@ -0,0 +1,261 @@
+import abc
+import queue
+import threading
+from multiprocessing.connection import wait
+
+# Events exchanged between servers sharing one chat. Every event is a dict
+# with 'type' and 'node' (the publishing server) plus:
+EVENT_DELIVER = 'deliver'    # 'to' (username, or None for ALL) and 'message'
+EVENT_JOIN = 'join'          # 'user' is now connected to 'node'
+EVENT_LEAVE = 'leave'        # 'user' left 'node'
+EVENT_KICK = 'kick'          # close 'user''s session wherever it is
+EVENT_PRESENCE = 'presence'  # hub snapshot for a new member: 'users' {username: node}
+EVENT_STOP = 'stop'          # ask a worker to shut down
+
+class BusHub:
+    """Relays events between servers and keeps the global presence map.
+
+    Members register with a `send(event)` callable, so the hub works over
+    any transport. Private deliveries and kicks go only to the server the
+    user is connected to; everything else goes to every other member.
+    Events are relayed under one lock so members see joins and leaves in
+    the order the hub accepted them.
+    """
+    def __init__(self):
+        self.members = {}   # node: send(event)
+        self.presence = {}  # username: node
+        self.lock = threading.Lock()
+
+    def add_member(self, node, send):
+        with self.lock:
+            self.members[node] = send
+            send({'type': EVENT_PRESENCE, 'node': None, 'users': dict(self.presence)})
+
+    def remove_member(self, node, send=None):
+        # Users of a vanished member leave everywhere else; with `send`, only
+        # if the member was not already replaced by a reconnect. Compare with
+        # ==: each q.put access builds a new bound method, equal but not identical
+        with self.lock:
+            if send is not None and self.members.get(node) != send:
+                return
+            self.members.pop(node, None)
+            gone = [user for user, owner in self.presence.items() if owner == node]
+            for user in gone:
+                del self.presence[user]
+                self.relay({'type': EVENT_LEAVE, 'node': node, 'user': user}, node)
+
+    def dispatch(self, event):
+        """Route one event published by event['node']"""
+        origin = event['node']
+        event_type = event['type']
+        with self.lock:
+            if event_type == EVENT_JOIN:
+                self.presence[event['user']] = origin
+            elif event_type == EVENT_LEAVE:
+                if self.presence.get(event['user']) == origin:
+                    del self.presence[event['user']]
+            elif event_type == EVENT_KICK or (event_type == EVENT_DELIVER and event.get('to')):
+                user = event['user'] if event_type == EVENT_KICK else event['to']
+                owner = self.presence.get(user)
+                if owner is not None and owner != origin:
+                    self.send_to(owner, event)
+                return
+            self.relay(event, origin)
+
+    def relay(self, event, origin):
+        for node in list(self.members):
+            if node != origin:
+                self.send_to(node, event)
+
+    def send_to(self, node, event):
+        try:
+            self.members[node](event)
+        except Exception as e:
+            print(f"[BUS] Dropping event for {node}: {e}")
+
+    def serve_pipes(self, connections, running):
+        """Relay events between worker pipes while running() is true.
+
+        `connections` maps node to the hub end of a multiprocessing Pipe.
+        Each pipe is written by its own PipeMember thread, so a worker that
+        stops reading never blocks this loop; they are all stopped again
+        before returning.
+        """
+        members = {conn: PipeMember(conn, node) for node, conn in connections.items()}
+        for member in members.values():
+            self.add_member(member.node, member.send)
+
+        try:
+            while members and running():
+                for conn in wait(list(members), timeout=1.0):
+                    try:
+                        event = conn.recv()
+                    except (EOFError, OSError):
+                        member = members.pop(conn)
+                        self.remove_member(member.node, member.send)
+                        member.close()
+                        continue
+                    self.dispatch(event)
+        finally:
+            for member in members.values():
+                member.close()
+
+class PipeMember:
+    """The hub end of one worker's Pipe, with its own outbound queue so a
+    worker that falls behind never stalls relaying to the others"""
+    def __init__(self, conn, node):
+        self.conn = conn
+        self.node = node
+        self.queue = queue.SimpleQueue()
+        self.writer_thread = threading.Thread(target=self.writer_loop, name=f"hub-{node}", daemon=True)
+        self.writer_thread.start()
+
+    def send(self, event):
+        self.queue.put(event)
+
+    def writer_loop(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+            try:
+                self.conn.send(event)
+            except (OSError, ValueError):
+                break
+
+    def close(self, timeout=5.0):
+        # Stop the writer once it has sent what is queued; the pipe stays open
+        self.queue.put(None)
+        self.writer_thread.join(timeout)
+
+class Bus(abc.ABC):
+    """A server's link to the hub; subclasses provide the transport.
+
+    `publish` stamps events with this server's node name; incoming events
+    are handed to the handler given to `start`.
+    """
+    def __init__(self, node):
+        self.node = node
+        self.handler = None
+
+    def start(self, handler):
+        self.handler = handler
+
+    def publish(self, event):
+        event['node'] = self.node
+        self._send(event)
+
+    @abc.abstractmethod
+    def _send(self, event):
+        """Hand one stamped event to the transport"""
+
+    def close(self):
+        pass
+
+class PipeBus(Bus):
+    """Bus over a multiprocessing Pipe to a hub in the parent process.
+
+    A worker cannot run correctly without its hub, so losing the pipe is
+    handled like an EVENT_STOP.
+    """
+    def __init__(self, node, conn):
+        super().__init__(node)
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.reader_thread = None
+        self.closed = False
+
+    def start(self, handler):
+        super().start(handler)
+        self.reader_thread = threading.Thread(target=self.reader_loop, name="chatx-bus", daemon=True)
+        self.reader_thread.start()
+
+    def reader_loop(self):
+        while True:
+            try:
+                event = self.conn.recv()
+            except (EOFError, OSError):
+                if not self.closed:
+                    self.handler({'type': EVENT_STOP, 'node': None})
+                break
+            try:
+                self.handler(event)
+            except Exception as e:
+                print(f"[BUS] Error handling {event.get('type')} event: {e}")
+
+    def _send(self, event):
+        with self.send_lock:
+            try:
+                self.conn.send(event)
+            except (OSError, ValueError) as e:
+                print(f"[BUS] Publish failed: {e}")
+
+    def close(self):
+        self.closed = True
+        try:
+            self.conn.close()
+        except OSError:
+            pass
+
+class InProcessBus(Bus):
+    """Bus to a BusHub in the same process, for nodes run side by side in
+    tests or demos. Events are handed over on a delivery thread, as a
+    network transport would."""
+    def __init__(self, node, hub):
+        super().__init__(node)
+        self.hub = hub
+        self.queue = queue.SimpleQueue()
+        self.delivery_thread = None
+
+    def start(self, handler):
+        super().start(handler)
+        self.delivery_thread = threading.Thread(target=self.delivery_loop, name="chatx-bus", daemon=True)
+        self.delivery_thread.start()
+        self.hub.add_member(self.node, self.queue.put)
+
+    def delivery_loop(self):
+        while True:
+            event = self.queue.get()
+            if event is None:
+                break
+            try:
+                self.handler(event)
+            except Exception as e:
+                print(f"[BUS] Error handling {event.get('type')} event: {e}")
+
+    def _send(self, event):
+        self.hub.dispatch(event)
+
+    def close(self):
+        self.hub.remove_member(self.node, self.queue.put)
+        self.queue.put(None)
+
+# Hubs for inproc:// URLs, by name
+INPROC_HUBS = {}
+
+def create_inproc_bus(node, address):
+    return InProcessBus(node, INPROC_HUBS.setdefault(address, BusHub()))
+
+def create_tcp_bus(node, address):
+    from broker import TcpBus
+    host, port, secret = parse_tcp_address(address)
+    return TcpBus(node, host, port, secret)
+
+def parse_tcp_address(address):
+    # [secret@]host:port
+    secret, _, hostport = address.rpartition('@')
+    host, _, port = hostport.rpartition(':')
+    return host, int(port), secret
+
+# Broker backends by URL scheme; add an entry to plug in another transport
+BUS_BACKENDS = {
+    'inproc': create_inproc_bus,
+    'tcp': create_tcp_bus,
+}
+
+def create_bus(url, node):
+    """Build the Bus for a broker URL such as tcp://10.0.0.5:6000 or inproc://test"""
+    scheme, _, address = url.partition('://')
+    if scheme not in BUS_BACKENDS:
+        raise ValueError(f"Unknown broker backend: {scheme}")
+    return BUS_BACKENDS[scheme](node, address)
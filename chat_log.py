@@ -0,0 +1,105 @@
+import collections
+import itertools
+
+class ChatEntry:
+    """One message of a chat as the client displays it"""
+    __slots__ = ('message', 'tag', 'sender', 'timestamp', 'message_id')
+
+    def __init__(self, message, tag, sender=None, timestamp=None, message_id=None):
+        self.message = message
+        self.tag = tag
+        self.sender = sender
+        self.timestamp = timestamp
+        self.message_id = message_id  # database id; None for live messages from older servers
+
+class ChatLog:
+    """The messages of one chat held in memory, at most `limit` of them.
+
+    Entries sit in a deque used as a ring buffer: appending to a full log
+    drops the oldest entry, which can be fetched again from the server.
+    Positions are absolute (`start` is the position of the oldest entry
+    held), so a rendered window keeps pointing at the same messages while
+    the ring moves.
+
+    `oldest_id` is the message id to page back from (None when the oldest
+    entry held is a live message from a server that sends no ids; the log
+    must then be reloaded from the latest page). `has_more` says the
+    server holds older messages; `has_newer` says newer entries were dropped
+    to make room for an older page.
+    """
+    def __init__(self, limit=1000):
+        self.limit = limit
+        self.entries = collections.deque()
+        self.start = 0
+        self.oldest_id = None
+        self.has_more = False
+        self.has_newer = False
+
+    def __len__(self):
+        return len(self.entries)
+
+    @property
+    def end(self):
+        return self.start + len(self.entries)
+
+    def slice(self, first, last):
+        """Entries at absolute positions [first, last)"""
+        return list(itertools.islice(self.entries, first - self.start, last - self.start))
+
+    def append(self, entry):
+        # A newer message; makes room by dropping the oldest one
+        if len(self.entries) >= self.limit:
+            self.entries.popleft()
+            self.start += 1
+            self.has_more = True
+            self.oldest_id = self.entries[0].message_id if self.entries else None
+        self.entries.append(entry)
+
+    def merge(self, entries):
+        """Append newer entries, skipping the ones already held.
+
+        A reconnecting client is replayed messages by id, but live
+        messages from servers without LIVE_MSG arrived without one: a
+        replayed entry matching a held live entry (same sender, timestamp
+        and text) is taken to be that message. Returns the number of entries appended.
+        """
+        held_ids = set()
+        live = collections.Counter()
+        for entry in self.entries:
+            if entry.message_id is None:
+                live[(entry.sender, entry.timestamp, entry.message)] += 1
+            else:
+                held_ids.add(entry.message_id)
+
+        added = 0
+        for entry in entries:
+            key = (entry.sender, entry.timestamp, entry.message)
+            if entry.message_id in held_ids:
+                continue
+            if live[key]:
+                live[key] -= 1
+                continue
+            self.append(entry)
+            added += 1
+        return added
+
+    def prepend(self, entries, oldest_id, has_more):
+        # An older page (in chronological order); makes room by dropping the newest
+        for entry in reversed(entries):
+            self.entries.appendleft(entry)
+        self.start -= len(entries)
+        while len(self.entries) > self.limit:
+            self.entries.pop()
+            self.has_newer = True
+        self.oldest_id = oldest_id
+        self.has_more = has_more
+
+    def replace(self, entries, oldest_id, has_more):
+        # The latest page, replacing everything held
+        self.entries = collections.deque(entries[-self.limit:])
+        self.start = 0
+        if len(entries) > self.limit:
+            oldest_id, has_more = self.entries[0].message_id, True
+        self.oldest_id = oldest_id
+        self.has_more = has_more
+        self.has_newer = False
@@ -1,5 +1,9 @@
+import bisect
+import collections
+import queue
 import socket
 import threading
+import time
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, simpledialog
 from datetime import datetime
@@ -7,29 +11,109 @@ from encryption import MessageEncryption
 import ipaddress
 import hashlib
 from login_dialog import LoginDialog, RegisterDialog
+from chat_log import ChatEntry, ChatLog
+from discovery import DISCOVERY_PORT, find_server
+from protocol import (
+    AUTH_BUSY, FLAG_GROUP_KEY, HISTORY_BATCH_PREFIX, LEGACY_VERSION, encode_wire,
+    unpack_history_batch,
+)
+
+# The receive thread queues UI work; the Tk thread applies it every
+# UI_TICK_MS, spending at most UI_TICK_BUDGET seconds per tick
+UI_TICK_MS = 50
+UI_TICK_BUDGET = 0.03
+
+class Debouncer:
+    """Runs `callback` once `delay` seconds pass without a trigger().
+
+    One Tk after() timer is reused for the whole burst: trigger() only moves
+    the deadline, and the timer re-arms itself if it fires early.
+    """
+    def __init__(self, widget, delay, callback):
+        self.widget = widget
+        self.delay = delay
+        self.callback = callback
+        self.deadline = 0.0
+        self.after_id = None
+    
+    def trigger(self):
+        self.deadline = time.monotonic() + self.delay
+        if self.after_id is None:
+            self.after_id = self.widget.after(int(self.delay * 1000), self.fire)
+    
+    def cancel(self):
+        if self.after_id is not None:
+            self.widget.after_cancel(self.after_id)
+            self.after_id = None
+    
+    def fire(self):
+        remaining = self.deadline - time.monotonic()
+        if remaining > 0:
+            self.after_id = self.widget.after(int(remaining * 1000) + 1, self.fire)
+            return
+        self.after_id = None
+        self.callback()
 
 class ChatClient:
-    def __init__(self):
+    def __init__(self, history_limit=1000, render_window=100, discovery_networks=None,
+                 discovery_port=DISCOVERY_PORT):
         self.client_socket = None
+        self.protocol_version = LEGACY_VERSION  # wire format negotiated at login
+        self.decoder = None
         self.encryption = MessageEncryption()
+        self.cipher = self.encryption  # session cipher negotiated at login
+        self.group_cipher = None       # decrypts broadcasts flagged FLAG_GROUP_KEY
         self.username = None
-        self.password = None
+        self.session_token = None  # latest SESSION token, for AuthService.resume; the password is never kept
+        self.last_message_id = 0   # newest message id seen; a reconnect replays after it
+        self.reconnecting = False  # a reconnect thread is retrying
+        self.session_replaced = False  # the server ended this session for a newer login
         self.authenticated = False
         self.connected = False
         self.receive_thread = None
-        self.typing_timer = None
+        self.typing_debouncer = None
         self.is_typing = False
+        self.typing_chat = None        # chat our current TYPING ON went to
+        self.typing_label_chat = None  # chat of the indicator on display
         self.server_ip = None
         self.server_port = 5555
+        self.discovery_networks = discovery_networks  # CIDRs to scan; None for the local /24
+        self.discovery_port = discovery_port          # UDP beacon port; None to only scan
         self.selected_user = None  # For private messaging
         self.current_chat = "ALL"
-        self.chat_history = {"ALL": []}
+        self.chat_history = {}     # chat_id: ChatLog
+        self.history_limit = history_limit  # messages kept in memory per chat
         self.online_users = set()
         self.all_chat_users = set()
+        self.presence_seq = None   # last presence delta applied; None until a snapshot
+        self.listbox_users = []    # users_listbox rows, in order
+        self.listbox_keys = []     # their sort keys, for bisect
+        self.history_requests = {}  # chat_id: 'older' or 'latest' HISTORY request in flight
+        self.pending_history = []  # HISTORY_MSG entries until HISTORY_END
+        
+        # Only a window of the current chat is rendered: log positions
+        # [view_first, view_last), with the Text lines each entry took
+        self.render_window = render_window
+        self.view_first = 0
+        self.view_last = 0
+        self.rendered_lines = collections.deque()
+        self.scroll_check_pending = False
+        
+        # Work handed from the receive thread to the Tk thread, and what the
+        # current tick still has to draw
+        self.ui_events = queue.SimpleQueue()
+        self.tail_pending = False     # new messages to draw at the bottom
+        self.user_list_dirty = False  # sidebar needs a full redraw
         
         # Create GUI
         self.create_gui()
         
+        # Typing stops 2s after the last keystroke
+        self.typing_debouncer = Debouncer(self.window, 2.0, self.stop_typing)
+        
+        # Apply what the receive thread queues
+        self.window.after(UI_TICK_MS, self.pump_ui_events)
+        
         # Start automatic server detection in background
         self.auto_detect_thread = threading.Thread(target=self.background_server_detection, daemon=True)
         self.auto_detect_thread.start()
@@ -59,38 +143,21 @@ class ChatClient:
             return "127.0.0.1"
     
     def scan_lan_for_server(self, port=5555, timeout=0.5):
-        # Scan local network for available server
+        # Find a server on the local network: UDP beacon first, then a
+        # concurrent TCP scan of the local /24 (or discovery_networks)
         local_ip = self.get_local_ip()
-        ip_parts = local_ip.split('.')
-        network_prefix = '.'.join(ip_parts[:3])
-        
-        # Try localhost first
-        if self.test_server_connection('127.0.0.1', port, timeout=1):
-            return '127.0.0.1'
-        
-        # Try local IP
-        if self.test_server_connection(local_ip, port, timeout=1):
-            return local_ip
-        
-        # Scan common LAN IPs
-        for i in (2,255):
-            test_ip = f"{network_prefix}.{i}"
-            if test_ip != local_ip:
-                if self.test_server_connection(test_ip, port, timeout):
-                    return test_ip
-        
-        return None
-    
-    def test_server_connection(self, host, port, timeout=0.5):
-        # Test if server is available at given address
+        networks = self.discovery_networks or [f"{local_ip}/24"]
         try:
-            test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            test_socket.settimeout(timeout)
-            test_socket.connect((host, port))
-            test_socket.close()
-            return True
-        except:
-            return False
+            found = find_server(port, networks, [local_ip], self.discovery_port, timeout)
+        except Exception as e:
+            print(f"Server discovery failed: {e}")
+            return None
+        if not found:
+            return None
+        
+        # A beacon reply names the server's chat port
+        server_ip, self.server_port = found
+        return server_ip
     
     def create_gui(self):
         # Main window with WhatsApp style
@@ -255,6 +322,20 @@ class ChatClient:
         )
         self.chat_header_label.pack(side=tk.LEFT, pady=12, padx=15)
         
+        # Fetch an older page of the current chat from the server
+        self.older_button = tk.Button(
+            chat_header,
+            text="Load older",
+            command=self.request_older_messages,
+            bg='#EDEDED',
+            fg='#075E54',
+            font=('Segoe UI', 9, 'bold'),
+            relief=tk.FLAT,
+            cursor='hand2',
+            state=tk.DISABLED
+        )
+        self.older_button.pack(side=tk.RIGHT, pady=10, padx=15)
+        
         # Chat display area (WhatsApp background pattern)
         self.chat_display = scrolledtext.ScrolledText(
             chat_container,
@@ -265,6 +346,8 @@ class ChatClient:
             relief=tk.FLAT
         )
         self.chat_display.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        # Render more of the chat when scrolled to either end
+        self.chat_display.configure(yscrollcommand=self.on_chat_scroll)
         
         # Configure chat text tags (WhatsApp colors)
         # Configure chat text tags (WhatsApp-like)
@@ -355,8 +438,6 @@ class ChatClient:
                 # Trigger selection
                 self.selected_user = username
                 self.current_chat = username
-                if username not in self.chat_history:
-                    self.chat_history[username] = []
                 self.chat_header_label.config(text=f"Private Chat with {username}")
                 self.message_entry.focus()
                 self.refresh_chat_display()
@@ -385,9 +466,6 @@ class ChatClient:
             self.selected_user = username
             self.current_chat = username
             
-            if username not in self.chat_history:
-                self.chat_history[username] = []
-                
             self.chat_header_label.config(text=f"Private Chat with {username}")
             self.message_entry.focus()
             self.refresh_chat_display()
@@ -397,6 +475,7 @@ class ChatClient:
         if self.connected:
             messagebox.showwarning("Already Connected", "You are already connected to the server")
             return
+        self.reconnecting = False
         
         if not self.server_ip:
             messagebox.showerror("No Server", "No server found. Please wait for automatic detection or check if server is running.")
@@ -440,29 +519,14 @@ class ChatClient:
                 success, sock, message = auth_service.login(self.server_ip, self.server_port, username, password)
                 
             if success:
-                self.client_socket = sock
                 self.username = username
-                self.password = password
-                self.authenticated = True
-                self.connected = True
-                
-                # Update window title
-                self.window.title(f"ChatX - {self.username}")
-                
-                # Update UI
-                self.status_label.config(text=f"Connected as {self.username}", fg='#25D366')
-                self.connect_button.config(state=tk.DISABLED)
-                self.disconnect_button.config(state=tk.NORMAL)
-                self.send_button.config(state=tk.NORMAL)
-                
-                # Start receive thread
-                self.receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
-                self.receive_thread.start()
+                self.session_token = None
+                self.start_session(auth_service, sock)
                 
                 if action == "REGISTER":
-                    self.display_message(f"✓ Account created! Welcome {self.username}!", 'system')
+                    self.add_message_to_history(self.current_chat, f"✓ Account created! Welcome {self.username}!", 'system')
                 else:
-                    self.display_message(f"✓ Welcome back {self.username}!", 'system')
+                    self.add_message_to_history(self.current_chat, f"✓ Welcome back {self.username}!", 'system')
             else:
                 self.connected = False
                 if sock:
@@ -476,8 +540,39 @@ class ChatClient:
                 self.client_socket.close()
                 self.client_socket = None
     
+    def start_session(self, auth_service, sock):
+        # Take over an authenticated socket and start receiving
+        self.client_socket = sock
+        # Frames that arrived right behind AUTH_RESPONSE are already in the decoder
+        self.protocol_version = auth_service.protocol_version
+        self.decoder = auth_service.decoder
+        self.cipher = auth_service.cipher
+        self.group_cipher = auth_service.group_cipher
+        self.presence_seq = None
+        self.history_requests.clear()  # answers to these died with the old socket
+        self.pending_history = []
+        self.session_replaced = False
+        self.authenticated = True
+        self.connected = True
+        
+        # Update window title
+        self.window.title(f"ChatX - {self.username}")
+        
+        # Update UI
+        self.status_label.config(text=f"Connected as {self.username}", fg='#25D366')
+        self.connect_button.config(state=tk.DISABLED)
+        self.disconnect_button.config(state=tk.NORMAL)
+        self.send_button.config(state=tk.NORMAL)
+        
+        # Start receive thread
+        self.receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
+        self.receive_thread.start()
+    
     def disconnect_from_server(self):
         # Manually disconnect from server
+        if self.reconnecting:
+            self.stop_reconnecting()
+            return
         if not self.connected:
             return
         
@@ -492,81 +587,139 @@ class ChatClient:
             self.connect_button.config(state=tk.NORMAL)
             self.disconnect_button.config(state=tk.DISABLED)
             self.send_button.config(state=tk.DISABLED)
+            self.older_button.config(state=tk.DISABLED)
             
-            self.display_message("✗ Disconnected from server", 'system')
+            self.add_message_to_history(self.current_chat, "✗ Disconnected from server", 'system')
             
         except Exception as e:
             print(f"Disconnect error: {e}")
     
     def receive_messages(self):
-        # Receive messages from server
-        buffer = ""
+        # Receive messages from server; the decoder buffers partial frames
+        decoder = self.decoder
         while self.connected:
             try:
-                data_chunk = self.client_socket.recv(4096).decode()
-                if not data_chunk:
-                    break
-                
-                buffer += data_chunk
-                
-                while '\n' in buffer:
-                    encrypted_data, buffer = buffer.split('\n', 1)
-                    if not encrypted_data:
-                        continue
-                        
+                for frame_type, flags, encrypted_data in decoder.drain():
                     # Process individual message
                     try:
-                        data = self.encryption.decrypt(encrypted_data)
+                        cipher = self.group_cipher if flags & FLAG_GROUP_KEY else self.cipher
+                        data = cipher.decrypt_bytes(encrypted_data)
                         if not data:
                             continue
                         
+                        # Compressed history arrives as one binary frame
+                        if data.startswith(HISTORY_BATCH_PREFIX):
+                            self.receive_history_batch(data)
+                            continue
+                        data = data.decode()
+                        
                         # Parse message
                         parts = data.split('|', 1)
                         
-                        if parts[0] == "USER_LIST":
+                        if parts[0] == "SESSION":
+                            # SESSION|TOKEN|EXPIRES: lets a reconnect skip the password
+                            if len(parts) > 1:
+                                self.session_token = parts[1].split('|', 1)[0]
+                        
+                        elif parts[0] == "PING":
+                            # PING|INTERVAL|TIMEOUT: answer it, and take a server silent
+                            # for TIMEOUT as gone (it pings at least every INTERVAL)
+                            ping_parts = parts[1].split('|') if len(parts) > 1 else []
+                            if len(ping_parts) >= 2:
+                                self.client_socket.settimeout(float(ping_parts[1]))
+                            self.post(self.send_pong)
+                        
+                        elif parts[0] == "SESSION_END":
+                            # Logged in elsewhere: reconnecting would kick that session
+                            self.session_replaced = True
+                        
+                        elif parts[0] == "USER_LIST":
                             users = parts[1].split(',') if len(parts) > 1 and parts[1] else []
-                            self.update_user_list(users)
+                            self.post(self.update_user_list, users)
+                        
+                        elif parts[0] == "PRESENCE_SNAPSHOT":
+                            if len(parts) > 1:
+                                seq, _, users = parts[1].partition('|')
+                                self.post(self.apply_presence_snapshot, int(seq), users.split(',') if users else [])
+                        
+                        elif parts[0] in ("PRESENCE_JOIN", "PRESENCE_LEAVE"):
+                            if len(parts) > 1:
+                                seq, _, user = parts[1].partition('|')
+                                self.post(self.apply_presence_delta, int(seq), user, parts[0] == "PRESENCE_JOIN")
+                        
+                        elif parts[0] == "PRESENCE_SEQ":
+                            if len(parts) > 1:
+                                self.post(self.check_presence_seq, int(parts[1]))
                         
                         elif parts[0] == "TYPING":
                             if len(parts) > 1:
-                                typing_parts = parts[1].split('|', 1)
+                                typing_parts = parts[1].split('|', 2)
                                 if len(typing_parts) >= 2:
                                     username = typing_parts[0]
                                     status = typing_parts[1]
+                                    # Private indicators belong to the chat with their sender
+                                    chat_id = username if typing_parts[2:] == ["PRIVATE"] else "ALL"
                                     if username != self.username:
-                                        if status == "ON":
-                                            self.typing_label.config(text=f"{username} is typing...")
-                                        else:
-                                            self.typing_label.config(text="")
+                                        self.post(self.show_typing, username, status, chat_id)
                         
                         elif parts[0] == "SYSTEM":
                             if len(parts) > 1:
                                 msg_parts = parts[1].split('|', 3)
                                 if len(msg_parts) >= 4:
                                     timestamp, sender, receiver, content = msg_parts
-                                    self.add_message_to_history("ALL", f"{content}", 'system')
+                                    self.post(self.add_entry, "ALL", ChatEntry(content, 'system'))
                         
                         elif parts[0] == "MSG":
                             if len(parts) > 1:
                                 msg_parts = parts[1].split('|', 3)
                                 if len(msg_parts) >= 4:
                                     timestamp, sender, receiver, content = msg_parts
-                                    if receiver == "ALL":
-                                        # Group message
-                                        if sender == self.username:
-                                            self.add_message_to_history("ALL", content, 'sent', sender="You", timestamp=timestamp)
-                                        else:
-                                            self.add_message_to_history("ALL", content, 'received', sender=sender, timestamp=timestamp)
-                                    else:
-                                        # Private message logic
-                                        chat_partner = receiver if sender == self.username else sender
-                                        
-                                        if sender == self.username:
-                                            self.add_message_to_history(chat_partner, content, 'sent', sender="You", timestamp=timestamp)
-                                        else:
-                                            self.add_message_to_history(chat_partner, content, 'received', sender=sender, timestamp=timestamp)
+                                    self.post(self.add_entry, *self.chat_entry_for(sender, receiver, content, timestamp))
+                        
+                        elif parts[0] == "LIVE_MSG":
+                            # A new message with its id (MESSAGE_IDS), so a reconnect skips it
+                            if len(parts) > 1:
+                                msg_parts = parts[1].split('|', 4)
+                                if len(msg_parts) >= 5:
+                                    message_id, timestamp, sender, receiver, content = msg_parts
+                                    self.last_message_id = max(self.last_message_id, int(message_id))
+                                    self.post(self.add_entry, *self.chat_entry_for(
+                                        sender, receiver, content, timestamp, int(message_id)
+                                    ))
+                        
+                        elif parts[0] == "THROTTLE":
+                            # THROTTLE|TYPE|RETRY_AFTER|CHAT|TIMESTAMP: the server refused
+                            # a frame; only a dropped message is worth telling the user
+                            if len(parts) > 1:
+                                throttle_parts = parts[1].split('|', 3)
+                                if len(throttle_parts) >= 3 and throttle_parts[0] == "MSG":
+                                    retry_after, chat_id = float(throttle_parts[1]), throttle_parts[2]
+                                    notice = f"⚠ Sending too fast: message not delivered, wait {retry_after:.1f}s"
+                                    self.post(self.add_entry, chat_id, ChatEntry(notice, 'system'))
+
+                        elif parts[0] == "HISTORY_MSG":
+                            # Older message requested with HISTORY (held until HISTORY_END)
+                            if len(parts) > 1:
+                                msg_parts = parts[1].split('|', 4)
+                                if len(msg_parts) >= 5:
+                                    message_id, timestamp, sender, receiver, content = msg_parts
+                                    self.last_message_id = max(self.last_message_id, int(message_id))
+                                    self.pending_history.append(self.chat_entry_for(
+                                        sender, receiver, content, timestamp, int(message_id)
+                                    )[1])
+                        
+                        elif parts[0] == "HISTORY_END":
+                            if len(parts) > 1:
+                                end_parts = parts[1].split('|')
+                                if len(end_parts) >= 3:
+                                    chat_id, oldest_id, has_more = end_parts[:3]
+                                    entries, self.pending_history = self.pending_history, []
+                                    self.post(self.apply_history_page, chat_id, int(oldest_id), has_more == '1', entries)
                     except Exception as e:
                         print(f"Error processing message: {e}")
+                
+                if not decoder.recv_into(self.client_socket):
+                    break
             
             except Exception as e:
                 print(f"Receive error: {e}")
@@ -574,7 +727,184 @@ class ChatClient:
         
         # Connection lost
         if self.connected:
-            self.handle_disconnect()
+            self.post(self.handle_disconnect)
+    
+    def post(self, handler, *args):
+        # Queue handler(*args) for the Tk thread (see pump_ui_events)
+        self.ui_events.put((handler, args))
+    
+    def pump_ui_events(self):
+        """Apply queued receive-thread work on the Tk thread, in batches.
+
+        Runs every UI_TICK_MS and stops after UI_TICK_BUDGET so a flood of
+        messages never starves input handling; leftovers wait for the next
+        tick. Drawing is coalesced per tick: one Text insert for every new
+        message at the bottom of the open chat and at most one sidebar redraw.
+        """
+        deadline = time.monotonic() + UI_TICK_BUDGET
+        try:
+            while time.monotonic() < deadline:
+                try:
+                    handler, args = self.ui_events.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    handler(*args)
+                except Exception as e:
+                    print(f"Error processing message: {e}")
+            self.flush_ui()
+        finally:
+            self.window.after(UI_TICK_MS, self.pump_ui_events)
+    
+    def flush_ui(self):
+        # Draw what this tick's events changed
+        self.flush_tail()
+        if self.user_list_dirty:
+            self.refresh_user_listbox()
+    
+    def flush_tail(self):
+        # Render messages appended while the open chat was scrolled to the bottom
+        if not self.tail_pending:
+            return
+        self.tail_pending = False
+        log = self.chat_log(self.current_chat)
+        if self.view_last < log.start:
+            # More arrived than the log holds
+            self.refresh_chat_display()
+            return
+        self.rendered_lines.extend(self.render_entries(log.slice(self.view_last, log.end), tk.END))
+        self.view_last = log.end
+        self.trim_view()
+        self.chat_display.see(tk.END)
+    
+    def show_typing(self, username, status, chat_id):
+        # Typing indicators only show in the chat they belong to
+        if chat_id != self.current_chat:
+            return
+        if status == "ON":
+            self.typing_label_chat = chat_id
+            self.typing_label.config(text=f"{username} is typing...")
+        else:
+            self.typing_label.config(text="")
+    
+    def chat_entry_for(self, sender, receiver, content, timestamp, message_id=None):
+        # Work out which chat a MSG belongs to and how to display it
+        if receiver == "ALL":
+            chat_id = "ALL"
+        else:
+            chat_id = receiver if sender == self.username else sender
+        
+        if sender == self.username:
+            return chat_id, ChatEntry(content, 'sent', "You", timestamp, message_id)
+        return chat_id, ChatEntry(content, 'received', sender, timestamp, message_id)
+    
+    def chat_log(self, chat_id):
+        log = self.chat_history.get(chat_id)
+        if log is None:
+            log = self.chat_history[chat_id] = ChatLog(self.history_limit)
+        return log
+    
+    def receive_history_batch(self, payload):
+        # Unpack a HISTORY_BATCH on the receive thread
+        older, rows = unpack_history_batch(payload)
+        if rows:
+            self.last_message_id = max(self.last_message_id, max(row[0] for row in rows))
+        entries = [
+            self.chat_entry_for(sender, receiver, message, timestamp, message_id)
+            for message_id, sender, receiver, message, timestamp in rows
+        ]
+        
+        if older:
+            # Page answering a HISTORY request; applied at HISTORY_END
+            self.pending_history.extend(entry for chat_id, entry in entries)
+            return
+        self.post(self.apply_history_batch, entries)
+    
+    def apply_history_batch(self, entries):
+        # Add the login replay to chat_history, then redraw once; after a
+        # reconnect it may repeat live messages we already show
+        chats = {}
+        for chat_id, entry in entries:
+            chats.setdefault(chat_id, []).append(entry)
+        for chat_id, chat_entries in chats.items():
+            self.chat_log(chat_id).merge(chat_entries)
+            if chat_id != "ALL" and chat_id != self.username:
+                self.all_chat_users.add(chat_id)
+        
+        self.user_list_dirty = True
+        self.refresh_chat_display()
+    
+    def apply_history_page(self, chat_id, oldest_id, has_more, entries):
+        # Apply a HISTORY_END: an older page goes in front of the log, the
+        # latest page replaces it; login history only sets the cursor, and
+        # a page nobody asked for is a reconnect catch-up that skipped a gap
+        self.flush_tail()
+        log = self.chat_log(chat_id)
+        kind = self.history_requests.pop(chat_id, 'latest' if entries else 'older')
+        if kind == 'latest':
+            log.replace(entries, oldest_id, has_more)
+            if chat_id == self.current_chat:
+                self.refresh_chat_display()
+        else:
+            log.prepend(entries, oldest_id, has_more)
+            if chat_id == self.current_chat and entries:
+                self.trim_view()
+                self.extend_view_up()
+        
+        if entries and chat_id != "ALL" and chat_id != self.username and chat_id not in self.all_chat_users:
+            self.all_chat_users.add(chat_id)
+            self.user_list_dirty = True
+        if chat_id == self.current_chat:
+            self.update_older_button()
+    
+    def update_older_button(self):
+        # Only offer older messages when the server said there are more
+        has_more = self.chat_log(self.current_chat).has_more
+        self.older_button.config(state=tk.NORMAL if (self.connected and has_more) else tk.DISABLED)
+    
+    def request_older_messages(self):
+        # Ask the server for the page before the oldest message we have
+        if not self.connected or self.current_chat in self.history_requests:
+            return
+        
+        log = self.chat_log(self.current_chat)
+        if not log.has_more:
+            return
+        if log.oldest_id is None:
+            # Only live messages are left and they carry no id to page from
+            self.request_latest_messages()
+            return
+        self.send_history_request('older', log.oldest_id)
+    
+    def request_latest_messages(self):
+        # Reload the current chat from the server's latest page
+        if self.connected and self.current_chat not in self.history_requests:
+            self.send_history_request('latest', '')
+    
+    def send_history_request(self, kind, before_id):
+        try:
+            timestamp = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+            msg = f"HISTORY|{timestamp}|{self.username}|{self.current_chat}|{before_id}"
+            self.send_protocol_message(msg)
+            self.history_requests[self.current_chat] = kind
+            self.older_button.config(state=tk.DISABLED)
+        except Exception as e:
+            print(f"History request error: {e}")
+    
+    def send_protocol_message(self, msg):
+        # Encrypt one protocol message and frame it for the negotiated wire format
+        token = self.cipher.encrypt_bytes(msg.encode())
+        self.client_socket.sendall(encode_wire(token, self.protocol_version))
+    
+    def send_pong(self):
+        # Heartbeat reply; the server drops clients that stop answering
+        if not self.connected:
+            return
+        try:
+            timestamp = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+            self.send_protocol_message(f"PONG|{timestamp}|{self.username}|SERVER|")
+        except Exception as e:
+            print(f"Heartbeat error: {e}")
     
     def send_message(self):
         # Send message to server
@@ -598,14 +928,13 @@ class ChatClient:
                 # Send group message
                 msg = f"MSG|{timestamp}|{self.username}|ALL|{message}"
             
-            encrypted_msg = self.encryption.encrypt(msg)
-            self.client_socket.send(encrypted_msg.encode() + b'\n')
+            self.send_protocol_message(msg)
             
             # Clear input
             self.message_entry.delete(0, tk.END)
             
             # Stop typing indicator
-            self.send_typing_status("OFF")
+            self.stop_typing()
         
         except Exception as e:
             messagebox.showerror("Send Error", f"Failed to send message: {e}")
@@ -614,116 +943,260 @@ class ChatClient:
         # Handle key press for typing indicator
         if not self.is_typing and event.char.isprintable():
             self.is_typing = True
-            self.send_typing_status("ON")
+            self.typing_chat = self.selected_user or "ALL"
+            self.send_typing_status("ON", self.typing_chat)
     
     def on_key_release(self, event):
-        # Reset typing timer on key release
-        if self.typing_timer:
-            self.typing_timer.cancel()
-        
-        self.typing_timer = threading.Timer(2.0, self.stop_typing)
-        self.typing_timer.start()
+        # Push back the typing timeout
+        if self.is_typing:
+            self.typing_debouncer.trigger()
     
     def stop_typing(self):
-        # Stop typing indicator after timeout
+        # Stop typing indicator after timeout, on send or on leaving the chat
+        self.typing_debouncer.cancel()
         if self.is_typing:
             self.is_typing = False
-            self.send_typing_status("OFF")
+            self.send_typing_status("OFF", self.typing_chat)
     
-    def send_typing_status(self, status):
-        # Send typing status to server
+    def send_typing_status(self, status, receiver):
+        # Send typing status for one chat (a username or ALL) to the server
         if not self.connected:
             return
         
         try:
             timestamp = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-            msg = f"TYPING|{timestamp}|{self.username}|ALL|{status}"
-            encrypted_msg = self.encryption.encrypt(msg)
-            self.client_socket.send(encrypted_msg.encode() + b'\n')
+            msg = f"TYPING|{timestamp}|{self.username}|{receiver}|{status}"
+            self.send_protocol_message(msg)
         except:
             pass
     
     def update_user_list(self, users):
-        # Update online users set
+        # Update online users set; the sidebar is redrawn once per UI tick
         self.online_users = set(users)
-        self.refresh_user_listbox()
+        self.user_list_dirty = True
+    
+    def apply_presence_snapshot(self, seq, users):
+        # Full presence state; deltas continue from seq
+        self.presence_seq = seq
+        self.update_user_list(users)
+    
+    def apply_presence_delta(self, seq, user, online):
+        # Apply one PRESENCE_JOIN/LEAVE in sequence; on a gap (a delta the
+        # server shed) ignore deltas until a fresh snapshot arrives
+        if self.presence_seq is None or seq <= self.presence_seq:
+            return
+        if seq != self.presence_seq + 1:
+            self.request_presence_sync(seq)
+            return
+        
+        self.presence_seq = seq
+        if online:
+            self.online_users.add(user)
+        else:
+            self.online_users.discard(user)
+        if not self.user_list_dirty:
+            self.update_user_row(user)
+
+    def check_presence_seq(self, seq):
+        # PRESENCE_SEQ after a burst: a higher SEQ means the last deltas were shed
+        if self.presence_seq is not None and seq > self.presence_seq:
+            self.request_presence_sync(seq)
+
+    def request_presence_sync(self, seq):
+        # Ignore deltas until the requested snapshot arrives
+        self.presence_seq = None
+        timestamp = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        self.send_protocol_message(f"PRESENCE_SYNC|{timestamp}|{self.username}|SERVER|{seq}")
+
+    def user_sort_key(self, user):
+        # Online first, then alphabetical
+        return (0 if user in self.online_users else 1, user.lower(), user)
         
     def refresh_user_listbox(self):
         # Redraw user list (Only show Active Chats)
+        self.user_list_dirty = False
         self.users_listbox.delete(0, tk.END)
         
         # Only show users in all_chat_users (History/Active)
-        display_users = self.all_chat_users
+        display_users = [user for user in self.all_chat_users if user and user != self.username]
         
-        # Sort users (Online first, then alphabetical)
-        sorted_users = sorted(list(display_users), key=lambda x: (0 if x in self.online_users else 1, x.lower()))
+        self.listbox_users = sorted(display_users, key=self.user_sort_key)
+        self.listbox_keys = [self.user_sort_key(user) for user in self.listbox_users]
+        for user in self.listbox_users:
+            self.insert_user_row(tk.END, user)
+    
+    def update_user_row(self, user):
+        # Move one user's row to match its online status instead of redrawing
+        # the whole list; users without a chat are not listed at all
+        if user in self.listbox_users:
+            index = self.listbox_users.index(user)
+            self.users_listbox.delete(index)
+            del self.listbox_users[index]
+            del self.listbox_keys[index]
+        elif user not in self.all_chat_users or user == self.username:
+            return
         
-        for user in sorted_users:
-            if user and user != self.username:
-                if user in self.online_users:
-                    self.users_listbox.insert(tk.END, f"🟢 {user}")
-                    self.users_listbox.itemconfig(tk.END, {'fg': '#075E54'})
-                else:
-                    self.users_listbox.insert(tk.END, f"⚪ {user}")
-                    self.users_listbox.itemconfig(tk.END, {'fg': '#999999'})
+        key = self.user_sort_key(user)
+        index = bisect.bisect(self.listbox_keys, key)
+        self.listbox_users.insert(index, user)
+        self.listbox_keys.insert(index, key)
+        self.insert_user_row(index, user)
+    
+    def insert_user_row(self, index, user):
+        if user in self.online_users:
+            self.users_listbox.insert(index, f"🟢 {user}")
+            self.users_listbox.itemconfig(index, {'fg': '#075E54'})
+        else:
+            self.users_listbox.insert(index, f"⚪ {user}")
+            self.users_listbox.itemconfig(index, {'fg': '#999999'})
     
     def add_message_to_history(self, chat_id, message, tag, sender=None, timestamp=None):
         # Add message to specific chat history
-        if chat_id not in self.chat_history:
-            self.chat_history[chat_id] = []
-            
+        self.add_entry(chat_id, ChatEntry(message, tag, sender, timestamp))
+    
+    def add_entry(self, chat_id, entry):
         # Track user if it's a private chat
         if chat_id != "ALL" and chat_id != self.username:
             if chat_id not in self.all_chat_users:
                 self.all_chat_users.add(chat_id)
-                self.window.after(0, self.refresh_user_listbox)
-            
-        self.chat_history[chat_id].append({
-            'message': message,
-            'tag': tag,
-            'sender': sender,
-            'timestamp': timestamp
-        })
-        
-        # If currently view this chat, display it immediately
-        if self.current_chat == chat_id:
-            self.display_message(message, tag, sender, timestamp)
+                self.user_list_dirty = True
+        
+        log = self.chat_log(chat_id)
+        if log.has_newer:
+            # The log holds an older stretch; this comes back with the latest page
+            return
+        
+        # If the open chat is scrolled to the bottom, the message is drawn
+        # with the rest of this tick's (flush_tail)
+        if chat_id == self.current_chat and (self.tail_pending or self.view_last == log.end):
+            self.tail_pending = True
+        log.append(entry)
+        if chat_id == self.current_chat and not self.tail_pending:
+            self.trim_view()
 
     def refresh_chat_display(self):
-        # Clear and redraw chat for current selection
+        # Typing indicators are per chat: stop ours and hide others' when switching
+        if self.typing_chat != (self.selected_user or "ALL"):
+            self.stop_typing()
+        if self.typing_label_chat != self.current_chat:
+            self.typing_label.config(text="")
+        
+        # Clear and redraw the newest window of the current chat
+        self.tail_pending = False
+        log = self.chat_log(self.current_chat)
+        self.view_last = log.end
+        self.view_first = max(log.start, log.end - self.render_window)
         self.chat_display.config(state=tk.NORMAL)
         self.chat_display.delete('1.0', tk.END)
         self.chat_display.config(state=tk.DISABLED)
+        self.rendered_lines = collections.deque(
+            self.render_entries(log.slice(self.view_first, self.view_last), tk.END)
+        )
+        self.chat_display.see(tk.END)
         
-        if self.current_chat in self.chat_history:
-            for msg_data in self.chat_history[self.current_chat]:
-                # Handle both old format (tuple) and new format (dict) for compatibility if needed
-                if isinstance(msg_data, tuple):
-                    self.display_message(msg_data[0], msg_data[1])
-                else:
-                    self.display_message(
-                        msg_data['message'], 
-                        msg_data['tag'], 
-                        msg_data['sender'], 
-                        msg_data['timestamp']
-                    )
-
-    def display_message(self, message, tag=None, sender=None, timestamp=None):
-        # Display message in chat window
-        self.chat_display.config(state=tk.NORMAL)
-        
-        if sender and timestamp and sender != "You":
+        self.update_older_button()
+    
+    def entry_segments(self, entry):
+        # (text, tag) pairs displaying one message
+        if entry.sender and entry.timestamp and entry.sender != "You":
             # For messages from others, make sender clickable
-            self.chat_display.insert(tk.END, f"{sender}", 'clickable_user')
-            self.chat_display.insert(tk.END, f" ({timestamp}):\n{message}\n\n", tag)
-        elif sender == "You" and timestamp:
-             self.chat_display.insert(tk.END, f"You ({timestamp}):\n{message}\n\n", tag)
-        else:
-            # Fallback for system messages or simple formatted strings
-             self.chat_display.insert(tk.END, message + '\n\n', tag)
-            
-        self.chat_display.see(tk.END)
-        self.chat_display.config(state=tk.DISABLED)
+            return [(entry.sender, 'clickable_user'),
+                    (f" ({entry.timestamp}):\n{entry.message}\n\n", entry.tag)]
+        elif entry.sender == "You" and entry.timestamp:
+            return [(f"You ({entry.timestamp}):\n{entry.message}\n\n", entry.tag)]
+        # Fallback for system messages or simple formatted strings
+        return [(entry.message + '\n\n', entry.tag)]
+    
+    def render_entries(self, entries, index):
+        # Insert entries at index with one Text.insert call; returns the
+        # number of lines each one took
+        args = []
+        lines = []
+        for entry in entries:
+            count = 0
+            for text, tag in self.entry_segments(entry):
+                args += [text, tag]
+                count += text.count('\n')
+            lines.append(count)
+        if args:
+            self.chat_display.config(state=tk.NORMAL)
+            self.chat_display.insert(index, *args)
+            self.chat_display.config(state=tk.DISABLED)
+        return lines
+    
+    def trim_view(self, keep_bottom=True):
+        """Un-render entries the log no longer holds and keep at most two
+        windows rendered, dropping from the far end; returns the number of
+        lines removed from the top"""
+        log = self.chat_log(self.current_chat)
+        top = min(max(log.start - self.view_first, 0), len(self.rendered_lines))
+        bottom = min(max(self.view_last - log.end, 0), len(self.rendered_lines) - top)
+        excess = len(self.rendered_lines) - top - bottom - 2 * self.render_window
+        if excess > 0:
+            if keep_bottom:
+                top += excess
+            else:
+                bottom += excess
+        
+        top_lines = sum(self.rendered_lines.popleft() for _ in range(top))
+        bottom_lines = sum(self.rendered_lines.pop() for _ in range(bottom))
+        self.view_first += top
+        self.view_last -= bottom
+        if top_lines or bottom_lines:
+            self.chat_display.config(state=tk.NORMAL)
+            if bottom_lines:
+                last_line = int(self.chat_display.index('end-1c').split('.')[0])
+                self.chat_display.delete(f"{last_line - bottom_lines}.0", tk.END)
+            if top_lines:
+                self.chat_display.delete('1.0', f"{top_lines + 1}.0")
+            self.chat_display.config(state=tk.DISABLED)
+        return top_lines
+    
+    def extend_view_up(self):
+        # Scrolled to the top: render the previous chunk of the log, or
+        # fetch an older page once the whole log is rendered
+        self.flush_tail()
+        log = self.chat_log(self.current_chat)
+        if self.view_first > log.start:
+            first = max(log.start, self.view_first - self.render_window)
+            lines = self.render_entries(log.slice(first, self.view_first), '1.0')
+            self.rendered_lines.extendleft(reversed(lines))
+            self.view_first = first
+            self.trim_view(keep_bottom=False)
+            # Keep the message that was on top in place
+            self.chat_display.yview(f"{sum(lines) + 1}.0")
+        elif log.has_more:
+            self.request_older_messages()
+    
+    def extend_view_down(self):
+        # Scrolled to the bottom: render the next chunk of the log, or reload
+        # the latest page if newer messages were dropped for older ones
+        self.flush_tail()
+        log = self.chat_log(self.current_chat)
+        if self.view_last < log.end:
+            top_line = int(self.chat_display.index('@0,0').split('.')[0])
+            last = min(log.end, self.view_last + self.render_window)
+            self.rendered_lines.extend(self.render_entries(log.slice(self.view_last, last), tk.END))
+            self.view_last = last
+            removed = self.trim_view()
+            self.chat_display.yview(f"{max(top_line - removed, 1)}.0")
+        elif log.has_newer:
+            self.request_latest_messages()
+    
+    def on_chat_scroll(self, first, last):
+        # Scrollbar update from the chat Text; check the edges once idle
+        self.chat_display.vbar.set(first, last)
+        if not self.scroll_check_pending:
+            self.scroll_check_pending = True
+            self.window.after_idle(self.check_scroll_edges)
+    
+    def check_scroll_edges(self):
+        self.scroll_check_pending = False
+        first, last = self.chat_display.yview()
+        if first <= 0.0:
+            self.extend_view_up()
+        elif last >= 1.0:
+            self.extend_view_down()
         
     def on_chat_username_click(self, event):
         # Handle click on username in chat
@@ -752,30 +1225,84 @@ class ChatClient:
             self.all_chat_users.add(username)
             self.refresh_user_listbox()
             
-        if username not in self.chat_history:
-            self.chat_history[username] = []
-            
         self.chat_header_label.config(text=f"Private Chat with {username}")
         self.message_entry.focus()
         self.refresh_chat_display()
     
     def handle_disconnect(self):
-        # Handle connection loss
+        # Handle connection loss: retry in the background before giving up
         self.connected = False
+        if self.client_socket:
+            self.client_socket.close()
+        self.send_button.config(state=tk.DISABLED)
+        self.older_button.config(state=tk.DISABLED)
+        self.typing_label.config(text="")
         
-        # Update UI
+        if self.session_replaced:
+            self.connection_lost("You logged in from another window, so this one was disconnected.")
+            return
+        # Only servers that issue session tokens say when a session was replaced
+        if self.session_token and not self.reconnecting:
+            self.reconnecting = True
+            self.window.title(f"ChatX - {self.username} (Reconnecting)")
+            self.status_label.config(text="Reconnecting...", fg='#FFC107')
+            self.add_message_to_history(self.current_chat, "✗ Connection lost, reconnecting...", 'system')
+            threading.Thread(target=self.reconnect, daemon=True).start()
+            return
+        self.connection_lost()
+    
+    def reconnect(self):
+        # Runs on its own thread: back off and retry until back in or refused.
+        # Only the token is tried; the password is not kept to fall back on
+        from auth_service import AuthService
+        auth_service = AuthService()
+        success, sock, message = auth_service.reconnect(
+            self.server_ip, self.server_port, self.username, None,
+            self.session_token, self.last_message_id, lambda: self.reconnecting
+        )
+        self.post(self.finish_reconnect, auth_service, success, sock, message)
+    
+    def finish_reconnect(self, auth_service, success, sock, message):
+        if not self.reconnecting:
+            # Cancelled meanwhile (Disconnect, Connect or closing the window)
+            if sock:
+                sock.close()
+            return
+        self.reconnecting = False
+        if success:
+            self.start_session(auth_service, sock)
+            self.add_message_to_history(self.current_chat, "✓ Reconnected", 'system')
+            return
+        self.add_message_to_history(self.current_chat, f"✗ Reconnect failed: {message}", 'system')
+        if auth_service.rejected and message != AUTH_BUSY:
+            self.connection_lost("Your session could not be resumed. Please connect and log in again.")
+        else:
+            self.connection_lost()
+    
+    def stop_reconnecting(self):
+        # Give up on the background reconnect (the thread notices between tries)
+        self.reconnecting = False
+        self.window.title(f"ChatX - {self.username} (Disconnected)")
+        self.status_label.config(text="Disconnected", fg='#DC3545')
+        self.connect_button.config(state=tk.NORMAL)
+        self.disconnect_button.config(state=tk.DISABLED)
+    
+    def connection_lost(self, reason="Your connection to the server was lost."):
+        # Back to the disconnected state; the user reconnects by hand
         self.window.title(f"ChatX - {self.username} (Disconnected)")
         self.status_label.config(text="Connection lost", fg='#DC3545')
         self.connect_button.config(state=tk.NORMAL)
         self.disconnect_button.config(state=tk.DISABLED)
         self.send_button.config(state=tk.DISABLED)
+        self.older_button.config(state=tk.DISABLED)
         
-        self.display_message("✗ Connection lost", 'system')
+        self.add_message_to_history(self.current_chat, "✗ Connection lost", 'system')
         
-        messagebox.showwarning("Connection Lost", "Your connection to the server was lost.")
+        messagebox.showwarning("Connection Lost", reason)
     
     def on_closing(self):
         # Handle window close
+        self.reconnecting = False
         if self.connected:
             self.disconnect_from_server()
         
@@ -0,0 +1,240 @@
+import abc
+import asyncio
+import queue
+import socket
+import threading
+import time
+
+from protocol import FLAG_GROUP_KEY, LEGACY_VERSION
+
+class SendQueuePolicy:
+    """Slow-consumer limits applied to every client's outbound queue.
+
+    Once a queue holds `drop_typing_depth` frames, droppable frames (typing
+    indicators) are discarded. Once it reaches `max_depth` the client is
+    disconnected instead of letting its backlog grow without bound.
+    """
+    SEND = 'send'
+    DROP = 'drop'
+    DISCONNECT = 'disconnect'
+
+    def __init__(self, max_depth=1024, drop_typing_depth=64):
+        self.max_depth = max_depth
+        self.drop_typing_depth = min(drop_typing_depth, max_depth)
+
+    def admit(self, depth, droppable=False):
+        # Decide what to do with a new frame given the current queue depth
+        if depth >= self.max_depth:
+            return self.DISCONNECT
+        if droppable and depth >= self.drop_typing_depth:
+            return self.DROP
+        return self.SEND
+
+class ClientConnection(abc.ABC):
+    """Outbound side of one client: a bounded queue drained by its own writer.
+
+    `send` only enqueues, so broadcasts never wait on a slow receiver.
+    Subclasses provide the queue and the writer for each server engine.
+    """
+    def __init__(self, username, address, policy=None):
+        self.username = username
+        self.address = address
+        self.policy = policy or SendQueuePolicy()
+        self.features = set()  # optional protocol features the client supports
+        self.protocol_version = LEGACY_VERSION  # wire format negotiated at connect
+        self.cipher = None        # session cipher for this client's own frames
+        self.group_cipher = None  # shared cipher for broadcasts, if negotiated
+        self.closed = False
+        self.ending = False  # closing once the queue is written (see end)
+        self.last_received = time.monotonic()  # stamped by the engine on every read
+        self.sent_frames = 0
+        self.dropped_frames = 0
+        self.peak_depth = 0
+
+    @property
+    @abc.abstractmethod
+    def queue_depth(self):
+        """Frames queued and not yet written"""
+
+    def send(self, data, droppable=False):
+        """Queue one encoded frame; returns False if it was dropped"""
+        if self.closed:
+            raise ConnectionError("Connection closed")
+
+        depth = self.queue_depth
+        action = self.policy.admit(depth, droppable)
+        if action == SendQueuePolicy.DROP:
+            self.dropped_frames += 1
+            return False
+        if action == SendQueuePolicy.DISCONNECT:
+            print(f"[SERVER] Disconnecting slow client {self.username} ({depth} frames queued)")
+            self.dropped_frames += 1
+            self.close()
+            return False
+
+        if depth >= self.peak_depth:
+            self.peak_depth = depth + 1
+        self._enqueue(data)
+        return True
+
+    def end(self, frame):
+        """Queue a last frame, then close once everything queued is written"""
+        if self.closed or self.ending:
+            return
+        self.ending = True
+        if self.send_frame(frame):
+            self._enqueue(None)
+
+    def frame_bytes(self, frame):
+        # Broadcasts use the group cipher when the client has one
+        if frame.shared and self.group_cipher is not None:
+            return frame.encode(self.protocol_version, self.group_cipher, FLAG_GROUP_KEY)
+        return frame.encode(self.protocol_version, self.cipher)
+
+    def send_frame(self, frame):
+        """Queue a Frame encoded for this client's wire format and cipher"""
+        return self.send(self.frame_bytes(frame), frame.droppable)
+
+    def write_frame(self, frame):
+        """Write a Frame immediately, bypassing the queue (before start only)"""
+        self.write_direct(self.frame_bytes(frame))
+
+    def metrics(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'peak_depth': self.peak_depth,
+            'sent_frames': self.sent_frames,
+            'dropped_frames': self.dropped_frames,
+        }
+
+    @abc.abstractmethod
+    def _enqueue(self, data):
+        """Put encoded bytes, or None to close after the queue drains, on the queue"""
+
+    @abc.abstractmethod
+    def start(self):
+        """Start draining the queue (frames queued before this are kept)"""
+
+    @abc.abstractmethod
+    def write_direct(self, data):
+        """Write to the socket immediately, bypassing the queue (before start only)"""
+
+    @abc.abstractmethod
+    def close(self):
+        """Close the socket and stop the writer"""
+
+class ThreadedConnection(ClientConnection):
+    """Client connection drained by a dedicated writer thread"""
+    def __init__(self, sock, username, address, policy=None):
+        super().__init__(username, address, policy)
+        self.sock = sock
+        self.queue = queue.SimpleQueue()
+        self.writer_thread = None
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def _enqueue(self, data):
+        self.queue.put(data)
+
+    def start(self):
+        self.writer_thread = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer_thread.start()
+
+    def writer_loop(self):
+        # Drain the queue into the socket until closed
+        try:
+            while True:
+                data = self.queue.get()
+                if data is None or self.closed:
+                    break
+                self.sock.sendall(data)
+                self.sent_frames += 1
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def write_direct(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        # shutdown() also wakes a writer blocked in sendall() and the
+        # handler thread blocked in recv()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+class AsyncConnection(ClientConnection):
+    """Client connection drained by a writer task on the server's event loop.
+
+    `send` and `close` may be called from other threads; they are handed
+    over to the loop.
+    """
+    def __init__(self, writer, loop, username, address, policy=None):
+        super().__init__(username, address, policy)
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.queue = asyncio.Queue()
+        self.writer_task = None
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize()
+
+    def _call(self, func, *args):
+        if threading.get_ident() == self.loop_thread:
+            func(*args)
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(func, *args)
+
+    def _enqueue(self, data):
+        self._call(self.queue.put_nowait, data)
+
+    def start(self):
+        self.writer_task = self.loop.create_task(self.writer_loop())
+
+    async def writer_loop(self):
+        # Write everything that is queued, then wait for the socket to drain
+        try:
+            while True:
+                data = await self.queue.get()
+                if data is None or self.closed:
+                    break
+                self.writer.write(data)
+                self.sent_frames += 1
+                while not self.queue.empty():
+                    data = self.queue.get_nowait()
+                    if data is None or self.closed:
+                        return
+                    self.writer.write(data)
+                    self.sent_frames += 1
+                await self.writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.close()
+
+    def write_direct(self, data):
+        self._call(self.writer.write, data)
+
+    def _abort(self):
+        self.queue.put_nowait(None)
+        if self.ending:
+            # Let the transport flush the last frames before it closes
+            self.writer.transport.close()
+        else:
+            self.writer.transport.abort()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self._call(self._abort)
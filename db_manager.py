@@ -1,92 +1,220 @@
+import os
 import sqlite3
-import hashlib
+import queue
+import threading
+from contextlib import contextmanager
 from datetime import datetime
 
+from metrics import REGISTRY, timed
+from passwords import hash_password, verify_password
+
+# SQL is kept in constants so every pooled connection reuses the same
+# prepared statements from its statement cache
+SQL_FIND_USER = 'SELECT username FROM users WHERE username = ?'
+SQL_INSERT_USER = 'INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)'
+SQL_GET_PASSWORD_HASH = 'SELECT password_hash FROM users WHERE username = ?'
+# Only replaces the hash that was verified, in case it changed meanwhile
+SQL_UPDATE_PASSWORD_HASH = 'UPDATE users SET password_hash = ? WHERE username = ? AND password_hash = ?'
+SQL_INSERT_SECRET = 'INSERT OR IGNORE INTO server_secrets (name, value) VALUES (?, ?)'
+SQL_GET_SECRET = 'SELECT value FROM server_secrets WHERE name = ?'
+SQL_INSERT_MESSAGE = 'INSERT INTO messages (sender, receiver, message, timestamp) VALUES (?, ?, ?, ?)'
+SQL_LAST_ID = 'SELECT last_insert_rowid()'
+SQL_USER_MESSAGES = (
+    'SELECT sender, receiver, message, timestamp FROM messages '
+    'WHERE receiver = ? OR sender = ? OR receiver = "ALL" ORDER BY id'
+)
+SQL_CONVERSATION_PARTNERS = (
+    'SELECT receiver FROM messages WHERE sender = ? AND receiver != "ALL" AND id > ? '
+    'UNION SELECT sender FROM messages WHERE receiver = ? AND id > ?'
+)
+# Pages hold the messages between two ids: before_id walks back through a
+# conversation, after_id stops at what a resuming client already has
+SQL_PUBLIC_PAGE = (
+    'SELECT id, sender, receiver, message, timestamp FROM messages '
+    'WHERE receiver = "ALL" AND id < ? AND id > ? ORDER BY id DESC LIMIT ?'
+)
+# Each direction walks the (receiver, id) index backwards on its own and is
+# limited before merging, so a page never sorts a user's whole history
+SQL_PRIVATE_PAGE = (
+    'SELECT * FROM (SELECT id, sender, receiver, message, timestamp FROM messages '
+    'WHERE receiver = ? AND sender = ? AND id < ? AND id > ? ORDER BY id DESC LIMIT ?) '
+    'UNION ALL '
+    'SELECT * FROM (SELECT id, sender, receiver, message, timestamp FROM messages '
+    'WHERE receiver = ? AND sender = ? AND id < ? AND id > ? ORDER BY id DESC LIMIT ?) '
+    'ORDER BY id DESC LIMIT ?'
+)
+
+# Cursor meaning "start from the newest message"
+NEWEST = 2 ** 63 - 1
+
+class ConnectionPool:
+    """Thread-safe pool of persistent SQLite connections.
+
+    Connections are opened lazily up to `size`, switched to WAL journaling
+    and handed out one thread at a time. Threads block when all of them
+    are in use.
+    """
+    def __init__(self, db_name, size=8, synchronous='NORMAL', cached_statements=128):
+        self.db_name = db_name
+        self.size = size
+        self.synchronous = synchronous
+        self.cached_statements = cached_statements
+        self.idle = queue.LifoQueue()
+        self.opened = []
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def open_connection(self):
+        conn = sqlite3.connect(
+            self.db_name, timeout=10, check_same_thread=False,
+            cached_statements=self.cached_statements
+        )
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute(f'PRAGMA synchronous={self.synchronous}')
+        return conn
+
+    def acquire(self):
+        if self.closed:
+            raise sqlite3.ProgrammingError("Connection pool is closed")
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            if len(self.opened) < self.size:
+                conn = self.open_connection()
+                self.opened.append(conn)
+                return conn
+        return self.idle.get()
+
+    def release(self, conn):
+        if self.closed:
+            conn.close()
+        else:
+            self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection; commits on success and rolls back on error"""
+        conn = self.acquire()
+        try:
+            with conn:
+                yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """Close every connection; ones still borrowed close on release"""
+        with self.lock:
+            self.closed = True
+            opened, self.opened = self.opened, []
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+        return len(opened)
+
+# Latency of every DBManager call, by method name
+DB_SECONDS = REGISTRY.histogram('chatx_db_seconds', "DBManager call latency", ('method',))
+
 class DBManager:
-    def __init__(self, db_name='chat_database.db'):
+    def __init__(self, db_name='chat_database.db', pool_size=8, synchronous='NORMAL'):
         self.db_name = db_name
+        self.pool = ConnectionPool(db_name, pool_size, synchronous)
         self.init_database()
 
     def init_database(self):
         """Initialize database with required tables"""
         # Create tables if not exist
-        import os
         print(f"[DB] Initializing database at {os.path.abspath(self.db_name)}")
-        conn = sqlite3.connect(self.db_name, check_same_thread=False)
-        cursor = conn.cursor()
-        
-        # Users table for authentication
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at TEXT NOT NULL
-            )
-        ''')
-        
-        # Messages table
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                sender TEXT NOT NULL,
-                receiver TEXT NOT NULL,
-                message TEXT NOT NULL,
-                timestamp TEXT NOT NULL
-            )
-        ''')
-        conn.commit()
-        conn.close()
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+
+            # Users table for authentication
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            ''')
+
+            # Messages table
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sender TEXT NOT NULL,
+                    receiver TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    timestamp TEXT NOT NULL
+                )
+            ''')
+
+            # Keys every server using this database shares (session tokens)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS server_secrets (
+                    name TEXT PRIMARY KEY,
+                    value BLOB NOT NULL
+                )
+            ''')
+
+            # History paging walks these backwards from a message id
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_receiver_id ON messages (receiver, id)')
+            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_sender_id ON messages (sender, id)')
+
+    def close(self):
+        """Close pooled connections (called when the server stops)"""
+        closed = self.pool.close()
+        print(f"[DB] Closed {closed} database connection(s)")
 
     def hash_password(self, password):
-        """Hash password using SHA-256"""
-        return hashlib.sha256(password.encode()).hexdigest()
+        """Hash password with salted scrypt (see passwords.py)"""
+        return hash_password(password)
 
+    @timed(DB_SECONDS)
     def register_user(self, username, password):
         """Register a new user"""
         try:
             print(f"[DB] Attempting to register user: '{username}'")
-            conn = sqlite3.connect(self.db_name, check_same_thread=False)
-            cursor = conn.cursor()
-            
-            # Check if username exists
-            cursor.execute('SELECT username FROM users WHERE username = ?', (username,))
-            if cursor.fetchone():
-                print(f"[DB] Username '{username}' already exists")
-                conn.close()
-                return False, "Username already exists"
-            
-            # Create new user
+            with self.pool.connection() as conn:
+                # Check if username exists
+                if conn.execute(SQL_FIND_USER, (username,)).fetchone():
+                    print(f"[DB] Username '{username}' already exists")
+                    return False, "Username already exists"
+
+            # Hash without holding a pooled connection; the KDF is slow on purpose
             password_hash = self.hash_password(password)
             created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            cursor.execute(
-                'INSERT INTO users (username, password_hash, created_at) VALUES (?, ?, ?)',
-                (username, password_hash, created_at)
-            )
-            conn.commit()
+            with self.pool.connection() as conn:
+                conn.execute(SQL_INSERT_USER, (username, password_hash, created_at))
             print(f"[DB] User '{username}' registered successfully")
-            conn.close()
             return True, "Registration successful"
+        except sqlite3.IntegrityError:
+            print(f"[DB] Username '{username}' already exists")
+            return False, "Username already exists"
         except Exception as e:
             print(f"[DB] Registration error: {e}")
             return False, "Registration failed"
 
+    @timed(DB_SECONDS)
     def authenticate_user(self, username, password):
-        """Authenticate a user"""
+        """Authenticate a user, upgrading a legacy or outdated password hash"""
         try:
             print(f"[DB] Authenticating user: '{username}'")
-            conn = sqlite3.connect(self.db_name, check_same_thread=False)
-            cursor = conn.cursor()
-            
-            password_hash = self.hash_password(password)
-            cursor.execute(
-                'SELECT username FROM users WHERE username = ? AND password_hash = ?',
-                (username, password_hash)
-            )
-            user = cursor.fetchone()
-            conn.close()
-            
-            if user:
+            with self.pool.connection() as conn:
+                row = conn.execute(SQL_GET_PASSWORD_HASH, (username,)).fetchone()
+
+            matches, needs_rehash = verify_password(password, row[0]) if row else (False, False)
+            if matches:
+                if needs_rehash:
+                    # Transparent migration: store a fresh hash while the password is at hand
+                    password_hash = self.hash_password(password)
+                    with self.pool.connection() as conn:
+                        conn.execute(SQL_UPDATE_PASSWORD_HASH, (password_hash, username, row[0]))
+                    print(f"[DB] Upgraded password hash for '{username}'")
                 print(f"[DB] User '{username}' logged in successfully")
                 return True, "Login successful"
             else:
@@ -96,32 +224,96 @@ class DBManager:
             print(f"[DB] Authentication error: {e}")
             return False, "Authentication failed"
 
+    @timed(DB_SECONDS)
+    def get_secret(self, name, size=32):
+        """Random key stored under `name`, created on first use.
+
+        Survives restarts and is the same for every server process sharing
+        this database.
+        """
+        with self.pool.connection() as conn:
+            conn.execute(SQL_INSERT_SECRET, (name, os.urandom(size)))
+            return conn.execute(SQL_GET_SECRET, (name,)).fetchone()[0]
+
+    @timed(DB_SECONDS)
     def save_message(self, sender, receiver, message, timestamp):
         """Save message to database"""
         try:
-            conn = sqlite3.connect(self.db_name, check_same_thread=False)
-            cursor = conn.cursor()
-            cursor.execute(
-                'INSERT INTO messages (sender, receiver, message, timestamp) VALUES (?, ?, ?, ?)',
-                (sender, receiver, message, timestamp)
-            )
-            conn.commit()
-            conn.close()
+            with self.pool.connection() as conn:
+                conn.execute(SQL_INSERT_MESSAGE, (sender, receiver, message, timestamp))
         except Exception as e:
             print(f"Database save error: {e}")
 
+    @timed(DB_SECONDS)
+    def save_messages(self, rows):
+        """Save a batch of (sender, receiver, message, timestamp) rows in one
+        transaction; returns their message ids, in order"""
+        with self.pool.connection() as conn:
+            conn.executemany(SQL_INSERT_MESSAGE, rows)
+            last_id = conn.execute(SQL_LAST_ID).fetchone()[0]
+        # The transaction holds the write lock throughout, so the ids are consecutive
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
+    @timed(DB_SECONDS)
+    def get_history_page(self, username, chat_id, before_id=None, limit=50, after_id=0):
+        """Retrieve one page of a conversation, walking back from before_id.
+
+        `chat_id` is "ALL" for the public chat or the other user's name.
+        Only messages newer than after_id are considered. Returns (rows,
+        has_more) where rows are (id, sender, receiver, message, timestamp)
+        tuples, oldest first.
+        """
+        before_id = before_id or NEWEST
+        try:
+            with self.pool.connection() as conn:
+                if chat_id == "ALL":
+                    rows = conn.execute(SQL_PUBLIC_PAGE, (before_id, after_id, limit + 1)).fetchall()
+                else:
+                    rows = conn.execute(
+                        SQL_PRIVATE_PAGE,
+                        (chat_id, username, before_id, after_id, limit + 1,
+                         username, chat_id, before_id, after_id, limit + 1, limit + 1)
+                    ).fetchall()
+        except Exception as e:
+            print(f"Database retrieve error: {e}")
+            return [], False
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, has_more
+
+    @timed(DB_SECONDS)
+    def get_recent_history(self, username, limit=50, after_id=0):
+        """Latest page of every conversation a user takes part in.
+
+        Returns {chat_id: (rows, has_more)} for the public chat and each
+        private conversation, as in get_history_page. With after_id only
+        messages newer than it count, and conversations without any are
+        left out (the public chat included).
+        """
+        try:
+            with self.pool.connection() as conn:
+                partners = [row[0] for row in conn.execute(
+                    SQL_CONVERSATION_PARTNERS, (username, after_id, username, after_id)
+                )]
+        except Exception as e:
+            print(f"Database retrieve error: {e}")
+            partners = []
+
+        history = {"ALL": self.get_history_page(username, "ALL", limit=limit, after_id=after_id)}
+        for partner in partners:
+            history[partner] = self.get_history_page(username, partner, limit=limit, after_id=after_id)
+        if after_id:
+            history = {chat_id: page for chat_id, page in history.items() if page[0]}
+        return history
+
+    @timed(DB_SECONDS)
     def get_previous_messages(self, username):
         """Retrieve previous messages for a user"""
         try:
-            conn = sqlite3.connect(self.db_name, check_same_thread=False)
-            cursor = conn.cursor()
-            cursor.execute(
-                'SELECT sender, receiver, message, timestamp FROM messages WHERE receiver = ? OR sender = ? OR receiver = "ALL" ORDER BY id',
-                (username, username)
-            )
-            messages = cursor.fetchall()
-            conn.close()
-            return messages
+            with self.pool.connection() as conn:
+                return conn.execute(SQL_USER_MESSAGES, (username, username)).fetchall()
         except Exception as e:
             print(f"Database retrieve error: {e}")
             return []
@@ -0,0 +1,216 @@
+import asyncio
+import ipaddress
+import socket
+import threading
+import time
+
+# UDP beacon: a client sends DISCOVERY_REQUEST to the discovery port by
+# broadcast and multicast, every server answers
+# DISCOVERY_REPLY<chat port>|name=value|... with its load metrics.
+# HEALTH_REQUEST, sent to one server, is answered the same way with
+# HEALTH_REPLY; neither touches the chat port or a handler thread.
+DISCOVERY_PORT = 5556
+DISCOVERY_GROUP = '239.255.43.21'  # administratively scoped multicast
+DISCOVERY_REQUEST = b"CHATX_DISCOVER"
+DISCOVERY_REPLY = b"CHATX_SERVER|"
+HEALTH_REQUEST = b"CHATX_HEALTH"
+HEALTH_REPLY = b"CHATX_HEALTH|"
+
+# TCP scan limits
+SCAN_CONCURRENCY = 256
+SCAN_MAX_HOSTS = 4096
+
+def format_reply(prefix, chat_port, metrics):
+    fields = [str(chat_port)] + [f"{name}={value}" for name, value in metrics.items()]
+    return prefix + '|'.join(fields).encode()
+
+def parse_reply(data, prefix):
+    """(chat port, metrics) from a beacon reply, or None if it is not one"""
+    if not data.startswith(prefix):
+        return None
+    fields = data[len(prefix):].decode(errors='replace').split('|')
+    try:
+        chat_port = int(fields[0])
+    except ValueError:
+        return None
+    metrics = {}
+    for field in fields[1:]:
+        name, _, value = field.partition('=')
+        try:
+            metrics[name] = int(value)
+        except ValueError:
+            metrics[name] = value
+    return chat_port, metrics
+
+def load_key(metrics):
+    # Least-loaded first: fewest connected users, then shortest queues
+    return (metrics.get('users', 0), metrics.get('queue', 0))
+
+class DiscoveryBeacon:
+    """Answers UDP discovery and health requests, on one thread.
+
+    Listens on `port` for broadcasts and, where the platform allows it,
+    for DISCOVERY_GROUP multicasts, so clients find the server without
+    opening TCP connections to every address of the LAN. Replies carry the
+    chat port and whatever `health()` returns (a dict of load metrics).
+    """
+    def __init__(self, chat_port, port=DISCOVERY_PORT, host='', health=None):
+        self.chat_port = chat_port
+        self.health = health
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        try:
+            membership = socket.inet_aton(DISCOVERY_GROUP) + socket.inet_aton('0.0.0.0')
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError:
+            pass  # no multicast route; broadcasts still work
+        self.sock.settimeout(1.0)  # to notice close()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="chatx-discovery", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.running:
+            try:
+                data, address = self.sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            request = data.strip()
+            if request == DISCOVERY_REQUEST:
+                prefix = DISCOVERY_REPLY
+            elif request == HEALTH_REQUEST:
+                prefix = HEALTH_REPLY
+            else:
+                continue
+            try:
+                metrics = self.health() if self.health else {}
+            except Exception as e:
+                print(f"[SERVER] Health metrics failed: {e}")
+                metrics = {}
+            try:
+                self.sock.sendto(format_reply(prefix, self.chat_port, metrics), address)
+            except OSError:
+                pass
+
+    def close(self):
+        self.running = False
+        self.thread.join(timeout=2)
+        self.sock.close()
+
+def beacon_query(port=DISCOVERY_PORT, timeout=0.5, targets=(), settle=None):
+    """Servers that answer a discovery request, as (host, chat port, metrics).
+
+    The request goes to the limited broadcast address, the discovery
+    multicast group, loopback and any extra `targets` (e.g. subnet
+    broadcast addresses). Waits up to `timeout`, or only `settle` seconds
+    more once the first server answered.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    servers = []
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        for target in ('255.255.255.255', DISCOVERY_GROUP, '127.0.0.1', *targets):
+            try:
+                sock.sendto(DISCOVERY_REQUEST, (target, port))
+            except OSError:
+                pass  # unreachable target, e.g. no broadcast route
+
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                data, (host, _) = sock.recvfrom(512)
+            except (socket.timeout, OSError):
+                break
+            reply = parse_reply(data, DISCOVERY_REPLY)
+            if reply is None or any(s[:2] == (host, reply[0]) for s in servers):
+                continue
+            servers.append((host, *reply))
+            if settle is not None and len(servers) == 1:
+                deadline = min(deadline, time.monotonic() + settle)
+    finally:
+        sock.close()
+    return servers
+
+def health_check(host, port=DISCOVERY_PORT, timeout=0.5):
+    """Load metrics of the server at `host` (with 'port', its chat port), or None"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.sendto(HEALTH_REQUEST, (host, port))
+            data = sock.recv(512)
+        except OSError:
+            return None
+    reply = parse_reply(data, HEALTH_REPLY)
+    if reply is None:
+        return None
+    chat_port, metrics = reply
+    return dict(metrics, port=chat_port)
+
+def scan_hosts(hosts, port, timeout=0.5, concurrency=SCAN_CONCURRENCY):
+    """First of `hosts` accepting a TCP connection on `port`, or None.
+
+    Probes run concurrently on an event loop (at most `concurrency` open
+    at once), so a whole /24 takes about one `timeout` instead of 254.
+    """
+    return asyncio.run(_scan_hosts(list(hosts), port, timeout, concurrency))
+
+async def _scan_hosts(hosts, port, timeout, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def probe(host):
+        async with semaphore:
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+            except (OSError, asyncio.TimeoutError):
+                return None
+            writer.close()
+            return host
+
+    tasks = [asyncio.ensure_future(probe(host)) for host in hosts]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            host = await next_done
+            if host:
+                return host
+        return None
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def network_hosts(networks, max_hosts=SCAN_MAX_HOSTS):
+    """Host addresses of CIDR strings like '192.168.1.0/24', at most max_hosts"""
+    hosts = []
+    for network in networks:
+        for address in ipaddress.ip_network(network, strict=False).hosts():
+            if len(hosts) >= max_hosts:
+                return hosts
+            hosts.append(str(address))
+    return hosts
+
+def find_server(port, networks, local_ips=(), beacon_port=DISCOVERY_PORT, timeout=0.5, settle=0.1):
+    """Locate a chat server: (host, port) or None.
+
+    Asks by UDP beacon first and picks the least-loaded server among those
+    answering within `settle` seconds of the first; if nobody answers,
+    probes `local_ips` and every host of `networks` over TCP on `port`,
+    all at once.
+    """
+    targets = [str(ipaddress.ip_network(network, strict=False).broadcast_address) for network in networks]
+    if beacon_port:
+        servers = beacon_query(beacon_port, timeout, targets, settle)
+        if servers:
+            host, chat_port, metrics = min(servers, key=lambda server: load_key(server[2]))
+            return host, chat_port
+
+    hosts = list(dict.fromkeys(['127.0.0.1', *local_ips, *network_hosts(networks)]))
+    host = scan_hosts(hosts, port, timeout)
+    return (host, port) if host else None
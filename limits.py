@@ -0,0 +1,88 @@
+import collections
+import threading
+import time
+
+class RateLimiter:
+    """Token buckets keyed by user or address.
+
+    Each key may spend `burst` tokens at once and earns `rate` tokens per
+    second back. A bucket is two floats in a dict, refilled lazily when
+    used, so idle keys cost nothing but memory; at most `max_keys` are
+    kept and the least recently used go first (a bucket idle that long
+    would be full anyway).
+    """
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_keys = max_keys
+        self.buckets = collections.OrderedDict()  # key: [tokens, updated at]
+        self.lock = threading.Lock()
+
+    def take(self, key, cost=1.0):
+        """Spend `cost` tokens from key's bucket.
+
+        Returns 0.0 when allowed, otherwise the seconds until enough
+        tokens are back (and nothing is spent).
+        """
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [self.burst, now]
+                while len(self.buckets) > self.max_keys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0.0
+            return (cost - bucket[0]) / self.rate if self.rate > 0 else float('inf')
+
+    def give_back(self, key, cost=1.0):
+        # Undo a take() whose frame was refused by another limiter
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + cost)
+
+class ConnectionLimiter:
+    """Admission control for new connections.
+
+    At most `max_connections` client sockets are open at once, and at most
+    `max_handshakes` of them may still be authenticating, so idle or slow
+    AUTH handshakes cannot hold every slot. admit() is called as a
+    connection is accepted, authenticated() once its AUTH succeeds and
+    release() when it closes. None disables a limit.
+    """
+    CONNECTIONS = 'connections'
+    HANDSHAKES = 'handshakes'
+
+    def __init__(self, max_connections=10000, max_handshakes=256):
+        self.max_connections = max_connections
+        self.max_handshakes = max_handshakes
+        self.connections = 0
+        self.handshakes = 0
+        self.lock = threading.Lock()
+
+    def admit(self):
+        """Count a new connection; returns None, or the limit it would exceed"""
+        with self.lock:
+            if self.max_connections is not None and self.connections >= self.max_connections:
+                return self.CONNECTIONS
+            if self.max_handshakes is not None and self.handshakes >= self.max_handshakes:
+                return self.HANDSHAKES
+            self.connections += 1
+            self.handshakes += 1
+            return None
+
+    def authenticated(self):
+        with self.lock:
+            self.handshakes -= 1
+
+    def release(self, authenticated):
+        with self.lock:
+            self.connections -= 1
+            if not authenticated:
+                self.handshakes -= 1
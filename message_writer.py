@@ -0,0 +1,121 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+# Durability modes: read a client's next frame as soon as its message is
+# queued, or only once the transaction containing it has committed. Either
+# way the message is routed after the commit, which assigns its id
+DURABILITY_MODES = ('queue', 'commit')
+
+_STOP = object()
+
+class MessageWriter:
+    """Background group-commit writer for chat messages.
+
+    `submit` queues a message and returns a Future of its message id that
+    completes when the batch containing it has been committed. A single
+    writer thread flushes the queue with one executemany transaction as
+    soon as nothing else is queued, or after `batch_size` messages or
+    `flush_interval` seconds while more keep arriving. Messages are only
+    routed once stored, so a quiet chat never waits out the interval.
+    `close` drains everything still queued before returning.
+    """
+    def __init__(self, db_manager, batch_size=200, flush_interval=0.05, durability='queue'):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.db_manager = db_manager
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.durability = durability
+        self.queue = queue.SimpleQueue()
+        self.closed = False
+        # Held while checking `closed` and queueing, so nothing is queued
+        # behind _STOP where the writer's final drain would miss it
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.written = 0
+        self.thread = threading.Thread(target=self.run, name="chatx-writer", daemon=True)
+        self.thread.start()
+
+    @property
+    def wait_for_commit(self):
+        return self.durability == 'commit'
+
+    @property
+    def pending(self):
+        return self.queue.qsize()
+
+    def submit(self, sender, receiver, message, timestamp):
+        """Queue one message for the next batch; returns a Future of its id"""
+        future = Future()
+        with self.lock:
+            if not self.closed:
+                self.queue.put(((sender, receiver, message, timestamp), future))
+                return future
+        future.set_exception(RuntimeError("Message writer is closed"))
+        return future
+
+    def run(self):
+        # Collect a batch, flush it, repeat until close() is called
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    # Nothing is delivered before its commit, so flush as
+                    # soon as the queue is empty
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self.flush(batch)
+
+        # Drain anything submitted before close()
+        batch = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                batch.append(item)
+        if batch:
+            self.flush(batch)
+
+    def flush(self, batch):
+        rows = [row for row, future in batch]
+        try:
+            message_ids = self.db_manager.save_messages(rows)
+        except Exception as e:
+            print(f"[DB] Batch write of {len(rows)} message(s) failed: {e}")
+            for row, future in batch:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.written += len(rows)
+        for (row, future), message_id in zip(batch, message_ids):
+            future.set_result(message_id)
+
+    def close(self):
+        """Stop accepting messages and wait until the queue is drained"""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(_STOP)
+        self.thread.join()
+        print(f"[DB] Message writer stopped after {self.written} message(s) in {self.batches} batch(es)")
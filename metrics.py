@@ -0,0 +1,283 @@
+import bisect
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Latency histogram buckets, in seconds (50us to 10s)
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 10.0,
+)
+
+class Counter:
+    """A value that only goes up"""
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+class Histogram:
+    """Counts observations into fixed buckets, plus their count and sum"""
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'lock')
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the duration of its block"""
+        return HistogramTimer(self)
+
+    def percentile(self, pct):
+        # Upper bound of the bucket holding the pct-th observation
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return 0.0
+        rank = count * pct / 100
+        seen = 0
+        for index, bucket_count in enumerate(counts):
+            seen += bucket_count
+            if seen >= rank:
+                return self.buckets[index] if index < len(self.buckets) else float('inf')
+        return float('inf')
+
+class HistogramTimer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+class Metric:
+    """A named metric: one Counter/Histogram per combination of label values.
+
+    Without labels the metric itself behaves as its only child, so
+    `metric.inc()` and `metric.observe(x)` work directly.
+    """
+    def __init__(self, kind, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.kind = kind  # 'counter' or 'histogram'
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.children = {}
+        self.lock = threading.Lock()
+        if not self.labelnames:
+            child = self.labels()
+            self.inc = getattr(child, 'inc', None)
+            self.observe = getattr(child, 'observe', None)
+            self.time = getattr(child, 'time', None)
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.get(values)
+                if child is None:
+                    child = Counter() if self.kind == 'counter' else Histogram(self.buckets)
+                    self.children[values] = child
+        return child
+
+class Gauge:
+    """A value read from `fn()` whenever metrics are collected.
+
+    With labelnames, `fn` returns {label value or tuple of values: value}.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn, labelnames=()):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.labelnames = tuple(labelnames)
+
+    def values(self):
+        try:
+            result = self.fn()
+        except Exception:
+            return []
+        if not self.labelnames:
+            return [((), result)]
+        return [(key if isinstance(key, tuple) else (key,), value) for key, value in result.items()]
+
+class Registry:
+    """The metrics of one process, rendered for the /metrics endpoint.
+
+    Registering an existing name returns the existing counter or histogram,
+    so every instance of a class shares its metrics; a gauge registered
+    again takes the new `fn` (the most recent server wins).
+    """
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, create):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = create()
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(name, lambda: Metric('counter', name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(name, lambda: Metric('histogram', name, help, labelnames, buckets))
+
+    def gauge(self, name, help, fn, labelnames=()):
+        gauge = Gauge(name, help, fn, labelnames)
+        with self.lock:
+            self.metrics[name] = gauge
+        return gauge
+
+    def collect(self):
+        # (metric, [(label values, Counter/Histogram/number)]) in name order
+        with self.lock:
+            metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+        for metric in metrics:
+            if isinstance(metric, Gauge):
+                yield metric, metric.values()
+            else:
+                yield metric, sorted(metric.children.items())
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric, samples in self.collect():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for values, sample in samples:
+                labels = format_labels(metric.labelnames, values)
+                if metric.kind == 'gauge':
+                    lines.append(f"{metric.name}{labels} {sample}")
+                elif metric.kind == 'counter':
+                    lines.append(f"{metric.name}{labels} {sample.value}")
+                else:
+                    cumulative = 0
+                    bounds = [*(str(bucket) for bucket in sample.buckets), '+Inf']
+                    for bound, count in zip(bounds, list(sample.counts)):
+                        cumulative += count
+                        bucket_labels = format_labels(metric.labelnames + ('le',), values + (bound,))
+                        lines.append(f"{metric.name}_bucket{bucket_labels} {cumulative}")
+                    lines.append(f"{metric.name}_sum{labels} {sample.sum}")
+                    lines.append(f"{metric.name}_count{labels} {sample.count}")
+        return '\n'.join(lines) + '\n'
+
+    def format_stats(self):
+        """A short human-readable summary (terminal 'stats' command)"""
+        lines = []
+        for metric, samples in self.collect():
+            for values, sample in samples:
+                name = metric.name + format_labels(metric.labelnames, values)
+                if metric.kind == 'gauge':
+                    lines.append(f"  {name} = {sample}")
+                elif metric.kind == 'counter':
+                    lines.append(f"  {name} = {sample.value}")
+                elif sample.count:
+                    lines.append(
+                        f"  {name}: n={sample.count} avg={sample.sum / sample.count * 1000:.3f}ms "
+                        f"p50<={sample.percentile(50) * 1000:g}ms p99<={sample.percentile(99) * 1000:g}ms"
+                    )
+        return '\n'.join(lines)
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = (f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+# Process-wide registry every module registers its metrics in
+REGISTRY = Registry()
+
+def timed(metric):
+    """Decorator observing each call's duration in metric.labels(<function name>)"""
+    def decorate(func):
+        histogram = metric.labels(func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+class TimedLock:
+    """A threading.Lock that records how long each holder kept it"""
+    __slots__ = ('lock', 'histogram', 'acquired_at')
+
+    def __init__(self, histogram):
+        self.lock = threading.Lock()
+        self.histogram = histogram
+        self.acquired_at = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        self.acquired_at = time.perf_counter()
+        return True
+
+    def release(self):
+        held = time.perf_counter() - self.acquired_at
+        self.lock.release()
+        self.histogram.observe(held)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes are not worth a log line
+
+def start_metrics_server(port, host='127.0.0.1', registry=REGISTRY):
+    """Serve `registry` at http://host:port/metrics on a background thread"""
+    handler = type('Handler', (MetricsHandler,), {'registry': registry})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name="chatx-metrics", daemon=True).start()
+    return httpd
@@ -0,0 +1,46 @@
+import base64
+import hashlib
+import hmac
+import os
+
+# scrypt cost: about 16 MB and tens of milliseconds per hash. Changing
+# these makes existing hashes rehash on their owner's next login.
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_SIZE = 16
+KEY_SIZE = 32
+
+# Stored format: scrypt$N$r$p$<base64 salt>$<base64 key>. Rows written
+# before the KDF hold a bare, unsalted SHA-256 hex digest.
+SCHEME = "scrypt"
+
+def hash_password(password, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P):
+    """Salted scrypt hash of a password, as stored in users.password_hash"""
+    salt = os.urandom(SALT_SIZE)
+    key = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=KEY_SIZE)
+    encoded = (base64.b64encode(part).decode() for part in (salt, key))
+    return f"{SCHEME}${n}${r}${p}${'$'.join(encoded)}"
+
+def legacy_hash(password):
+    # The original unsalted SHA-256 scheme
+    return hashlib.sha256(password.encode()).hexdigest()
+
+def verify_password(password, stored):
+    """Check a password against a stored hash.
+
+    Returns (matches, needs_rehash): needs_rehash is True for a matching
+    password stored with the legacy scheme or other scrypt costs, so the
+    caller can store a fresh hash while it has the plain password.
+    """
+    if not stored.startswith(SCHEME + "$"):
+        return hmac.compare_digest(legacy_hash(password), stored), True
+    try:
+        _, n, r, p, salt, key = stored.split('$')
+        n, r, p = int(n), int(r), int(p)
+        salt, key = base64.b64decode(salt), base64.b64decode(key)
+    except ValueError:
+        return False, False
+    candidate = hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, dklen=len(key))
+    matches = hmac.compare_digest(candidate, key)
+    return matches, matches and (n, r, p) != (SCRYPT_N, SCRYPT_R, SCRYPT_P)
@@ -0,0 +1,315 @@
+import json
+import struct
+import time
+import zlib
+
+from metrics import REGISTRY
+
+# Wire format versions. Version 1 is the original newline-delimited
+# base64 text; version 2 frames every message with a binary header.
+LEGACY_VERSION = 1
+PROTOCOL_VERSION = 2
+
+# Header: magic|version byte, frame type, flags, payload length.
+# The magic nibble is never valid base64 text, so the first byte a client
+# sends tells binary-framing clients apart from legacy ones.
+FRAME_MAGIC = 0xC0
+FRAME_HEADER = struct.Struct('!BBBI')
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+# Until a client authenticates it may only send small frames: an AUTH
+# request is a few hundred bytes
+MAX_AUTH_FRAME_SIZE = 4096
+
+# Frame types
+FRAME_MESSAGE = 1        # encrypted protocol text (AUTH, MSG, TYPING, ...)
+FRAME_HISTORY_BATCH = 2  # encrypted compressed history batch
+FRAME_HANDSHAKE = 3      # plaintext key exchange, before anything is encrypted
+
+# Frame flags
+FLAG_COMPRESSED = 0x01
+FLAG_GROUP_KEY = 0x02  # encrypted with the shared group key, not the session key
+
+# Optional protocol features a client can advertise in its AUTH request
+FEATURE_HISTORY_BATCH = "HISTORY_BATCH"
+FEATURE_PRESENCE_DELTAS = "PRESENCE_DELTAS"
+FEATURE_RESUME = "RESUME"  # SESSION tokens for AUTH|RESUME
+FEATURE_HEARTBEAT = "HEARTBEAT"  # answers PING with PONG
+FEATURE_PRIVATE_TYPING = "PRIVATE_TYPING"  # understands TYPING|user|status|PRIVATE
+FEATURE_MESSAGE_IDS = "MESSAGE_IDS"  # live messages as LIVE_MSG|ID|..., not MSG
+CLIENT_FEATURES = (FEATURE_HISTORY_BATCH, FEATURE_PRESENCE_DELTAS, FEATURE_RESUME, FEATURE_HEARTBEAT,
+                   FEATURE_PRIVATE_TYPING, FEATURE_MESSAGE_IDS)
+
+# AUTH_RESPONSE message when the server's auth pool refuses a request;
+# unlike other failures it is worth retrying
+AUTH_BUSY = "Server busy, please try again"
+
+# Server frames that slow-consumer policies may shed: typing indicators
+# and their THROTTLE replies, and presence deltas (the client notices the
+# sequence gap, at the latest from the PRESENCE_SEQ that follows, and resyncs)
+DROPPABLE_PREFIXES = ("TYPING|", "PRESENCE_JOIN|", "PRESENCE_LEAVE|", "THROTTLE|TYPING|")
+
+# Handshake frames: the client's HELLO|KEY_EXCHANGE, answered by
+# HELLO|CIPHER|SERVER_KEY|IDENTITY|SIGNATURE or ERROR|MESSAGE
+HANDSHAKE_HELLO = "HELLO"
+HANDSHAKE_ERROR = "ERROR"
+
+# Key exchange field: x25519:<base64 public key>:<ciphers by preference>
+KEY_EXCHANGE_X25519 = "x25519"
+
+# Binary frame carrying many history rows in one compressed payload
+HISTORY_BATCH_PREFIX = b"HISTORY_BATCH|"
+HISTORY_BATCH_ROWS = 1000
+
+# Time spent encrypting outbound frames (once per frame and cipher)
+ENCRYPT_SECONDS = REGISTRY.histogram('chatx_encrypt_seconds', "Outbound frame encryption time")
+
+class ProtocolError(Exception):
+    """Raised when a peer sends bytes that are not a valid frame"""
+
+def detect_version(first_bytes):
+    """Wire format used by a client, judged from the first bytes it sent"""
+    if first_bytes and first_bytes[0] & 0xF0 == FRAME_MAGIC:
+        return PROTOCOL_VERSION
+    return LEGACY_VERSION
+
+def encode_wire(token, version, frame_type=FRAME_MESSAGE, flags=0):
+    """Put an encrypted token on the wire in the given format"""
+    if version == LEGACY_VERSION:
+        return token + b'\n'
+    return FRAME_HEADER.pack(FRAME_MAGIC | version, frame_type, flags, len(token)) + token
+
+class FrameDecoder:
+    """Incremental frame parser for either wire format.
+
+    Bytes land in one bytearray between a read cursor
+    (`start`) and a write cursor (`end`). `recv_into` reads from a socket
+    straight into the free tail, `feed` copies bytes in for callers that
+    already hold them, and iterating takes complete frames off the read
+    cursor as (frame_type, flags, payload) tuples (`drain` takes them all
+    at once). Consumed space is
+    reclaimed by sliding the unread bytes to the front only when the tail
+    runs short, so a burst of frames costs one copy of each payload rather
+    than a copy of the whole remaining buffer per frame. Legacy framing
+    yields each newline-terminated line as a FRAME_MESSAGE.
+
+    The buffer is allocated on the first read, at `buffer_size` bytes, and
+    doubles only as bytes arrive; once it empties, a buffer grown past
+    IDLE_BUFFER_SIZE is given back. An idle connection therefore holds at
+    most a few KiB however large its last frame was.
+    """
+    IDLE_BUFFER_SIZE = 65536
+
+    def __init__(self, version=PROTOCOL_VERSION, max_frame_size=MAX_FRAME_SIZE,
+                 buffer_size=4096, read_size=4096):
+        self.version = version
+        self.max_frame_size = max_frame_size
+        self.buffer_size = buffer_size  # first allocation
+        self.read_size = read_size  # free space guaranteed before each recv_into
+        self.buffer = bytearray()
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.scanned = 0  # legacy: bytes after `start` already searched for a newline
+
+    @property
+    def pending(self):
+        return self.end - self.start
+
+    def reserve(self, size):
+        """Make room for `size` more bytes after the write cursor"""
+        if len(self.buffer) - self.end >= size:
+            return
+        pending = self.pending
+        if pending + size <= len(self.buffer):
+            # Compact: slide the unread bytes to the front
+            self.view[:pending] = self.view[self.start:self.end]
+        else:
+            # Grow by doubling, only as bytes actually arrive: a header
+            # announcing a large frame reserves nothing by itself, and a
+            # large frame still costs a handful of copies, not one per read
+            buffer = bytearray(max(len(self.buffer) * 2, pending + size, self.buffer_size))
+            buffer[:pending] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+        self.start = 0
+        self.end = pending
+
+    def feed(self, data):
+        self.reserve(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def recv_into(self, sock):
+        """Read once from a socket into the buffer; returns the byte count (0 at EOF)"""
+        self.reserve(self.read_size)
+        count = sock.recv_into(self.view[self.end:])
+        self.end += count
+        return count
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        frame = self.next_legacy() if self.version == LEGACY_VERSION else self.next_binary()
+        if frame is None:
+            raise StopIteration
+        return frame
+
+    def drain(self):
+        """Take every complete frame in the buffer at once, as a list.
+
+        Same frames as iterating, but parsed in one tight loop (legacy
+        lines with a single split), which is what the read loops use.
+        """
+        if self.version == LEGACY_VERSION:
+            last = self.buffer.rfind(b'\n', self.start + self.scanned, self.end)
+            if last < 0:
+                self.scanned = self.pending
+                if self.scanned > self.max_frame_size:
+                    raise ProtocolError("Line exceeds maximum frame size")
+                return []
+            lines = self.view[self.start:last].tobytes().split(b'\n')
+            self.consumed(last + 1)
+            return [(FRAME_MESSAGE, 0, line) for line in lines if line]
+
+        # Walk the headers to find where the complete frames end, then slice
+        # payloads out of one immutable snapshot of just those bytes (a
+        # partial frame behind them is never copied until it completes)
+        buffer, unpack, header_size = self.buffer, FRAME_HEADER.unpack_from, FRAME_HEADER.size
+        current = FRAME_MAGIC | PROTOCOL_VERSION
+        headers = []
+        position, end = self.start, self.end
+        while end - position >= header_size:
+            magic, frame_type, flags, length = unpack(buffer, position)
+            if magic != current and (magic & 0xF0 != FRAME_MAGIC or magic & 0x0F > PROTOCOL_VERSION):
+                raise ProtocolError(f"Bad frame header byte 0x{magic:02x}")
+            if length > self.max_frame_size:
+                raise ProtocolError(f"Frame of {length} bytes exceeds maximum size")
+            if end < position + header_size + length:
+                break
+            headers.append((frame_type, flags, length))
+            position += header_size + length
+
+        frames = []
+        if headers:
+            data = self.view[self.start:position].tobytes()
+            offset = 0
+            for frame_type, flags, length in headers:
+                body = offset + header_size
+                frames.append((frame_type, flags, data[body:body + length]))
+                offset = body + length
+            self.consumed(position)
+        return frames
+
+    def consumed(self, position):
+        # Advance the read cursor; rewind both cursors once the buffer is empty
+        self.start = position
+        self.scanned = 0
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.IDLE_BUFFER_SIZE:
+                self.buffer = bytearray()
+                self.view = memoryview(self.buffer)
+
+    def next_legacy(self):
+        while True:
+            end = self.buffer.find(b'\n', self.start + self.scanned, self.end)
+            if end < 0:
+                self.scanned = self.pending
+                if self.scanned > self.max_frame_size:
+                    raise ProtocolError("Line exceeds maximum frame size")
+                return None
+            payload = self.view[self.start:end].tobytes()
+            self.consumed(end + 1)
+            if payload:
+                return FRAME_MESSAGE, 0, payload
+
+    def next_binary(self):
+        if self.pending < FRAME_HEADER.size:
+            return None
+        magic, frame_type, flags, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        if magic & 0xF0 != FRAME_MAGIC or magic & 0x0F > PROTOCOL_VERSION:
+            raise ProtocolError(f"Bad frame header byte 0x{magic:02x}")
+        if length > self.max_frame_size:
+            raise ProtocolError(f"Frame of {length} bytes exceeds maximum size")
+
+        body = self.start + FRAME_HEADER.size
+        if self.end < body + length:
+            return None
+        payload = self.view[body:body + length].tobytes()
+        self.consumed(body + length)
+        return frame_type, flags, payload
+
+class Frame:
+    """A server-to-client message, serialized once and encrypted once per cipher.
+
+    Encryption happens on first use and each wire encoding is cached per
+    (protocol version, cipher), so every recipient sharing a cipher gets
+    the same immutable bytes. `shared` frames (broadcasts) are encrypted
+    with the recipients' group cipher, so a broadcast costs one encryption
+    per cipher in use rather than one per client; other frames use each
+    recipient's session cipher. `message` may be text or, for binary
+    frames such as HISTORY_BATCH, bytes.
+    """
+    __slots__ = ('message', 'payload', 'frame_type', 'flags', 'droppable', 'shared', 'wire')
+
+    def __init__(self, message, shared=False):
+        self.message = message
+        self.shared = shared
+        self.wire = {}
+        if isinstance(message, bytes):
+            self.payload = message
+            self.frame_type = FRAME_HISTORY_BATCH
+            self.flags = FLAG_COMPRESSED
+            self.droppable = False
+        else:
+            self.payload = message.encode()
+            self.frame_type = FRAME_MESSAGE
+            self.flags = 0
+            self.droppable = message.startswith(DROPPABLE_PREFIXES)
+
+    def encode(self, version, cipher, flags=0):
+        """Wire bytes for `version` encrypted with `cipher` (built once per pair)"""
+        key = (version, cipher)
+        data = self.wire.get(key)
+        if data is None:
+            start = time.perf_counter()
+            token = cipher.encrypt_bytes(self.payload)
+            ENCRYPT_SECONDS.observe(time.perf_counter() - start)
+            data = self.wire[key] = encode_wire(token, version, self.frame_type, self.flags | flags)
+        return data
+
+def format_key_exchange(public_key, ciphers):
+    """HELLO field offering an X25519 public key and the ciphers a client accepts"""
+    return f"{KEY_EXCHANGE_X25519}:{public_key}:{','.join(ciphers)}"
+
+def parse_key_exchange(field):
+    """Return (public_key, ciphers) from a HELLO key exchange field, or None"""
+    parts = field.split(':')
+    if len(parts) != 3 or parts[0] != KEY_EXCHANGE_X25519:
+        return None
+    return parts[1], [cipher for cipher in parts[2].split(',') if cipher]
+
+def hello_transcript(client_hello, server_hello):
+    """Bytes a server's identity key signs: the client's HELLO payload and
+    the server's HELLO|CIPHER|SERVER_KEY|IDENTITY, so neither key can be swapped"""
+    return b"chatx handshake\n" + client_hello + b"\n" + server_hello
+
+def parse_features(field):
+    """Parse the comma-separated feature list sent after the AUTH password"""
+    return {feature for feature in field.split(',') if feature}
+
+def pack_history_batch(rows, older=False):
+    """Pack (id, sender, receiver, message, timestamp) rows into a HISTORY_BATCH payload.
+
+    `older` marks a page answering a HISTORY request rather than the
+    login replay.
+    """
+    body = json.dumps({'older': older, 'messages': [list(row) for row in rows]},
+                      separators=(',', ':'))
+    return HISTORY_BATCH_PREFIX + zlib.compress(body.encode(), 6)
+
+def unpack_history_batch(payload):
+    """Return (older, rows) from a decrypted HISTORY_BATCH payload"""
+    body = json.loads(zlib.decompress(payload[len(HISTORY_BATCH_PREFIX):]))
+    return body['older'], body['messages']
@@ -1,21 +1,159 @@
 import socket
 import threading
+import time
 from datetime import datetime
-from encryption import MessageEncryption
+import base64
+import functools
+from concurrent.futures import Future
+from encryption import DEFAULT_CIPHERS, KeyExchange, MessageEncryption, ServerIdentity, SessionCipher
 from db_manager import DBManager
+from message_writer import DURABILITY_MODES, MessageWriter
+from connection import SendQueuePolicy, ThreadedConnection
+from timers import TimerQueue
+from typing_limiter import TypingLimiter
+from discovery import DISCOVERY_PORT, DiscoveryBeacon
+from metrics import REGISTRY, TimedLock, start_metrics_server
+from auth_pool import AuthPool
+from sessions import SessionTokens
+from limits import ConnectionLimiter, RateLimiter
+from heartbeat import IdleReaper, set_keepalive
+from bus import (
+    EVENT_DELIVER, EVENT_JOIN, EVENT_KICK, EVENT_LEAVE, EVENT_PRESENCE, EVENT_STOP, create_bus,
+)
+from protocol import (
+    AUTH_BUSY, FEATURE_HEARTBEAT, FEATURE_HISTORY_BATCH, FEATURE_MESSAGE_IDS, FEATURE_PRESENCE_DELTAS,
+    FEATURE_PRIVATE_TYPING, FEATURE_RESUME, FRAME_HANDSHAKE, FRAME_MESSAGE, HANDSHAKE_ERROR, HANDSHAKE_HELLO, HISTORY_BATCH_ROWS,
+    LEGACY_VERSION, MAX_AUTH_FRAME_SIZE, MAX_FRAME_SIZE, PROTOCOL_VERSION, Frame, FrameDecoder, ProtocolError,
+    detect_version, encode_wire, hello_transcript, pack_history_batch, parse_features, parse_key_exchange,
+)
+
+ENGINES = ('threaded', 'asyncio')
+
+# Requests AUTH accepts; RESUME carries a SESSION token instead of a password
+AUTH_TYPES = ("LOGIN", "REGISTER", "RESUME")
+
+# Server messages client_text() rewrites for clients without a feature
+ADAPTED_PREFIXES = ("TYPING|", "LIVE_MSG|")
+
+# Client message types counted by name; anything else counts as 'other'
+MESSAGE_TYPES = ('MSG', 'TYPING', 'HISTORY', 'PRESENCE_SYNC', 'PONG')
+
+CONNECTIONS = REGISTRY.counter('chatx_connections_total', "Client connections accepted")
+CONNECTIONS_REJECTED = REGISTRY.counter('chatx_connections_rejected_total',
+                                        "Connections closed on accept, by the limit they hit", ('reason',))
+THROTTLED = REGISTRY.counter('chatx_throttled_total', "Client frames refused by a rate limit", ('type', 'scope'))
+AUTH_REQUESTS = REGISTRY.counter('chatx_auth_total', "AUTH requests by type and result", ('type', 'result'))
+MESSAGES_RECEIVED = REGISTRY.counter('chatx_messages_received_total', "Client messages by type", ('type',))
+FRAME_SECONDS = REGISTRY.histogram('chatx_frame_seconds', "Time to handle one client frame")
+DECRYPT_SECONDS = REGISTRY.histogram('chatx_decrypt_seconds', "Inbound frame decryption time")
+FANOUT_SECONDS = REGISTRY.histogram('chatx_fanout_seconds', "Time to queue a message to its recipients", ('kind',))
+LOCK_SECONDS = REGISTRY.histogram('chatx_clients_lock_held_seconds', "Time clients_lock is held per acquisition")
+BROADCAST_FANOUT = FANOUT_SECONDS.labels('broadcast')
+PRIVATE_FANOUT = FANOUT_SECONDS.labels('private')
 
 class ChatServer:
-    def __init__(self, host='0.0.0.0', port=5555):
+    def __init__(self, host='0.0.0.0', port=5555, db_name='chat_database.db',
+                 send_queue_size=1024, typing_drop_depth=64,
+                 durability='queue', write_batch_size=200, write_flush_interval=0.05,
+                 history_page_size=50, ciphers=DEFAULT_CIPHERS, reuse_port=False, interactive=True,
+                 typing_interval=1.0, presence_check_delay=1.0, discovery_port=None, metrics_port=None,
+                 auth_workers=None, auth_queue=256,
+                 session_secret=None, session_ttl=24 * 3600, session_cache_size=10000, identity_secret=None,
+                 backlog=1024, max_connections=10000, max_handshakes=1024,
+                 message_limit=(5.0, 20), typing_limit=(5.0, 10),
+                 ip_message_limit=(100.0, 300), ip_typing_limit=(100.0, 300),
+                 heartbeat_interval=30.0, heartbeat_timeout=90.0, keepalive=(60, 10, 6)):
         self.host = host
         self.port = port
         self.server_socket = None
-        self.clients = {}  # username: socket
-        self.clients_lock = threading.Lock()
-        self.encryption = MessageEncryption()
+        self.clients = {}  # username: ClientConnection
+        self.clients_lock = TimedLock(LOCK_SECONDS)
+        self.reuse_port = reuse_port    # share the port with other workers (SO_REUSEPORT)
+        self.backlog = backlog          # pending connections the kernel holds for accept
+        self.interactive = interactive  # read stop/queues commands from the terminal
+        
+        # UDP discovery beacon (see discovery.py); None to run without one
+        self.discovery_port = discovery_port
+        self.beacon = None
+        
+        # Local Prometheus-format endpoint (see metrics.py); None for none
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.register_metrics()
+        
+        # Link to other servers of the same chat (see bus.py); users
+        # connected elsewhere are tracked as username: node
+        self.bus = None
+        self.remote_users = {}
+        
+        # Users clients have been told are online, and the sequence number
+        # of the last PRESENCE_JOIN/PRESENCE_LEAVE delta
+        self.online_users = set()
+        self.presence_seq = 0
+        
+        # Deltas may be shed for slow clients, so presence_check_delay
+        # seconds after a burst of them the current SEQ follows in a
+        # PRESENCE_SEQ frame that is never dropped (None turns it off)
+        self.presence_check_delay = presence_check_delay
+        self.presence_check = None
+        self.encryption = MessageEncryption()  # legacy clients' shared key
         self.running = False
         
+        # AEAD ciphers offered to binary-framing clients, with one group key
+        # per cipher so broadcasts are encrypted once for all of its users
+        self.ciphers = tuple(ciphers)
+        self.group_ciphers = {algorithm: SessionCipher.generate(algorithm) for algorithm in self.ciphers}
+        
+        # Outbound queue limits for slow receivers
+        self.send_policy = SendQueuePolicy(send_queue_size, typing_drop_depth)
+        
+        # Messages replayed per conversation on login and per HISTORY request
+        self.history_page_size = history_page_size
+        
+        # Typing indicators: at most one state change per user and chat
+        # every typing_interval seconds, flushed by a shared timer thread
+        self.timers = TimerQueue()
+        self.typing_limiter = TypingLimiter(self.send_typing, self.timers, typing_interval)
+        
+        # Heartbeat clients are pinged on the same timer thread and dropped
+        # when silent for heartbeat_timeout; TCP keepalive (idle, interval,
+        # count) catches dead peers among the others. None turns either off
+        self.reaper = IdleReaper(self.timers, heartbeat_interval, heartbeat_timeout) if heartbeat_interval else None
+        self.keepalive = keepalive
+        
+        # Password checks run on a bounded pool (the KDF is slow on purpose)
+        self.auth_pool = AuthPool(auth_workers, auth_queue)
+        
+        # Open sockets and unfinished AUTH handshakes beyond these limits
+        # are closed as soon as they are accepted
+        self.connection_limiter = ConnectionLimiter(max_connections, max_handshakes)
+        
+        # Token buckets on MSG and TYPING frames, per user and per client
+        # address: (rate per second, burst), or None for no limit
+        self.rate_limiters = {
+            "MSG": (make_rate_limiter(message_limit), make_rate_limiter(ip_message_limit)),
+            "TYPING": (make_rate_limiter(typing_limit), make_rate_limiter(ip_typing_limit)),
+        }
+        
         # Initialize database manager
-        self.db_manager = DBManager()
+        self.db_manager = DBManager(db_name)
+        
+        # Signed tokens let a reconnecting client skip the password check.
+        # The key defaults to one kept in the database, so tokens outlive a
+        # restart and every server sharing the database accepts them
+        self.sessions = SessionTokens(
+            session_secret or self.db_manager.get_secret('session'), session_ttl, session_cache_size
+        )
+        
+        # Ed25519 key signing the HELLO handshake; clients pin it on first
+        # use. Kept in the database like the session key, so it survives a
+        # restart and workers sharing the database present the same key
+        self.identity = ServerIdentity(identity_secret or self.db_manager.get_secret('identity'))
+        
+        # Messages are persisted in batches by a background writer
+        self.message_writer = MessageWriter(
+            self.db_manager, write_batch_size, write_flush_interval, durability
+        )
     
     # Database methods now delegated to DBManager
     def register_user(self, username, password):
@@ -24,235 +162,818 @@ class ChatServer:
     def authenticate_user(self, username, password):
         return self.db_manager.authenticate_user(username, password)
     
+    def resume_session(self, username, token):
+        # No database or KDF work: the token's signature vouches for the user
+        if self.sessions.verify(username, token):
+            return True, "Session resumed"
+        return False, "Invalid or expired session"
+    
     def save_message(self, sender, receiver, message, timestamp):
-        self.db_manager.save_message(sender, receiver, message, timestamp)
+        # Queue for the next group commit; the Future of its id completes on commit
+        return self.message_writer.submit(sender, receiver, message, timestamp)
+    
+    def get_recent_history(self, username, after_id=0):
+        return self.db_manager.get_recent_history(username, self.history_page_size, after_id)
     
-    def get_previous_messages(self, username):
-        return self.db_manager.get_previous_messages(username)
+    def get_history_page(self, username, chat_id, before_id=None):
+        return self.db_manager.get_history_page(username, chat_id, before_id, self.history_page_size)
+    
+    def make_frame(self, message, shared=False):
+        """Serialize a message once for any number of recipients; shared
+        frames (broadcasts) are encrypted with the group key"""
+        return Frame(message, shared)
+    
+    def deliver_frame(self, frame, connections):
+        # Queue the same pre-encrypted bytes to every (username, connection)
+        for username, connection in connections:
+            try:
+                connection.send_frame(frame)
+            except Exception as e:
+                print(f"Error sending to {username}: {e}")
+    
+    def deliver_text(self, message, connections):
+        # Queue a broadcast adapted to each client (see client_text), one Frame per variant
+        if not message.startswith(ADAPTED_PREFIXES):
+            self.deliver_frame(self.make_frame(message, shared=True), connections)
+            return
+        frames = {}
+        for username, connection in connections:
+            text = self.client_text(message, connection)
+            frame = frames.get(text)
+            if frame is None:
+                frame = frames[text] = self.make_frame(text, shared=True)
+            try:
+                connection.send_frame(frame)
+            except Exception as e:
+                print(f"Error sending to {username}: {e}")
     
     def broadcast_user_list(self):
-        # Send updated user list to all clients
+        """Send the full list of online users to clients without presence deltas"""
         with self.clients_lock:
-            user_list = ','.join(self.clients.keys())
-            message = f"USER_LIST|{user_list}"
-            encrypted_msg = self.encryption.encrypt(message)
-            
-        """Send list of connected users to all clients"""
+            self.send_user_list(self.clients.items())
+    
+    def send_user_list(self, connections):
+        # Caller holds clients_lock; lists are built and queued under it so
+        # concurrent joins/leaves can never deliver an older list after a newer one
+        legacy = [(username, connection) for username, connection in connections
+                  if FEATURE_PRESENCE_DELTAS not in connection.features]
+        if legacy:
+            frame = self.make_frame(f"USER_LIST|{','.join(self.online_users)}", shared=True)
+            self.deliver_frame(frame, legacy)
+    
+    def broadcast_presence(self, *users):
+        """Tell local clients about users whose online status changed.
+
+        Status is read here, under the lock, from local and remote users, so
+        callers only say who may have changed. Each change is one
+        PRESENCE_JOIN|SEQ|USER or PRESENCE_LEAVE|SEQ|USER delta, built once
+        for every client that supports them; other clients get the full
+        USER_LIST.
+        """
         with self.clients_lock:
-            users = ",".join(self.clients.keys())
-            message = f"USER_LIST|{users}"
-            encrypted_message = self.encryption.encrypt(message)
+            deltas = []
+            for user in users:
+                online = user in self.clients or user in self.remote_users
+                if online == (user in self.online_users):
+                    continue
+                if online:
+                    self.online_users.add(user)
+                else:
+                    self.online_users.discard(user)
+                self.presence_seq += 1
+                kind = "PRESENCE_JOIN" if online else "PRESENCE_LEAVE"
+                deltas.append(self.make_frame(f"{kind}|{self.presence_seq}|{user}", shared=True))
+            if not deltas:
+                return
             
-            for client_socket in self.clients.values():
-                try:
-                    client_socket.send(encrypted_message.encode() + b'\n')
-                except:
-                    pass
+            self.send_user_list(self.clients.items())
+            subscribers = [(username, connection) for username, connection in self.clients.items()
+                           if FEATURE_PRESENCE_DELTAS in connection.features]
+            for frame in deltas:
+                self.deliver_frame(frame, subscribers)
+            if self.presence_check is None and self.presence_check_delay is not None:
+                self.presence_check = self.timers.call_later(self.presence_check_delay, self.send_presence_seq)
+    
+    def send_presence_seq(self):
+        """Send PRESENCE_SEQ|SEQ after a burst of deltas, so a client whose
+        last delta was shed notices the gap and asks for a snapshot"""
+        with self.clients_lock:
+            self.presence_check = None
+            subscribers = [(username, connection) for username, connection in self.clients.items()
+                           if FEATURE_PRESENCE_DELTAS in connection.features]
+            if subscribers:
+                self.deliver_frame(self.make_frame(f"PRESENCE_SEQ|{self.presence_seq}", shared=True), subscribers)
+    
+    def send_presence_snapshot(self, connection):
+        """Queue PRESENCE_SNAPSHOT|SEQ|USERS: sent on connect and when the
+        client reports a gap in the delta sequence"""
+        with self.clients_lock:
+            connection.send_frame(self.presence_snapshot_frame())
+    
+    def presence_snapshot_frame(self):
+        # Caller holds clients_lock, so SEQ matches the users listed
+        return self.make_frame(f"PRESENCE_SNAPSHOT|{self.presence_seq}|{','.join(self.online_users)}")
     
     def broadcast_message(self, message, sender_username=None):
-        """Broadcast message to all connected clients"""
-        encrypted_message = self.encryption.encrypt(message)
-        
+        """Broadcast a message (str or Frame) to all connected clients"""
+        start = time.perf_counter()
         with self.clients_lock:
-            for username, client_socket in self.clients.items():
-                try:
-                    client_socket.send(encrypted_message.encode() + b'\n')
-                except Exception as e:
-                    print(f"Error sending to {username}: {e}")
+            connections = list(self.clients.items())
+        
+        if isinstance(message, Frame):
+            self.deliver_frame(message, connections)
+            message = message.message
+        else:
+            self.deliver_text(message, connections)
+        if self.bus is not None:
+            self.bus.publish({'type': EVENT_DELIVER, 'to': None, 'message': message})
+        BROADCAST_FANOUT.observe(time.perf_counter() - start)
     
     def send_private_message(self, message, receiver_username):
-        """Send message to specific client"""
+        """Send a message (str or Frame) to specific client"""
+        start = time.perf_counter()
         with self.clients_lock:
-            if receiver_username in self.clients:
-                try:
-                    client_socket = self.clients[receiver_username]
-                    encrypted_message = self.encryption.encrypt(message)
-                    client_socket.send(encrypted_message.encode() + b'\n')
-                    return True
-                except Exception as e:
-                    print(f"Error sending to {receiver_username}: {e}")
-                    return False
+            connection = self.clients.get(receiver_username)
+            remote = receiver_username in self.remote_users
+        if connection is None:
+            if remote and self.bus is not None:
+                frame_message = message.message if isinstance(message, Frame) else message
+                self.bus.publish({'type': EVENT_DELIVER, 'to': receiver_username, 'message': frame_message})
+                PRIVATE_FANOUT.observe(time.perf_counter() - start)
+                return True
             return False
+        
+        frame = message if isinstance(message, Frame) else self.make_frame(self.client_text(message, connection))
+        try:
+            connection.send_frame(frame)
+            PRIVATE_FANOUT.observe(time.perf_counter() - start)
+            return True
+        except Exception as e:
+            print(f"Error sending to {receiver_username}: {e}")
+            return False
+    
+    def client_text(self, message, connection):
+        """Adapt protocol text to what the receiving client understands"""
+        # Older clients read the status of TYPING|user|ON|PRIVATE as 'ON|PRIVATE'
+        if message.startswith("TYPING|") and FEATURE_PRIVATE_TYPING not in connection.features:
+            return message.removesuffix("|PRIVATE")
+        # and only know live messages as MSG|TIMESTAMP|..., without the id
+        if message.startswith("LIVE_MSG|") and FEATURE_MESSAGE_IDS not in connection.features:
+            return "MSG|" + message.split('|', 2)[2]
+        return message
+    
+    def register_metrics(self):
+        # Gauges read on every scrape or 'stats' command
+        REGISTRY.gauge('chatx_connected_clients', "Clients connected to this server", lambda: len(self.clients))
+        REGISTRY.gauge('chatx_online_users', "Users online in the chat, on any server", lambda: len(self.online_users))
+        REGISTRY.gauge('chatx_send_queue_depth', "Frames waiting in a client's outbound queue",
+                       lambda: {user: m['queue_depth'] for user, m in self.queue_metrics().items()}, ('user',))
+        REGISTRY.gauge('chatx_dropped_frames', "Frames dropped for slow clients connected now",
+                       lambda: sum(m['dropped_frames'] for m in self.queue_metrics().values()))
+        REGISTRY.gauge('chatx_auth_pending', "AUTH requests running or queued on the auth pool",
+                       lambda: self.auth_pool.pending)
+        REGISTRY.gauge('chatx_pending_writes', "Messages waiting for the database writer",
+                       lambda: self.message_writer.pending)
+        REGISTRY.gauge('chatx_open_connections', "Client sockets open, authenticated or not",
+                       lambda: self.connection_limiter.connections)
+        REGISTRY.gauge('chatx_handshakes', "Connections still in the AUTH handshake",
+                       lambda: self.connection_limiter.handshakes)
+    
+    def queue_metrics(self):
+        """Return outbound queue statistics for every connected client"""
+        with self.clients_lock:
+            connections = list(self.clients.items())
+        return {username: connection.metrics() for username, connection in connections}
+    
+    def health_metrics(self):
+        """Load figures for discovery and health replies"""
+        metrics = self.queue_metrics()
+        return {
+            'users': len(metrics),
+            'online': len(self.online_users),
+            'queue': sum(m['queue_depth'] for m in metrics.values()),
+        }
+    
+    def print_queue_metrics(self):
+        # Print outbound queue depth per client (terminal 'queues' command)
+        metrics = self.queue_metrics()
+        print(f"[SERVER] Outbound queues for {len(metrics)} client(s):")
+        for username, m in sorted(metrics.items(), key=lambda item: -item[1]['queue_depth']):
+            print(f"  {username}: depth={m['queue_depth']} peak={m['peak_depth']} "
+                  f"sent={m['sent_frames']} dropped={m['dropped_frames']}")
+    
+    def process_auth_request(self, encrypted_auth, address, version=LEGACY_VERSION, session=None):
+        """Handle one encrypted AUTH|TYPE|USERNAME|PASSWORD|FEATURES request.
+
+        RESUME requests carry a SESSION token in place of the password;
+        LOGIN and RESUME may add an empty field and |LAST_SEEN_ID. Binary
+        clients send it under the session key agreed in their HELLO
+        handshake (`session`, see process_hello), legacy clients under the
+        shared Fernet key. Returns (username, encrypted_response, features,
+        session, resume_from), where username is None when authentication
+        failed, features is the set of optional protocol features the
+        client advertised after its password, session is the (cipher,
+        group_cipher) pair for the connection (None to keep the shared
+        Fernet key) and resume_from is the message id a reconnecting client
+        replays history after (None for a full replay), or
+        None if the connection should be closed. Blocks the calling thread while the
+        auth pool checks the password; see parse_auth_request for the
+        non-blocking steps.
+        """
+        request = self.parse_auth_request(encrypted_auth, self.auth_cipher(version, session))
+        if request is None:
+            return None
+        future = self.submit_credentials(request)
+        success, message = future.result() if future else (False, AUTH_BUSY)
+        return self.finish_auth(request, success, message, address, version, session)
+    
+    def auth_cipher(self, version, session):
+        """The cipher an AUTH request arrives under: the shared key from a
+        legacy client, otherwise the HELLO session key (None before HELLO)"""
+        if version == LEGACY_VERSION:
+            return self.encryption
+        return session[0] if session else None
+    
+    def parse_auth_request(self, encrypted_auth, cipher):
+        """(auth_type, username, password, features, last_seen_id) from an
+        AUTH request encrypted under `cipher`, or None if it is not one.
+
+        With submit_credentials and finish_auth this is process_auth_request
+        in steps, so an event loop can await the password check instead of
+        blocking on it.
+        """
+        # Binary clients must finish the HELLO handshake before AUTH
+        if cipher is None:
+            return None
+        
+        # Try to decrypt (might fail for test connections)
+        auth_data = cipher.decrypt_bytes(encrypted_auth)
+        if not auth_data:
+            return None
+        try:
+            auth_data = auth_data.decode()
+        except UnicodeDecodeError:
+            return None
+        
+        # Parse authentication request: AUTH|TYPE|USERNAME|PASSWORD
+        parts = auth_data.split('|')
+        if len(parts) < 4 or parts[0] != "AUTH" or parts[1] not in AUTH_TYPES:
+            return None
+        
+        auth_type = parts[1]  # LOGIN, REGISTER or RESUME
+        if auth_type == "RESUME" and cipher is self.encryption:
+            # Anyone with the source can read the shared key, so a token
+            # sent under it may be a replay; tokens only count under a session key
+            return None
+        username = parts[2]
+        password = parts[3]
+        features = parse_features(parts[4]) if len(parts) > 4 else set()
+        # parts[5] carried the key exchange before HELLO and is ignored
+        last_seen_id = int(parts[6]) if len(parts) > 6 and parts[6].isdigit() else 0
+        return auth_type, username, password, features, last_seen_id
+    
+    def submit_credentials(self, request):
+        """Check a parsed AUTH request's password on the auth pool.
+
+        Returns a Future of (success, message), or None when the pool is
+        full and the request should be refused as busy. RESUME tokens are
+        checked at once and never queue behind password hashes.
+        """
+        auth_type, username, password = request[:3]
+        if auth_type == "RESUME":
+            future = Future()
+            future.set_result(self.resume_session(username, password))
+            return future
+        check = self.register_user if auth_type == "REGISTER" else self.authenticate_user
+        return self.auth_pool.submit(check, username, password)
+    
+    def finish_auth(self, request, success, message, address, version, session=None):
+        # Build the AUTH_RESPONSE for a checked request (see process_auth_request)
+        auth_type, username, password, features, last_seen_id = request
+        if success and auth_type == "REGISTER":
+            print(f"[SERVER] User {username} registered from {address}")
+        elif success:
+            # For "force one session", we kick the old user, wherever it is,
+            # once the new one has proved who it is
+            self.kick_session(username)
+            if self.bus is not None:
+                self.bus.publish({'type': EVENT_KICK, 'user': username})
+            action = "resumed a session" if auth_type == "RESUME" else "logged in"
+            print(f"[SERVER] User {username} {action} from {address}")
+        
+        AUTH_REQUESTS.labels(auth_type, 'success' if success else 'fail').inc()
+        response = f"AUTH_RESPONSE|{'SUCCESS' if success else 'FAIL'}|{message}"
+        if success and session:
+            # The broadcast group key, which only travels under the session key
+            response += f"|{base64.b64encode(session[1].key).decode()}"
+        # A reconnecting client only needs what was sent after last_seen_id
+        resume_from = None
+        if success and auth_type != "REGISTER":
+            resume_from = last_seen_id or None
+        if session:
+            encrypted_response = session[0].encrypt_bytes(response.encode())
+        else:
+            encrypted_response = self.encryption.encrypt(response).encode()
+        return (username if success else None), encrypted_response, features, session, resume_from
+    
+    def process_hello(self, payload):
+        """Answer a binary client's plaintext HELLO|KEY_EXCHANGE frame.
+
+        Picks the client's most preferred cipher this server offers and
+        replies HELLO|CIPHER|SERVER_KEY|IDENTITY|SIGNATURE, the signature
+        by the server's identity key over both HELLOs. Returns (reply,
+        session) with the (cipher, group_cipher) pair the AUTH exchange and
+        the rest of the connection use; session is None with an ERROR reply
+        when no cipher is shared, and both are None for anything that is
+        not a HELLO.
+        """
+        try:
+            kind, _, field = payload.decode().partition('|')
+        except UnicodeDecodeError:
+            return None, None
+        key_exchange = parse_key_exchange(field) if kind == HANDSHAKE_HELLO else None
+        if key_exchange is None:
+            return None, None
+        
+        client_key, client_ciphers = key_exchange
+        algorithm = next((c for c in client_ciphers if c in self.group_ciphers), None)
+        if algorithm is None:
+            return self.handshake_reply(f"{HANDSHAKE_ERROR}|No common cipher"), None
+        
+        exchange = KeyExchange()
+        try:
+            cipher = exchange.session_cipher(client_key, algorithm, is_client=False)
+        except Exception:
+            return None, None
+        hello = f"{HANDSHAKE_HELLO}|{algorithm}|{exchange.public_key}|{self.identity.public_key}"
+        signature = self.identity.sign(hello_transcript(payload, hello.encode()))
+        return self.handshake_reply(f"{hello}|{signature}"), (cipher, self.group_ciphers[algorithm])
+    
+    def handshake_reply(self, text):
+        # Plaintext handshake frame: HELLO or ERROR
+        return encode_wire(text.encode(), PROTOCOL_VERSION, FRAME_HANDSHAKE)
+    
+    def configure_connection(self, connection, version, features, session):
+        # Apply what was negotiated during AUTH to a new connection
+        connection.protocol_version = version
+        connection.features = features
+        connection.cipher, connection.group_cipher = session or (self.encryption, None)
+    
+    def auth_response_bytes(self, encrypted_response, version):
+        # Legacy clients expect the AUTH_RESPONSE token alone, unterminated
+        if version == LEGACY_VERSION:
+            return encrypted_response
+        return encode_wire(encrypted_response, version)
+    
+    def auth_frames(self, decoder, data_chunk):
+        """(frame_type, payload) pairs in a chunk read during the handshake.
+
+        The first chunk decides the wire format. Binary clients frame their
+        HELLO and AUTH requests, so anything they pipeline after them stays
+        buffered in the decoder; legacy clients send the bare AUTH token on
+        its own.
+        """
+        if decoder.version == LEGACY_VERSION:
+            return [(FRAME_MESSAGE, data_chunk.strip())]
+        decoder.feed(data_chunk)
+        return ((frame_type, payload) for frame_type, flags, payload in decoder)
+    
+    def kick_session(self, username):
+        """Close a user's local session without announcing a leave"""
+        with self.clients_lock:
+            old_connection = self.clients.pop(username, None)
+        if old_connection is None:
+            return False
+        print(f"[SERVER] Kicking old session for {username}")
+        try:
+            if FEATURE_RESUME in old_connection.features:
+                # Tell it why, or it would reconnect and kick the new session
+                old_connection.end(self.make_frame("SESSION_END|replaced"))
+            else:
+                old_connection.close()
+        except:
+            pass
+        return True
+    
+    def register_client(self, connection):
+        # Add client to dictionary; frames queue up until connection.start()
+        with self.clients_lock:
+            self.clients[connection.username] = connection
+            # Starting point for this client's view of who is online
+            if FEATURE_PRESENCE_DELTAS in connection.features:
+                connection.send_frame(self.presence_snapshot_frame())
+            else:
+                self.send_user_list([(connection.username, connection)])
+        
+        print(f"[SERVER] {connection.username} connected from {connection.address}")
+    
+    def unregister_client(self, connection):
+        """Remove a client, unless it was already replaced by a newer session"""
+        with self.clients_lock:
+            if self.clients.get(connection.username) is connection:
+                del self.clients[connection.username]
+                return True
+            return False
+    
+    def send_session_token(self, connection):
+        # SESSION|TOKEN|EXPIRES, under the session key, for a later AUTH|RESUME;
+        # never under the shared key, which would expose it to anyone
+        if FEATURE_RESUME not in connection.features or connection.cipher is self.encryption:
+            return
+        token, expires = self.sessions.issue(connection.username)
+        connection.write_frame(self.make_frame(f"SESSION|{token}|{expires}"))
+    
+    def send_history(self, connection, after_id=None):
+        # Send the latest page of each conversation ahead of anything queued
+        # for the user, then one HISTORY_END cursor per conversation
+        history = self.get_recent_history(connection.username, after_id or 0)
+        if after_id:
+            self.send_missed_history(connection, history)
+            return
+        rows = sorted(row for page, has_more in history.values() for row in page)
+        for frame in self.history_frames(connection, rows):
+            connection.write_frame(frame)
+        
+        for chat_id, (page, has_more) in history.items():
+            connection.write_frame(self.make_frame(self.history_end_message(chat_id, page, has_more)))
+    
+    def send_missed_history(self, connection, history):
+        """Catch a reconnecting client up on messages newer than it has.
+
+        Conversations that missed at most a page get just those rows,
+        appended to what the client holds. The others missed too much to
+        fill in: their latest page is sent like a HISTORY answer, which
+        the client puts in place of the chat.
+        """
+        rows = sorted(row for page, has_more in history.values() if not has_more for row in page)
+        for frame in self.history_frames(connection, rows):
+            connection.write_frame(frame)
+        
+        for chat_id, (page, has_more) in history.items():
+            if has_more:
+                for frame in self.history_frames(connection, page, older=True):
+                    connection.write_frame(frame)
+                connection.write_frame(self.make_frame(self.history_end_message(chat_id, page, has_more)))
+    
+    def history_end_message(self, chat_id, page, has_more, before_id=None):
+        # HISTORY_END|CHAT|OLDEST_ID|HAS_MORE tells the client where to page from
+        oldest_id = page[0][0] if page else (before_id or 0)
+        return f"HISTORY_END|{chat_id}|{oldest_id}|{1 if has_more else 0}"
+    
+    def history_frames(self, connection, rows, older=False):
+        """Frames carrying history rows: compressed HISTORY_BATCH frames for
+        clients that support them, otherwise one MSG (or HISTORY_MSG) each"""
+        if FEATURE_HISTORY_BATCH in connection.features:
+            for i in range(0, len(rows), HISTORY_BATCH_ROWS):
+                yield self.make_frame(pack_history_batch(rows[i:i + HISTORY_BATCH_ROWS], older))
+            return
+        
+        for message_id, sender, receiver, message, timestamp in rows:
+            if older:
+                yield self.make_frame(f"HISTORY_MSG|{message_id}|{timestamp}|{sender}|{receiver}|{message}")
+            else:
+                yield self.make_frame(f"MSG|{timestamp}|{sender}|{receiver}|{message}")
+    
+    def send_history_page(self, connection, chat_id, before_id):
+        """Answer a HISTORY request with the page of chat_id older than before_id"""
+        before_id = int(before_id) if before_id.isdigit() else None
+        page, has_more = self.get_history_page(connection.username, chat_id, before_id)
+        for frame in self.history_frames(connection, page, older=True):
+            connection.send_frame(frame)
+        connection.send_frame(self.make_frame(self.history_end_message(chat_id, page, has_more, before_id)))
+    
+    def announce_join(self, username):
+        # Notify all clients about new user
+        timestamp = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        join_message = f"SYSTEM|{timestamp}|SERVER|ALL|{username} joined the chat"
+        self.broadcast_message(join_message, username)
+        if self.bus is not None:
+            self.bus.publish({'type': EVENT_JOIN, 'user': username})
+        
+        # Tell every client the user is online
+        self.broadcast_presence(username)
+    
+    def announce_leave(self, username):
+        print(f"[SERVER] {username} disconnected")
+        
+        # Clear indicators the user left switched on
+        for receiver in self.typing_limiter.forget(username):
+            self.send_typing(username, receiver, "OFF")
+        
+        # Notify all clients
+        timestamp = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
+        leave_message = f"SYSTEM|{timestamp}|SERVER|ALL|{username} left the chat"
+        self.broadcast_message(leave_message, username)
+        if self.bus is not None:
+            self.bus.publish({'type': EVENT_LEAVE, 'user': username})
+        
+        # Update user list
+        self.broadcast_presence(username)
+    
+    def attach_bus(self, bus):
+        """Join other servers of the same chat through a Bus"""
+        self.bus = bus
+        bus.start(self.handle_bus_event)
+    
+    def handle_bus_event(self, event):
+        """Apply an event published by another server"""
+        event_type = event['type']
+        
+        if event_type == EVENT_DELIVER:
+            # Deliver locally only; the publishing server already did its share
+            with self.clients_lock:
+                if event['to'] is None:
+                    connections = list(self.clients.items())
+                else:
+                    connection = self.clients.get(event['to'])
+                    connections = [(event['to'], connection)] if connection else []
+            if event['to'] is None:
+                self.deliver_text(event['message'], connections)
+            elif connections:
+                self.deliver_frame(self.make_frame(self.client_text(event['message'], connection)), connections)
+        
+        elif event_type == EVENT_JOIN:
+            with self.clients_lock:
+                self.remote_users[event['user']] = event['node']
+            self.broadcast_presence(event['user'])
+        
+        elif event_type == EVENT_LEAVE:
+            with self.clients_lock:
+                changed = self.remote_users.get(event['user']) == event['node']
+                if changed:
+                    del self.remote_users[event['user']]
+            if changed:
+                self.broadcast_presence(event['user'])
+        
+        elif event_type == EVENT_KICK:
+            # The user logged in elsewhere; tell the others this session is gone
+            if self.kick_session(event['user']):
+                self.bus.publish({'type': EVENT_LEAVE, 'user': event['user']})
+                self.broadcast_presence(event['user'])
+        
+        elif event_type == EVENT_PRESENCE:
+            with self.clients_lock:
+                previous = set(self.remote_users)
+                self.remote_users = {
+                    user: node for user, node in event['users'].items() if node != self.bus.node
+                }
+                changed = previous | set(self.remote_users)
+                # After a broker reconnect the hub may have forgotten our users
+                missing = [user for user in self.clients if event['users'].get(user) != self.bus.node]
+            for user in missing:
+                self.bus.publish({'type': EVENT_JOIN, 'user': user})
+            self.broadcast_presence(*changed)
+        
+        elif event_type == EVENT_STOP:
+            print("[SERVER] Stop requested by the worker supervisor")
+            threading.Thread(target=self.stop, daemon=True).start()
+    
+    def admit_connection(self):
+        """Count a just-accepted connection; False if it must be closed"""
+        rejected = self.connection_limiter.admit()
+        if rejected is None:
+            return True
+        CONNECTIONS_REJECTED.labels(rejected).inc()
+        return False
+    
+    def busy_reply(self):
+        """Handshake ERROR frame written to a connection refused on accept.
+        
+        Without it the client would see a silent close, which is how
+        servers that predate binary framing refuse a framed request, and
+        would retry on the shared-key legacy path.
+        """
+        return self.handshake_reply(f"{HANDSHAKE_ERROR}|{AUTH_BUSY}")
+    
+    def configure_socket(self, sock):
+        # TCP keepalive on an accepted client socket
+        if self.keepalive:
+            try:
+                set_keepalive(sock, *self.keepalive)
+            except OSError as e:
+                print(f"[SERVER] Could not enable TCP keepalive: {e}")
+    
+    def watch_connection(self, connection):
+        # Start pinging a client that can answer PING with PONG
+        if self.reaper is not None and FEATURE_HEARTBEAT in connection.features:
+            self.reaper.watch(connection)
+    
+    def admit_frame(self, msg_type, timestamp, receiver, connection):
+        """Spend a MSG or TYPING token for the sender and its address.
+
+        Over either limit, nothing is spent and the sender gets
+        THROTTLE|TYPE|RETRY_AFTER|CHAT|TIMESTAMP instead of a database
+        write and fan-out. A client that keeps flooding without reading
+        those fills its send queue and is disconnected as a slow client.
+        """
+        user_limiter, ip_limiter = self.rate_limiters[msg_type]
+        scope, wait = 'user', 0.0
+        if user_limiter is not None:
+            wait = user_limiter.take(connection.username)
+        if not wait and ip_limiter is not None:
+            scope, wait = 'ip', ip_limiter.take(connection.address[0])
+            if wait and user_limiter is not None:
+                user_limiter.give_back(connection.username)
+        if not wait:
+            return True
+        
+        THROTTLED.labels(msg_type, scope).inc()
+        connection.send_frame(self.make_frame(f"THROTTLE|{msg_type}|{wait:.2f}|{receiver}|{timestamp}"))
+        return False
+    
+    def parse_client_message(self, encrypted_data, cipher=None):
+        """Decrypt and split a client frame into its five protocol fields"""
+        start = time.perf_counter()
+        data = (cipher or self.encryption).decrypt_bytes(encrypted_data)
+        DECRYPT_SECONDS.observe(time.perf_counter() - start)
+        if not data:
+            return None
+        data = data.decode(errors='replace')
+        
+        # Parse message
+        parts = data.split('|', 4)
+        if len(parts) < 5:
+            return None
+        MESSAGES_RECEIVED.labels(parts[0] if parts[0] in MESSAGE_TYPES else 'other').inc()
+        return parts
+    
+    def route_message(self, msg_type, timestamp, sender, receiver, content, connection, message_id=None):
+        """Deliver a MSG stored as message_id, or a TYPING update, to its recipients"""
+        # Handle typing indicator
+        if msg_type == "TYPING":
+            if content in ("ON", "OFF"):
+                self.typing_limiter.offer(sender, receiver, content)
+            return
+        
+        # The id lets clients advance their reconnect cursor (see client_text)
+        message = f"LIVE_MSG|{message_id}|{timestamp}|{sender}|{receiver}|{content}"
+        if receiver == "ALL":
+            # Group message
+            self.broadcast_message(message, sender)
+        else:
+            # Private message, echoed to the sender as confirmation
+            if self.send_private_message(message, receiver):
+                connection.send_frame(self.make_frame(self.client_text(message, connection)))
+    
+    def route_saved(self, saved, timestamp, sender, receiver, content, connection):
+        # Deliver a MSG once the writer has stored it (`saved` is its Future)
+        try:
+            message_id = saved.result()
+        except Exception as e:
+            print(f"[SERVER] Message from {sender} not delivered: {e}")
+            return
+        self.route_message("MSG", timestamp, sender, receiver, content, connection, message_id)
+    
+    def send_typing(self, sender, receiver, status):
+        """Deliver a typing state change to the chat's participants only"""
+        if receiver == "ALL":
+            self.broadcast_message(f"TYPING|{sender}|{status}", sender)
+        else:
+            # PRIVATE tells the receiver it belongs to the chat with sender;
+            # client_text() drops it for clients without FEATURE_PRIVATE_TYPING
+            self.send_private_message(f"TYPING|{sender}|{status}|PRIVATE", receiver)
+    
+    def process_client_frame(self, encrypted_data, connection):
+        """Handle one client frame on the calling thread (threaded engine)"""
+        for future in self.client_frame_steps(encrypted_data, connection):
+            future.result()
+    
+    def client_frame_steps(self, encrypted_data, connection):
+        """Decrypt, check and route one client frame.
+        
+        Shared by both engines: a generator yielding each Future the frame
+        must wait on before the next one is handled, so the threaded engine
+        blocks on it and the asyncio engine awaits it.
+        """
+        parts = self.parse_client_message(encrypted_data, connection.cipher)
+        if not parts:
+            return
+        
+        msg_type, timestamp, sender, receiver, content = parts
+        
+        # Client asks for an older page of a conversation
+        if msg_type == "HISTORY":
+            yield self.run_blocking(self.send_history_page, connection, receiver, content)
+            return
+        
+        # Client missed a presence delta
+        if msg_type == "PRESENCE_SYNC":
+            self.send_presence_snapshot(connection)
+            return
+        
+        if msg_type not in ("MSG", "TYPING"):
+            return
+        if not self.admit_frame(msg_type, timestamp, receiver, connection):
+            return
+        
+        # Regular messages are routed once stored, with their id; in
+        # 'commit' durability mode the next frame waits for that too
+        if msg_type == "MSG":
+            saved = self.save_message(sender, receiver, content, timestamp)
+            if self.message_writer.wait_for_commit:
+                yield saved
+                self.route_saved(saved, timestamp, sender, receiver, content, connection)
+            else:
+                saved.add_done_callback(functools.partial(
+                    self.route_saved, timestamp=timestamp, sender=sender, receiver=receiver,
+                    content=content, connection=connection
+                ))
+            return
+        
+        self.route_message(msg_type, timestamp, sender, receiver, content, connection)
+    
+    def run_blocking(self, func, *args):
+        """Run database work for a client frame and return a Future of its
+        result; the threaded engine runs it on the handler thread"""
+        future = Future()
+        future.set_result(func(*args))
+        return future
     
     def handle_client(self, client_socket, address):
-        # Handle individual client connection
+        # Handle individual client connection (already counted by admit_connection)
         username = None
+        connection = None
         authenticated = False
         
+        CONNECTIONS.inc()
         try:
             # Set timeout for authentication
             client_socket.settimeout(10.0)
             
-            # Authentication loop
-            while not authenticated:
+            # Authentication loop: HELLO (binary clients), then AUTH
+            decoder = None
+            session = None
+            while not username:
                 # Receive authentication request
                 try:
-                    encrypted_auth = client_socket.recv(4096).decode()
+                    data_chunk = client_socket.recv(4096)
                 except socket.timeout:
                     # Test connection that doesn't send data - just close silently
                     client_socket.close()
                     return
                 
-                if not encrypted_auth:
+                if not data_chunk:
                     client_socket.close()
                     return
                 
-                # Try to decrypt (might fail for test connections)
-                try:
-                    auth_data = self.encryption.decrypt(encrypted_auth)
-                except:
-                    # Invalid data (probably a test connection) - close silently
-                    client_socket.close()
-                    return
+                if decoder is None:
+                    decoder = FrameDecoder(detect_version(data_chunk), MAX_AUTH_FRAME_SIZE)
                 
-                if not auth_data:
-                    client_socket.close()
-                    return
-                
-                # Parse authentication request: AUTH|TYPE|USERNAME|PASSWORD
-                parts = auth_data.split('|')
-                if len(parts) < 3 or parts[0] != "AUTH":
-                    client_socket.close()
-                    return
-                
-                auth_type = parts[1]  # LOGIN or REGISTER
-                
-                # Process authentication
-                if auth_type == "REGISTER":
-                    if len(parts) < 4:
+                for frame_type, payload in self.auth_frames(decoder, data_chunk):
+                    if frame_type == FRAME_HANDSHAKE:
+                        reply, session = self.process_hello(payload)
+                        if reply is not None:
+                            client_socket.sendall(reply)
+                        if session is None:
+                            client_socket.close()
+                            return
+                        continue
+                    
+                    result = self.process_auth_request(payload, address, decoder.version, session)
+                    if result is None:
+                        # Invalid data (probably a test connection) - close silently
                         client_socket.close()
                         return
-                    username = parts[2]
-                    password = parts[3]
-                    
-                    success, message = self.register_user(username, password)
-                    response = f"AUTH_RESPONSE|{'SUCCESS' if success else 'FAIL'}|{message}"
-                    encrypted_response = self.encryption.encrypt(response)
-                    client_socket.send(encrypted_response.encode())
-                    
-                    if success:
-                        authenticated = True
-                        print(f"[SERVER] User {username} registered from {address}")
-                    
-                elif auth_type == "LOGIN":
-                    username = parts[2]
-                    password = parts[3]
                     
-                    # Check if user is already connected
-                    is_already_connected = False
-                    with self.clients_lock:
-                        if username in self.clients:
-                            is_already_connected = True
-                            
-                    if is_already_connected:
-                        # Optional: You could reject the login here.
-                        # For "force one session", we will kick the old user.
-                        print(f"[SERVER] Kicking old session for {username}")
-                        with self.clients_lock:
-                            try:
-                                old_socket = self.clients[username]
-                                old_socket.close()
-                                del self.clients[username]
-                            except:
-                                pass
-                    
-                    success, message = self.authenticate_user(username, password)
-                    response = f"AUTH_RESPONSE|{'SUCCESS' if success else 'FAIL'}|{message}"
-                    encrypted_response = self.encryption.encrypt(response)
-                    client_socket.send(encrypted_response.encode())
-                    
-                    if success:
-                        authenticated = True
-                        print(f"[SERVER] User {username} logged in from {address}")
-                
-                else:
-                    client_socket.close()
-                    return
+                    username, encrypted_response, features, session, resume_from = result
+                    client_socket.sendall(self.auth_response_bytes(encrypted_response, decoder.version))
+                    if username:
+                        break
             
-            if not username or not authenticated:
-                client_socket.close()
-                return
+            self.connection_limiter.authenticated()
+            decoder.max_frame_size = MAX_FRAME_SIZE
+            authenticated = True
             
             # Reset timeout for persistent connection
             client_socket.settimeout(None)
             
-            # Add client to dictionary
-            with self.clients_lock:
-                self.clients[username] = client_socket
-            
-            print(f"[SERVER] {username} connected from {address}")
-            
-            # Send previous messages to user
-            previous_messages = self.get_previous_messages(username)
-            for sender, receiver, message, timestamp in previous_messages:
-                msg = f"MSG|{timestamp}|{sender}|{receiver}|{message}"
-                encrypted_msg = self.encryption.encrypt(msg)
-                client_socket.send(encrypted_msg.encode() + b'\n')
-            
-            # Notify all clients about new user
-            timestamp = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-            join_message = f"SYSTEM|{timestamp}|SERVER|ALL|{username} joined the chat"
-            self.broadcast_message(join_message, username)
-            
-            # Send user list to all clients
-            self.broadcast_user_list()
+            connection = ThreadedConnection(client_socket, username, address, self.send_policy)
+            self.configure_connection(connection, decoder.version, features, session)
+            self.register_client(connection)
+            self.send_session_token(connection)
+            self.send_history(connection, resume_from)
+            connection.start()
+            self.watch_connection(connection)
+            self.announce_join(username)
             
-            # Main message loop with buffering
-            buffer = ""
+            # Main message loop: the decoder buffers partial frames
             while self.running:
                 try:
-                    data_chunk = client_socket.recv(4096).decode()
-                    if not data_chunk:
-                        break
-                    
-                    buffer += data_chunk
-                    
-                    while '\n' in buffer:
-                        encrypted_data, buffer = buffer.split('\n', 1)
-                        if not encrypted_data:
-                            continue
-                            
-                        # Process individual message
+                    for frame_type, flags, encrypted_data in decoder.drain():
+                        start = time.perf_counter()
                         try:
-                            data = self.encryption.decrypt(encrypted_data)
-                            if not data:
-                                continue
-                            
-                            # Parse message
-                            parts = data.split('|', 4)
-                            if len(parts) < 5:
-                                continue
-                            
-                            msg_type, timestamp, sender, receiver, content = parts
-                            
-                            # Handle typing indicator
-                            if msg_type == "TYPING":
-                                typing_msg = f"TYPING|{sender}|{content}"
-                                self.broadcast_message(typing_msg, sender)
-                                continue
-                            
-                            # Handle regular message
-                            if msg_type == "MSG":
-                                # Save to database
-                                self.save_message(sender, receiver, content, timestamp)
-                                
-                                # Route message
-                                if receiver == "ALL":
-                                    # Group message
-                                    message = f"MSG|{timestamp}|{sender}|{receiver}|{content}"
-                                    self.broadcast_message(message, sender)
-                                else:
-                                    # Private message
-                                    message = f"MSG|{timestamp}|{sender}|{receiver}|{content}"
-                                    success = self.send_private_message(message, receiver)
-                                    
-                                    # Send confirmation to sender
-                                    if success:
-                                        encrypted_msg = self.encryption.encrypt(message)
-                                        client_socket.send(encrypted_msg.encode() + b'\n')
+                            self.process_client_frame(encrypted_data, connection)
                         except Exception as e:
                             print(f"[SERVER] Error processing message: {e}")
-                            
+                        FRAME_SECONDS.observe(time.perf_counter() - start)
+                    
+                    if not decoder.recv_into(client_socket):
+                        break
+                    connection.last_received = time.monotonic()
+                
+                except ProtocolError as e:
+                    print(f"[SERVER] Protocol error from {username}: {e}")
+                    break
                 except Exception as e:
                     print(f"[SERVER] Error handling message from {username}: {e}")
                     break
@@ -262,27 +983,45 @@ class ChatServer:
         
         finally:
             # Remove client and notify others
-            if username:
-                with self.clients_lock:
-                    if username in self.clients:
-                        del self.clients[username]
-                
-                print(f"[SERVER] {username} disconnected")
-                
-                # Notify all clients
-                timestamp = datetime.now().strftime("%Y/%m/%d %H:%M:%S")
-                leave_message = f"SYSTEM|{timestamp}|SERVER|ALL|{username} left the chat"
-                self.broadcast_message(leave_message, username)
-                
-                # Update user list
-                self.broadcast_user_list()
+            if connection:
+                connection.close()
+                if self.unregister_client(connection):
+                    self.announce_leave(username)
             
             client_socket.close()
+            self.connection_limiter.release(authenticated)
     
     
+    def start_beacon(self):
+        # Answer LAN discovery requests with our port
+        if not self.discovery_port:
+            return
+        try:
+            self.beacon = DiscoveryBeacon(self.port, self.discovery_port, health=self.health_metrics)
+            print(f"[SERVER] Discovery beacon on UDP port {self.discovery_port}")
+        except OSError as e:
+            print(f"[SERVER] Discovery beacon unavailable: {e}")
+    
+    def start_metrics(self):
+        # Serve /metrics on localhost
+        if not self.metrics_port:
+            return
+        try:
+            self.metrics_server = start_metrics_server(self.metrics_port)
+            print(f"[SERVER] Metrics at http://127.0.0.1:{self.metrics_port}/metrics")
+        except OSError as e:
+            print(f"[SERVER] Metrics endpoint unavailable: {e}")
+    
+    def print_stats(self):
+        # Summarize metrics (terminal 'stats' command)
+        print("[SERVER] Metrics:")
+        print(REGISTRY.format_stats())
+    
     def monitor_terminal_input(self):
         # Monitor terminal for stop commands
         print("\n[SERVER] Type 'stop' or 'quit' to shutdown the server gracefully")
+        print("[SERVER] Type 'queues' to show per-client outbound queue depth")
+        print("[SERVER] Type 'stats' to show server metrics")
         print("[SERVER] Or press Ctrl+C to force stop\n")
         
         while self.running:
@@ -292,6 +1031,10 @@ class ChatServer:
                     print("\n[SERVER] Shutting down gracefully...")
                     self.stop()
                     break
+                elif user_input == 'queues':
+                    self.print_queue_metrics()
+                elif user_input == 'stats':
+                    self.print_stats()
             except (EOFError, KeyboardInterrupt):
                 break
     
@@ -300,16 +1043,21 @@ class ChatServer:
         try:
             self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(100)
+            self.server_socket.listen(self.backlog)
             self.running = True
             
             print(f"[SERVER] ChatX Server started on {self.host}:{self.port}")
+            self.start_beacon()
+            self.start_metrics()
             print(f"[SERVER] Waiting for connections...")
             
             # Start terminal input monitoring thread
-            input_thread = threading.Thread(target=self.monitor_terminal_input, daemon=True)
-            input_thread.start()
+            if self.interactive:
+                input_thread = threading.Thread(target=self.monitor_terminal_input, daemon=True)
+                input_thread.start()
             
             # Accept connections
             while self.running:
@@ -317,6 +1065,16 @@ class ChatServer:
                     self.server_socket.settimeout(1.0)  # Timeout to check running flag
                     try:
                         client_socket, address = self.server_socket.accept()
+                        if not self.admit_connection():
+                            # Over a limit: no thread, and the client retries later
+                            try:
+                                client_socket.setblocking(False)
+                                client_socket.send(self.busy_reply())
+                            except OSError:
+                                pass
+                            client_socket.close()
+                            continue
+                        self.configure_socket(client_socket)
                         client_thread = threading.Thread(
                             target=self.handle_client,
                             args=(client_socket, address),
@@ -336,6 +1094,11 @@ class ChatServer:
         finally:
             self.stop()
     
+    def close_database(self):
+        # Flush queued messages, then release pooled database connections
+        self.message_writer.close()
+        self.db_manager.close()
+    
     def stop(self):
         # Stop the server
         if not self.running:
@@ -346,9 +1109,9 @@ class ChatServer:
         # Notify all connected clients
         with self.clients_lock:
             print(f"\n[SERVER] Disconnecting {len(self.clients)} client(s)...")
-            for username, client_socket in list(self.clients.items()):
+            for username, connection in list(self.clients.items()):
                 try:
-                    client_socket.close()
+                    connection.close()
                 except:
                     pass
             self.clients.clear()
@@ -360,9 +1123,34 @@ class ChatServer:
             except:
                 pass
         
+        self.timers.close()
+        self.auth_pool.shutdown()
+        if self.beacon is not None:
+            self.beacon.close()
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+        if self.bus is not None:
+            self.bus.close()
+        
+        self.close_database()
+        
         print("[SERVER] Server stopped successfully")
         print("[SERVER] Goodbye!")
 
+def make_rate_limiter(limit):
+    # (rate, burst) to a RateLimiter; None stays None (no limit)
+    return RateLimiter(*limit) if limit else None
+
+def create_server(host='0.0.0.0', port=5555, engine='threaded', **kwargs):
+    """Build a ChatServer using the selected connection engine"""
+    if engine == 'asyncio':
+        from async_server import AsyncChatServer
+        return AsyncChatServer(host, port, **kwargs)
+    if engine != 'threaded':
+        raise ValueError(f"Unknown server engine: {engine}")
+    return ChatServer(host, port, **kwargs)
+
 if __name__ == "__main__":
     # Get server configuration
     print("="*50)
@@ -388,10 +1176,59 @@ if __name__ == "__main__":
         port = 5555
         print("Using default port: 5555")
     
+    try:
+        engine = input("Enter server engine, threaded or asyncio (press Enter for threaded): ").strip().lower()
+        if engine not in ENGINES:
+            engine = 'threaded'
+    except (EOFError, OSError):
+        engine = 'threaded'
+        print("Using default engine: threaded")
+    
+    try:
+        durability = input("Enter message durability, queue or commit (press Enter for queue): ").strip().lower()
+        if durability not in DURABILITY_MODES:
+            durability = 'queue'
+    except (EOFError, OSError):
+        durability = 'queue'
+        print("Using default durability: queue")
+    
+    try:
+        workers_str = input("Enter number of worker processes (press Enter for 1): ").strip()
+        workers = max(1, int(workers_str)) if workers_str else 1
+    except (EOFError, OSError, ValueError):
+        workers = 1
+        print("Using default workers: 1")
+    
+    try:
+        metrics_str = input("Enter metrics port for http://127.0.0.1:PORT/metrics (press Enter for none): ").strip()
+        metrics_port = int(metrics_str) if metrics_str else None
+    except (EOFError, OSError, ValueError):
+        metrics_port = None
+    
+    try:
+        broker_url = input("Enter cluster broker URL, e.g. tcp://10.0.0.5:6000 (press Enter for none): ").strip()
+    except (EOFError, OSError):
+        broker_url = ''
+    
     print("="*50)
     
+    if broker_url and workers > 1:
+        print("[SERVER] A cluster node runs a single worker; ignoring the worker count")
+        workers = 1
+    
+    if workers > 1:
+        # Several processes share the port; see workers.py
+        from workers import WorkerPool
+        WorkerPool(host, port, workers, engine, durability=durability,
+                   discovery_port=DISCOVERY_PORT, metrics_port=metrics_port).start()
+        raise SystemExit
+    
     # Start server
-    server = ChatServer(host, port)
+    server = create_server(host, port, engine, durability=durability,
+                           discovery_port=DISCOVERY_PORT, metrics_port=metrics_port)
+    if broker_url:
+        # Federate with the other nodes behind the same broker; see broker.py
+        server.attach_bus(create_bus(broker_url, f"{socket.gethostname()}:{port}"))
     try:
         server.start()
     except KeyboardInterrupt:
@@ -0,0 +1,80 @@
+import base64
+import collections
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+from metrics import REGISTRY
+
+SESSION_CACHE = REGISTRY.counter('chatx_session_cache_total', "RESUME token checks by cache result", ('result',))
+CACHE_HITS = SESSION_CACHE.labels('hit')
+CACHE_MISSES = SESSION_CACHE.labels('miss')
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+class SessionTokens:
+    """Signed, expiring session tokens for resuming without a password.
+
+    A token is <base64 "username|expires">.<base64 HMAC-SHA256 of it>, so
+    any server holding `secret` can check one without touching the
+    database. Tokens that verified recently are kept in an LRU cache of at
+    most `cache_size` entries, which answers repeated resumes (a flapping
+    connection) with a dict lookup. Servers accept each other's tokens
+    only if they share the secret (ChatServer keeps one in the database);
+    without one a random key is picked, and the tokens die with it.
+    """
+    def __init__(self, secret=None, ttl=24 * 3600, cache_size=10000):
+        self.secret = secret or os.urandom(32)
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.cache = collections.OrderedDict()  # token: (username, expires)
+        self.lock = threading.Lock()
+
+    def sign(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()
+
+    def issue(self, username):
+        """Returns (token, expires) for a user who just authenticated"""
+        expires = int(time.time() + self.ttl)
+        payload = f"{username}|{expires}".encode()
+        token = f"{b64encode(payload)}.{b64encode(self.sign(payload))}"
+        self.remember(token, username, expires)
+        return token, expires
+
+    def verify(self, username, token):
+        """True if `token` was issued to `username` and has not expired"""
+        now = time.time()
+        with self.lock:
+            session = self.cache.get(token)
+            if session is not None:
+                self.cache.move_to_end(token)
+        if session is not None:
+            CACHE_HITS.inc()
+            return session[0] == username and session[1] > now
+
+        CACHE_MISSES.inc()
+        try:
+            payload, signature = (b64decode(part) for part in token.split('.'))
+            owner, expires = payload.decode().rsplit('|', 1)
+            expires = int(expires)
+        except ValueError:
+            return False
+        if not hmac.compare_digest(self.sign(payload), signature):
+            return False
+        if owner != username or expires <= now:
+            return False
+        self.remember(token, owner, expires)
+        return True
+
+    def remember(self, token, username, expires):
+        with self.lock:
+            self.cache[token] = (username, expires)
+            self.cache.move_to_end(token)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
@@ -0,0 +1,64 @@
+import contextlib
+import io
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from protocol import FLAG_GROUP_KEY, encode_wire
+from server import create_server
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def quiet(test):
+    """Silence server and client logging for the rest of a test"""
+    stack = contextlib.ExitStack()
+    stack.enter_context(contextlib.redirect_stdout(io.StringIO()))
+    test.addCleanup(stack.close)
+
+
+def read_until(auth, sock, last):
+    """Decrypted frames a logged-in AuthService receives, up to and including `last`"""
+    lines = []
+    while last not in lines:
+        for frame_type, flags, payload in auth.decoder.drain():
+            cipher = auth.group_cipher if flags & FLAG_GROUP_KEY else auth.cipher
+            lines.append(cipher.decrypt_bytes(payload).decode())
+        if last not in lines and not auth.decoder.recv_into(sock):
+            raise ConnectionError(f"closed before {last!r}")
+    return lines
+
+
+def send(auth, sock, message):
+    """Send one protocol message on a logged-in AuthService's socket"""
+    sock.sendall(encode_wire(auth.cipher.encrypt_bytes(message.encode()), auth.protocol_version))
+
+
+def start_server(test, engine='threaded', **kwargs):
+    """Run a ChatServer on a free loopback port with its own database until the test ends"""
+    fd, db_name = tempfile.mkstemp(prefix='chatx_test_', suffix='.db')
+    os.close(fd)
+    os.unlink(db_name)
+    port = free_port()
+    server = create_server('127.0.0.1', port, engine, db_name=db_name, interactive=False, **kwargs)
+    threading.Thread(target=server.start, daemon=True).start()
+
+    def cleanup():
+        server.stop()
+        for suffix in ('', '-wal', '-shm'):
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(db_name + suffix)
+    test.addCleanup(cleanup)
+
+    deadline = time.monotonic() + 5
+    while not server.running:
+        if time.monotonic() > deadline:
+            raise RuntimeError("Server did not start")
+        time.sleep(0.01)
+    return server, port
@@ -0,0 +1,207 @@
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+from auth_service import IDENTITY_CHANGED, SERVER_CLOSED, AuthService, KnownServers
+from encryption import MessageEncryption, ServerIdentity
+from protocol import AUTH_BUSY, LEGACY_VERSION, PROTOCOL_VERSION, FrameDecoder, encode_wire
+from tests.support import quiet, read_until, start_server
+
+
+class LegacyServer:
+    """Answers one AUTH the way servers before binary framing did.
+
+    A framed request fails to decrypt and the connection is dropped; a
+    bare one gets a bare AUTH_RESPONSE with history and the user list
+    sent right behind it, in the same write.
+    """
+
+    def __init__(self, lines):
+        self.encryption = MessageEncryption()
+        self.lines = lines
+        self.requests = []
+        self.listener = socket.create_server(('127.0.0.1', 0))
+        self.port = self.listener.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except OSError:
+                return
+            with sock:
+                try:
+                    request = self.encryption.decrypt(sock.recv(4096).decode())
+                except UnicodeDecodeError:
+                    request = None
+                self.requests.append(request)
+                if request is None:
+                    continue
+                response = self.encryption.encrypt("AUTH_RESPONSE|SUCCESS|Login successful").encode()
+                sock.sendall(response + b''.join(self.encryption.encrypt(line).encode() + b'\n'
+                                                 for line in self.lines))
+
+    def close(self):
+        self.listener.close()
+
+
+class LegacyFallbackTest(unittest.TestCase):
+    def test_login_to_legacy_server(self):
+        lines = ["MSG|2025/01/01 10:00:00|bob|ALL|hi", "USER_LIST|alice,bob"]
+        server = LegacyServer(lines)
+        self.addCleanup(server.close)
+        auth = AuthService(KnownServers())
+        success, sock, message = auth.login('127.0.0.1', server.port, 'alice', 'secret')
+        self.addCleanup(sock.close)
+
+        self.assertTrue(success, message)
+        self.assertEqual(message, "Login successful")
+        # One framed attempt dropped by the server, then the bare request
+        self.assertEqual(len(server.requests), 2)
+        self.assertIsNone(server.requests[0])
+        self.assertTrue(server.requests[1].startswith("AUTH|LOGIN|alice|secret|"))
+        self.assertEqual(auth.protocol_version, LEGACY_VERSION)
+        frames = [auth.cipher.decrypt_bytes(payload).decode() for _, _, payload in auth.decoder.drain()]
+        self.assertEqual(frames, lines)
+
+    def test_current_server_with_legacy_framing(self):
+        quiet(self)
+        server, port = start_server(self)
+        auth = AuthService(KnownServers())
+        sock = auth.connect_server('127.0.0.1', port)
+        self.addCleanup(sock.close)
+        success, message = auth.authenticate(sock, 'alice', 'secret', "REGISTER", LEGACY_VERSION)
+        self.assertTrue(success, message)
+
+        # The history replay follows the response at once
+        read_until(auth, sock, "HISTORY_END|ALL|0|0")
+
+    def test_busy_server_is_not_retried_as_legacy(self):
+        quiet(self)
+        server, port = start_server(self, max_connections=0)
+        auth = AuthService(KnownServers())
+        success, sock, message = auth.login('127.0.0.1', port, 'alice', 'secret')
+        self.assertFalse(success)
+        self.assertEqual(message, AUTH_BUSY)
+        self.assertTrue(auth.rejected)
+        self.assertEqual(auth.protocol_version, PROTOCOL_VERSION)
+
+    def test_silent_close_is_reported(self):
+        listener = socket.create_server(('127.0.0.1', 0))
+        self.addCleanup(listener.close)
+
+        def drop():
+            for _ in range(2):
+                sock, address = listener.accept()
+                sock.recv(4096)
+                sock.close()
+        threading.Thread(target=drop, daemon=True).start()
+        success, sock, message = AuthService(KnownServers()).login('127.0.0.1', listener.getsockname()[1], 'alice', 'secret')
+        self.assertFalse(success)
+        self.assertEqual(message, SERVER_CLOSED)
+
+
+class HandshakeTest(unittest.TestCase):
+    def login(self, port, known_servers):
+        auth = AuthService(known_servers)
+        success, sock, message = auth.register('127.0.0.1', port, 'alice', 'secret')
+        if sock:
+            self.addCleanup(sock.close)
+        return auth, success, message
+
+    def test_identity_pinned_on_first_login(self):
+        quiet(self)
+        server, port = start_server(self)
+        known = KnownServers()
+        auth, success, message = self.login(port, known)
+        self.assertTrue(success, message)
+        self.assertEqual(auth.protocol_version, PROTOCOL_VERSION)
+        self.assertIsNot(auth.cipher, auth.encryption)
+        self.assertIsNotNone(auth.group_cipher)
+        self.assertEqual(known.get(f"127.0.0.1:{port}"), server.identity.public_key)
+
+    def test_pins_are_saved(self):
+        quiet(self)
+        server, port = start_server(self)
+        path = os.path.join(tempfile.mkdtemp(), 'known.json')
+        self.addCleanup(os.unlink, path)
+        auth, success, message = self.login(port, KnownServers(path))
+        self.assertTrue(success, message)
+        self.assertEqual(KnownServers(path).get(f"127.0.0.1:{port}"), server.identity.public_key)
+
+    def test_changed_identity_is_refused(self):
+        quiet(self)
+        server, port = start_server(self)
+        known = KnownServers()
+        known.pin(f"127.0.0.1:{port}", ServerIdentity(os.urandom(32)).public_key)
+        auth, success, message = self.login(port, known)
+        self.assertFalse(success)
+        self.assertEqual(message, IDENTITY_CHANGED)
+        self.assertTrue(auth.rejected)
+
+    def test_pinned_server_is_not_retried_as_legacy(self):
+        server = LegacyServer([])
+        self.addCleanup(server.close)
+        known = KnownServers()
+        known.pin(f"127.0.0.1:{server.port}", ServerIdentity(os.urandom(32)).public_key)
+        auth, success, message = self.login(server.port, known)
+        self.assertFalse(success)
+        self.assertEqual(message, SERVER_CLOSED)
+        self.assertEqual(server.requests, [None])
+
+    def test_auth_under_shared_key_is_dropped(self):
+        quiet(self)
+        server, port = start_server(self)
+        encryption = MessageEncryption()
+        auth = encryption.encrypt("AUTH|REGISTER|alice|secret|").encode()
+        client = AuthService(KnownServers())
+        for handshake in (False, True):
+            with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+                if handshake:
+                    client.handshake(sock, FrameDecoder())
+                sock.sendall(encode_wire(auth, PROTOCOL_VERSION))
+                self.assertEqual(sock.recv(4096), b'')
+
+
+class SessionTokenTest(unittest.TestCase):
+    def test_resume_with_token(self):
+        quiet(self)
+        server, port = start_server(self)
+        auth = AuthService(KnownServers())
+        success, sock, message = auth.register('127.0.0.1', port, 'alice', 'secret')
+        self.assertTrue(success, message)
+        token = read_until(auth, sock, "HISTORY_END|ALL|0|0")[0].split('|')[1]
+        sock.close()
+
+        success, sock, message = auth.resume('127.0.0.1', port, 'alice', token)
+        self.addCleanup(sock.close)
+        self.assertTrue(success, message)
+        self.assertTrue(auth.resumed)
+
+    def test_no_token_under_shared_key(self):
+        quiet(self)
+        server, port = start_server(self)
+        auth = AuthService(KnownServers())
+        sock = auth.connect_server('127.0.0.1', port)
+        self.addCleanup(sock.close)
+        success, message = auth.authenticate(sock, 'alice', 'secret', "REGISTER", LEGACY_VERSION)
+        self.assertTrue(success, message)
+        lines = read_until(auth, sock, "HISTORY_END|ALL|0|0")
+        self.assertFalse([line for line in lines if line.startswith("SESSION|")])
+
+    def test_resume_under_shared_key_is_dropped(self):
+        quiet(self)
+        server, port = start_server(self)
+        server.register_user('alice', 'secret')
+        token, expires = server.sessions.issue('alice')
+        request = MessageEncryption().encrypt(f"AUTH|RESUME|alice|{token}|RESUME").encode()
+        with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+            sock.sendall(request)
+            self.assertEqual(sock.recv(4096), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import multiprocessing
+import queue
+import threading
+import time
+import unittest
+
+from broker import BrokerServer, TcpBus
+from bus import EVENT_DELIVER, EVENT_JOIN, EVENT_LEAVE, BusHub, InProcessBus
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+def next_event(events, event_type, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        event = events.get(timeout=max(deadline - time.monotonic(), 0.01))
+        if event['type'] == event_type:
+            return event
+
+
+class NodeDepartureTest(unittest.TestCase):
+    def check_departure(self, hub, make_bus):
+        events = queue.SimpleQueue()
+        a, b = make_bus('a'), make_bus('b')
+        a.start(lambda event: None)
+        b.start(events.put)
+        wait_for(lambda: set(hub.members) == {'a', 'b'})
+
+        a.publish({'type': EVENT_JOIN, 'user': 'alice'})
+        self.assertEqual(next_event(events, EVENT_JOIN)['user'], 'alice')
+
+        a.close()
+        leave = next_event(events, EVENT_LEAVE)
+        self.assertEqual((leave['node'], leave['user']), ('a', 'alice'))
+        wait_for(lambda: 'a' not in hub.members)
+        self.assertEqual(hub.presence, {})
+        b.close()
+
+    def test_inproc_close_removes_member(self):
+        hub = BusHub()
+        self.check_departure(hub, lambda node: InProcessBus(node, hub))
+
+    def test_broker_disconnect_removes_member(self):
+        broker = BrokerServer('127.0.0.1', 0)
+        broker.start_background()
+        wait_for(lambda: broker.running)
+        try:
+            self.check_departure(broker.hub, lambda node: TcpBus(node, '127.0.0.1', broker.port))
+        finally:
+            broker.stop()
+
+
+class BrokerSecretTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = BrokerServer('127.0.0.1', 0, 'cluster secret')
+        self.broker.start_background()
+        wait_for(lambda: self.broker.running)
+        self.buses = []
+
+    def tearDown(self):
+        for bus in self.buses:
+            bus.close()
+        self.broker.stop()
+
+    def bus(self, node, secret):
+        bus = TcpBus(node, '127.0.0.1', self.broker.port, secret)
+        self.buses.append(bus)
+        return bus
+
+    def test_nodes_with_the_secret_exchange_events(self):
+        events = queue.SimpleQueue()
+        self.bus('a', 'cluster secret').start(lambda event: None)
+        self.bus('b', 'cluster secret').start(events.put)
+        wait_for(lambda: set(self.broker.hub.members) == {'a', 'b'})
+        self.buses[0].publish({'type': EVENT_JOIN, 'user': 'alice'})
+        self.assertEqual(next_event(events, EVENT_JOIN)['user'], 'alice')
+        self.assertIsNotNone(self.buses[0].cipher)
+
+    def test_wrong_secret_is_refused(self):
+        bus = self.bus('a', 'guess')
+        with self.assertRaises(ConnectionError):
+            bus.connect()
+        self.assertEqual(self.broker.hub.members, {})
+
+    def test_non_loopback_needs_a_secret(self):
+        with self.assertRaises(ValueError):
+            BrokerServer('0.0.0.0', 0)
+        self.assertEqual(BrokerServer().host, '127.0.0.1')
+
+
+class PipeHubTest(unittest.TestCase):
+    def test_worker_that_stops_reading_does_not_stall_the_others(self):
+        hub = BusHub()
+        pipes = {node: multiprocessing.Pipe() for node in ('a', 'slow', 'fast')}
+        running = True
+        thread = threading.Thread(
+            target=hub.serve_pipes, args=({node: ends[0] for node, ends in pipes.items()}, lambda: running)
+        )
+        thread.start()
+        wait_for(lambda: len(hub.members) == 3)
+
+        # Far more than a pipe buffers, none of it read by 'slow'
+        count = 200
+        for i in range(count):
+            pipes['a'][1].send({'type': EVENT_DELIVER, 'node': 'a', 'to': None, 'message': f"{i}" * 10000})
+        fast = pipes['fast'][1]
+        received = 0
+        while received < count:
+            self.assertTrue(fast.poll(5), f"stalled after {received} events")
+            if fast.recv()['type'] == EVENT_DELIVER:
+                received += 1
+
+        pipes['slow'][1].close()
+        running = False
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
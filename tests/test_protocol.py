@@ -0,0 +1,171 @@
+import unittest
+
+from protocol import (
+    FRAME_HEADER, FRAME_HISTORY_BATCH, FRAME_MAGIC, FRAME_MESSAGE, LEGACY_VERSION, MAX_AUTH_FRAME_SIZE,
+    PROTOCOL_VERSION, FrameDecoder, ProtocolError, detect_version, encode_wire,
+)
+
+
+def frames(*payloads):
+    return b''.join(encode_wire(payload, PROTOCOL_VERSION) for payload in payloads)
+
+
+def header(length):
+    return FRAME_HEADER.pack(FRAME_MAGIC | PROTOCOL_VERSION, FRAME_MESSAGE, 0, length)
+
+
+class ChunkSocket:
+    """Hands out fixed bytes at most `chunk` bytes per recv_into call"""
+
+    def __init__(self, data, chunk):
+        self.data = data
+        self.chunk = chunk
+        self.pos = 0
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), self.chunk, len(self.data) - self.pos)
+        buffer[:size] = self.data[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+
+class BinaryDecoderTest(unittest.TestCase):
+    def test_no_buffer_until_first_read(self):
+        decoder = FrameDecoder()
+        self.assertEqual(len(decoder.buffer), 0)
+        self.assertEqual(decoder.drain(), [])
+        self.assertIsNone(next(decoder, None))
+
+    def test_partial_header_yields_nothing_until_complete(self):
+        decoder = FrameDecoder()
+        data = frames(b'hello')
+        for byte in data[:-1]:
+            decoder.feed(bytes([byte]))
+            self.assertEqual(decoder.drain(), [])
+        decoder.feed(data[-1:])
+        self.assertEqual(decoder.drain(), [(FRAME_MESSAGE, 0, b'hello')])
+        self.assertEqual(decoder.pending, 0)
+
+    def test_header_alone_does_not_reserve_the_declared_length(self):
+        decoder = FrameDecoder()
+        decoder.feed(header(1 << 24))
+        self.assertEqual(decoder.drain(), [])
+        self.assertIsNone(next(decoder, None))
+        self.assertEqual(len(decoder.buffer), decoder.buffer_size)
+
+    def test_frames_split_across_reads(self):
+        data = frames(b'one', b'two' * 100, b'three')
+        for chunk in (1, 5, 7, 64):
+            decoder = FrameDecoder(buffer_size=16, read_size=16)
+            sock = ChunkSocket(data, chunk)
+            received = []
+            while decoder.recv_into(sock):
+                received.extend(decoder.drain())
+            self.assertEqual([payload for _, _, payload in received], [b'one', b'two' * 100, b'three'])
+
+    def test_iteration_and_drain_agree(self):
+        decoder = FrameDecoder()
+        decoder.feed(frames(b'one', b'two', b'three') + frames(b'fo')[:-1])
+        self.assertEqual([payload for _, _, payload in decoder.drain()], [b'one', b'two', b'three'])
+        decoder.feed(b'o' + frames(b'a', b'b'))
+        self.assertEqual([payload for _, _, payload in decoder], [b'fo', b'a', b'b'])
+
+    def test_frame_type_and_flags(self):
+        decoder = FrameDecoder()
+        decoder.feed(encode_wire(b'batch', PROTOCOL_VERSION, FRAME_HISTORY_BATCH, 0x03))
+        self.assertEqual(decoder.drain(), [(FRAME_HISTORY_BATCH, 0x03, b'batch')])
+
+    def test_compaction_reuses_the_buffer(self):
+        decoder = FrameDecoder(buffer_size=64, read_size=16)
+        payload = b'x' * 20
+        data = frames(payload) * 10
+        decoder.feed(data[:40])
+        self.assertEqual(decoder.drain(), [(FRAME_MESSAGE, 0, payload)])
+        buffer = decoder.buffer
+        # 13 bytes are left unread at offset 27; 40 more only fit once they slide to the front
+        decoder.feed(data[40:80])
+        self.assertIs(decoder.buffer, buffer)
+        self.assertEqual(decoder.start, 0)
+        self.assertEqual(decoder.drain(), [(FRAME_MESSAGE, 0, payload)])
+        self.assertEqual(decoder.pending, 26)
+
+    def test_growth_keeps_unread_bytes_and_releases_large_buffers(self):
+        payload = bytes(range(256)) * 1024
+        decoder = FrameDecoder()
+        sock = ChunkSocket(frames(payload, b'next'), 1000)
+        received = []
+        sizes = set()
+        while decoder.recv_into(sock):
+            sizes.add(len(decoder.buffer))
+            received.extend(decoder.drain())
+        self.assertEqual(received, [(FRAME_MESSAGE, 0, payload), (FRAME_MESSAGE, 0, b'next')])
+        self.assertGreater(max(sizes), len(payload))
+        # Doubling, not one reallocation per read
+        self.assertLess(len(sizes), 12)
+        self.assertLessEqual(len(decoder.buffer), FrameDecoder.IDLE_BUFFER_SIZE)
+
+    def test_oversize_frame_rejected(self):
+        decoder = FrameDecoder(max_frame_size=MAX_AUTH_FRAME_SIZE)
+        decoder.feed(header(MAX_AUTH_FRAME_SIZE + 1))
+        with self.assertRaises(ProtocolError):
+            decoder.drain()
+        with self.assertRaises(ProtocolError):
+            next(decoder)
+
+    def test_max_frame_size_can_be_raised(self):
+        decoder = FrameDecoder(max_frame_size=8)
+        decoder.feed(frames(b'x' * 16))
+        with self.assertRaises(ProtocolError):
+            decoder.drain()
+        decoder.max_frame_size = 16
+        self.assertEqual(decoder.drain(), [(FRAME_MESSAGE, 0, b'x' * 16)])
+
+    def test_bad_magic_rejected(self):
+        for first in (0x41, FRAME_MAGIC | (PROTOCOL_VERSION + 1)):
+            decoder = FrameDecoder()
+            decoder.feed(bytes([first]) + frames(b'x')[1:])
+            with self.assertRaises(ProtocolError):
+                decoder.drain()
+            with self.assertRaises(ProtocolError):
+                next(decoder)
+
+
+class LegacyDecoderTest(unittest.TestCase):
+    def test_lines_split_across_chunks(self):
+        decoder = FrameDecoder(LEGACY_VERSION)
+        decoder.feed(b'first li')
+        self.assertEqual(decoder.drain(), [])
+        decoder.feed(b'ne\n\nsecond\nthi')
+        self.assertEqual(decoder.drain(), [(FRAME_MESSAGE, 0, b'first line'), (FRAME_MESSAGE, 0, b'second')])
+        decoder.feed(b'rd\n')
+        self.assertEqual(list(decoder), [(FRAME_MESSAGE, 0, b'third')])
+
+    def test_lines_split_across_reads(self):
+        lines = [b'gAAAAA' + bytes([65 + i]) * (i * 37) for i in range(20)]
+        decoder = FrameDecoder(LEGACY_VERSION, buffer_size=16, read_size=16)
+        sock = ChunkSocket(b''.join(line + b'\n' for line in lines), 13)
+        received = []
+        while decoder.recv_into(sock):
+            received.extend(payload for _, _, payload in decoder.drain())
+        self.assertEqual(received, lines)
+
+    def test_overlong_line_rejected(self):
+        decoder = FrameDecoder(LEGACY_VERSION, max_frame_size=16)
+        decoder.feed(b'x' * 17)
+        with self.assertRaises(ProtocolError):
+            decoder.drain()
+        decoder = FrameDecoder(LEGACY_VERSION, max_frame_size=16)
+        decoder.feed(b'x' * 17)
+        with self.assertRaises(ProtocolError):
+            next(decoder)
+
+
+class DetectVersionTest(unittest.TestCase):
+    def test_detect_version(self):
+        self.assertEqual(detect_version(frames(b'x')), PROTOCOL_VERSION)
+        self.assertEqual(detect_version(b'gAAAAAB...\n'), LEGACY_VERSION)
+        self.assertEqual(detect_version(b''), LEGACY_VERSION)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import socket
+import unittest
+
+from auth_service import AuthService, KnownServers
+from encryption import MessageEncryption
+from protocol import LEGACY_VERSION, FrameDecoder
+from tests.support import quiet, read_until, send, start_server
+
+
+def register(test, port, username):
+    auth = AuthService(KnownServers())
+    success, sock, message = auth.register('127.0.0.1', port, username, 'secret')
+    test.assertTrue(success, message)
+    test.addCleanup(sock.close)
+    read_until(auth, sock, "HISTORY_END|ALL|0|0")
+    return auth, sock
+
+
+class LiveMessageTest(unittest.TestCase):
+    def check_ids(self, durability):
+        quiet(self)
+        server, port = start_server(self, durability=durability)
+        alice, alice_sock = register(self, port, 'alice')
+        bob, bob_sock = register(self, port, 'bob')
+
+        send(alice, alice_sock, "MSG|2025/01/01 10:00:00|alice|ALL|hello")
+        send(alice, alice_sock, "MSG|2025/01/01 10:00:01|alice|bob|psst")
+        first = "LIVE_MSG|1|2025/01/01 10:00:00|alice|ALL|hello"
+        second = "LIVE_MSG|2|2025/01/01 10:00:01|alice|bob|psst"
+        self.assertIn(first, read_until(bob, bob_sock, second))
+        # The sender's copies carry the ids too
+        self.assertIn(first, read_until(alice, alice_sock, second))
+
+        rows, has_more = server.db_manager.get_history_page('bob', 'alice')
+        self.assertEqual([row[0] for row in rows], [2])
+
+    def test_ids_in_queue_mode(self):
+        self.check_ids('queue')
+
+    def test_ids_in_commit_mode(self):
+        self.check_ids('commit')
+
+    def test_older_clients_get_plain_msg(self):
+        quiet(self)
+        server, port = start_server(self)
+        alice, alice_sock = register(self, port, 'alice')
+
+        # A legacy client advertising no features
+        encryption = MessageEncryption()
+        server.register_user('carol', 'secret')
+        carol = socket.create_connection(('127.0.0.1', port), timeout=5)
+        self.addCleanup(carol.close)
+        carol.sendall(encryption.encrypt("AUTH|LOGIN|carol|secret|").encode())
+        decoder = FrameDecoder(LEGACY_VERSION)
+        reply = AuthService(KnownServers()).read_legacy_response(carol, decoder)
+        self.assertTrue(encryption.decrypt(reply.decode()).startswith("AUTH_RESPONSE|SUCCESS"))
+
+        send(alice, alice_sock, "MSG|2025/01/01 10:00:00|alice|ALL|hello")
+        lines = [encryption.decrypt(payload.decode()) for _, _, payload in decoder.drain()]
+        while "MSG|2025/01/01 10:00:00|alice|ALL|hello" not in lines:
+            self.assertTrue(decoder.recv_into(carol))
+            lines.extend(encryption.decrypt(payload.decode()) for _, _, payload in decoder.drain())
+
+
+class PresenceSeqTest(unittest.TestCase):
+    def test_seq_follows_a_burst_of_deltas(self):
+        quiet(self)
+        server, port = start_server(self, presence_check_delay=0.05)
+        alice, alice_sock = register(self, port, 'alice')
+        register(self, port, 'bob')
+
+        lines = read_until(alice, alice_sock, "PRESENCE_SEQ|2")
+        self.assertLess(lines.index("PRESENCE_JOIN|2|bob"), lines.index("PRESENCE_SEQ|2"))
+        # Unlike the deltas it checks, the SEQ frame is never shed
+        self.assertTrue(server.make_frame("PRESENCE_JOIN|2|bob").droppable)
+        self.assertFalse(server.make_frame("PRESENCE_SEQ|2").droppable)
+
+
+class ReconnectTest(unittest.TestCase):
+    def test_refused_token_without_password_gives_up(self):
+        quiet(self)
+        server, port = start_server(self)
+        server.register_user('alice', 'secret')
+        auth = AuthService(KnownServers())
+        success, sock, message = auth.reconnect('127.0.0.1', port, 'alice', None, 'forged', base_delay=0)
+        self.assertFalse(success)
+        self.assertTrue(auth.rejected)
+        self.assertEqual(message, "Invalid or expired session")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import heapq
+import itertools
+import threading
+import time
+
+class Timer:
+    """Handle for a callback scheduled on a TimerQueue"""
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class TimerQueue:
+    """Runs delayed callbacks on one background thread.
+
+    Timers sit in a heap ordered by deadline, so any number of pending
+    callbacks costs one thread instead of a threading.Timer each.
+    Callbacks must be short; anything slow belongs on another thread.
+    """
+    def __init__(self, name="chatx-timers"):
+        self.heap = []
+        self.counter = itertools.count()  # tie-breaker for equal deadlines
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def call_later(self, delay, callback, *args):
+        """Run callback(*args) after `delay` seconds; returns a cancellable Timer"""
+        timer = Timer(time.monotonic() + max(0.0, delay), callback, args)
+        with self.condition:
+            heapq.heappush(self.heap, (timer.when, next(self.counter), timer))
+            if self.heap[0][2] is timer:
+                self.condition.notify()
+        return timer
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.closed:
+                    if self.heap:
+                        wait = self.heap[0][0] - time.monotonic()
+                        if wait <= 0:
+                            break
+                        self.condition.wait(wait)
+                    else:
+                        self.condition.wait()
+                if self.closed:
+                    return
+                timer = heapq.heappop(self.heap)[2]
+            if timer.cancelled:
+                continue
+            try:
+                timer.callback(*timer.args)
+            except Exception as e:
+                print(f"[SERVER] Timer callback failed: {e}")
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.heap.clear()
+            self.condition.notify()
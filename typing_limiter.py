@@ -0,0 +1,58 @@
+import threading
+import time
+
+class TypingLimiter:
+    """Rate-limits and coalesces typing indicators per (sender, chat).
+
+    At most one state change is forwarded per `interval` seconds for each
+    sender in each chat. Changes arriving sooner are held and only the
+    latest is sent when the interval ends, so ON/OFF/ON bursts collapse to
+    a single update and repeats of the current state are dropped.
+    `emit(sender, receiver, status)` does the actual routing; held states
+    are flushed by `timers` (a TimerQueue).
+    """
+    def __init__(self, emit, timers, interval=1.0):
+        self.emit = emit
+        self.timers = timers
+        self.interval = interval
+        self.lock = threading.Lock()
+        # sender: {receiver: [sent status, sent at, held status, flush scheduled]}
+        self.state = {}
+
+    def offer(self, sender, receiver, status):
+        now = time.monotonic()
+        with self.lock:
+            chats = self.state.setdefault(sender, {})
+            entry = chats.get(receiver)
+            if entry is None:
+                entry = chats[receiver] = ["OFF", now - self.interval, None, False]
+            if entry[3]:
+                entry[2] = status
+                return
+            if status == entry[0]:
+                return
+            wait = entry[1] + self.interval - now
+            if wait > 0:
+                entry[2] = status
+                entry[3] = True
+                self.timers.call_later(wait, self.flush, sender, receiver)
+                return
+            entry[0], entry[1] = status, now
+        self.emit(sender, receiver, status)
+
+    def flush(self, sender, receiver):
+        with self.lock:
+            entry = self.state.get(sender, {}).get(receiver)
+            if entry is None:
+                return
+            status, entry[2], entry[3] = entry[2], None, False
+            if status is None or status == entry[0]:
+                return
+            entry[0], entry[1] = status, time.monotonic()
+        self.emit(sender, receiver, status)
+
+    def forget(self, sender):
+        """Drop a departed sender; returns the chats it was still typing in"""
+        with self.lock:
+            chats = self.state.pop(sender, {})
+        return [receiver for receiver, entry in chats.items() if entry[0] == "ON"]
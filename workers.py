@@ -0,0 +1,116 @@
+import multiprocessing
+import signal
+import socket
+import threading
+
+from bus import EVENT_STOP, BusHub, PipeBus
+from discovery import DiscoveryBeacon
+
+def run_worker(node, conn, host, port, engine, kwargs):
+    # Entry point of one worker process: a normal server sharing the port
+    from server import create_server
+    server = create_server(host, port, engine, reuse_port=True, interactive=False, **kwargs)
+    server.attach_bus(PipeBus(node, conn))
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        server.stop()
+
+class WorkerPool:
+    """Runs a chat server as several processes sharing one listening port.
+
+    Each worker is an ordinary ChatServer (either engine) bound with
+    SO_REUSEPORT, so the kernel spreads incoming connections across them.
+    Users on different workers reach each other through a BusHub in this
+    process, which relays events over one Pipe per worker and keeps the
+    global presence map behind USER_LIST.
+    """
+    def __init__(self, host='0.0.0.0', port=5555, workers=2, engine='threaded', **kwargs):
+        if workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+            print("[SERVER] SO_REUSEPORT is not available on this platform; using one worker")
+            workers = 1
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.engine = engine
+        # One discovery beacon for the pool, answered from this process
+        self.discovery_port = kwargs.pop('discovery_port', None)
+        self.beacon = None
+        self.kwargs = kwargs
+        self.hub = BusHub()
+        self.pipes = {}      # node: hub end of the worker's Pipe
+        self.processes = []
+        self.running = False
+
+    def start(self):
+        # Spawn the workers, then relay bus events until stopped
+        self.running = True
+        for index in range(self.workers):
+            node = f"worker-{index}"
+            kwargs = dict(self.kwargs)
+            if kwargs.get('metrics_port'):
+                # Each worker serves its own metrics, on consecutive ports
+                kwargs['metrics_port'] += index
+            hub_end, worker_end = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_worker, name=node, daemon=True,
+                args=(node, worker_end, self.host, self.port, self.engine, kwargs)
+            )
+            process.start()
+            worker_end.close()
+            self.pipes[node] = hub_end
+            self.processes.append(process)
+
+        print(f"[SERVER] ChatX Server started {self.workers} {self.engine} worker(s) on {self.host}:{self.port}")
+        if self.discovery_port:
+            try:
+                self.beacon = DiscoveryBeacon(self.port, self.discovery_port, health=self.health_metrics)
+            except OSError as e:
+                print(f"[SERVER] Discovery beacon unavailable: {e}")
+        if threading.current_thread() is threading.main_thread():
+            # SIGTERM stops the workers too instead of orphaning them
+            signal.signal(signal.SIGTERM, lambda signum, frame: setattr(self, 'running', False))
+        input_thread = threading.Thread(target=self.monitor_terminal_input, daemon=True)
+        input_thread.start()
+        try:
+            self.hub.serve_pipes(dict(self.pipes), lambda: self.running)
+        except KeyboardInterrupt:
+            print("\n[SERVER] Keyboard interrupt received...")
+        finally:
+            self.stop()
+
+    def health_metrics(self):
+        # The hub's presence map covers every worker; queues live in the workers
+        return {'users': len(self.hub.presence), 'workers': self.workers}
+
+    def monitor_terminal_input(self):
+        print("\n[SERVER] Type 'stop' or 'quit' to shutdown all workers gracefully\n")
+        while self.running:
+            try:
+                if input().strip().lower() in ['stop', 'quit', 'exit', 'q']:
+                    print("\n[SERVER] Shutting down workers...")
+                    self.running = False
+                    break
+            except (EOFError, KeyboardInterrupt):
+                break
+
+    def stop(self):
+        # Ask every worker to stop (flushing its message writer), then reap them
+        self.running = False
+        if self.beacon is not None:
+            self.beacon.close()
+            self.beacon = None
+        # serve_pipes has stopped the pipes' writer threads, so nothing else sends now
+        for conn in self.pipes.values():
+            try:
+                conn.send({'type': EVENT_STOP, 'node': None})
+            except (OSError, ValueError):
+                pass
+        for process in self.processes:
+            process.join(timeout=10)
+            if process.is_alive():
+                process.terminate()
+        for conn in self.pipes.values():
+            conn.close()
+        self.pipes.clear()
+        self.processes = []